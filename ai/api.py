@@ -3,33 +3,60 @@ import shutil
 import asyncio
 import json
 import datetime
-import time
-from typing import List, Dict
+import functools
+from contextlib import asynccontextmanager
+from typing import List, Dict, Optional
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from config.settings import OUTPUT_DIR, GEMINI_ENGINE
-from core.pdf_utils import convert_pdf_to_images
-from core.schema_manager import load_schemas, update_schema_memory
-from core.ai_extractor import extract_invoice_with_rotation
-from core.excel_writer import update_excel_sheet
+from config.settings import OUTPUT_DIR, SESSION_STORE, API_WORKERS, EXTRACTION_QUEUE, GEMINI_PROCESS_SHARE
+from core.pdf_utils import shutdown_raster_pool, vendor_folder
+from core.schema_manager import schema_registry
+from core.ai_extractor import retry_policy
+from core.gemini_clients import gemini_clients
+from core.key_scheduler import key_scheduler
+from core.fair_scheduler import fair_scheduler
+from core.excel_writer import export_report, EXPORT_FORMATS
+from core.pipeline import (
+    process_single_file_async, log_file_usage, mark_file_done, store_file_result, write_session_report,
+    RASTER_PREFETCH,
+)
+from core.result_store import result_store
+from core.session_store import session_store
+from core.job_queue import job_queue
 from costing.cost_manager import CostManager
-from costing.price_updater import update_model_prices
+from costing.usage_ledger import usage_ledger
+from costing.price_service import price_service
 
 
 BASE_UPLOAD_DIR = "uploads"
 BASE_OUTPUT_DIR = "outputs"
 
-MAX_CONCURRENT_TASKS = 3 
-
 MAX_FILES_ALLOWED = 10
 MAX_FILE_SIZE_MB = 10
 MAX_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
-SESSION_STATUS: Dict[str, Dict] = {}
-
-app = FastAPI(title="Mizhou Invoice Extractor API")
+# Longest a /status long-poll is held open, and the SSE keep-alive interval.
+LONG_POLL_MAX_SECONDS = 30
+SSE_KEEPALIVE_SECONDS = 15
+FINAL_STATUSES = ("completed", "failed")
+EXPORT_MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    gemini_clients.start()
+    price_service.start()
+    yield
+    await price_service.stop()
+    await gemini_clients.aclose()
+    shutdown_raster_pool()
+
+app = FastAPI(title="Mizhou Invoice Extractor API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -39,81 +66,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-async def process_single_file_async(file_path, schemas, semaphore):
-    """
-    Async Worker: Performs the extraction.
-    Does NOT update global status (keeps it pure).
-    """
-    async with semaphore:
-        filename = os.path.basename(file_path)
-        start_time = time.time()
-        
-        try:
-            images = convert_pdf_to_images(file_path)
-            if not images:
-                return None, None, f"Skipped (Image Conversion Failed): {filename}"
-
-            invoices_list, usage_stats = await extract_invoice_with_rotation(images, schemas)
-            
-            end_time = time.time()
-            duration = round(end_time - start_time, 2)
-
-            if invoices_list:
-                unique_invoices = []
-                seen_invoice_numbers = set()
-                
-                for invoice in invoices_list:
-                    inv_no = str(invoice.get("Invoice No", "")).strip()
-                    if inv_no and inv_no in seen_invoice_numbers:
-                        continue
-                    if inv_no:
-                        seen_invoice_numbers.add(inv_no)
-                    unique_invoices.append(invoice)
-
-                if unique_invoices:
-                    return unique_invoices, usage_stats, f"Completed ({duration}s)"
-                else:
-                    return None, usage_stats, f"Skipped (Duplicate) ({duration}s)"
-            else:
-                return None, None, f"Failed (AI returned no data) ({duration}s)"
-
-        except Exception as e:
-            end_time = time.time()
-            duration = round(end_time - start_time, 2)
-            return None, None, f"Error: {str(e)} ({duration}s)"
-
-async def process_and_track_file(file_path, schemas, semaphore, session_key, cost_manager):
+async def process_and_track_file(file_path, schema, gemini_slot, prefetch_semaphore, session_key, cost_manager,
+                                 report_path, user_id, session_id):
     """
     🔥 THE SMART WRAPPER 🔥
     This function calls the worker AND updates the global status IMMEDIATELY.
+    The file's rows are stored right away, so /partial can serve them before the session ends.
     """
     filename = os.path.basename(file_path)
     
-    SESSION_STATUS[session_key]["files"][filename] = "Processing..."
+    def mark_processing(state):
+        state["files"][filename] = "Processing..."
+    await asyncio.to_thread(session_store.mutate, session_key, mark_processing)
     
-    invoices, stats, msg = await process_single_file_async(file_path, schemas, semaphore)
+    invoices, stats, msg = await process_single_file_async(file_path, schema, gemini_slot, prefetch_semaphore)
     
     print(f"⏱️  Worker Finished: {filename} -> {msg}")
-    SESSION_STATUS[session_key]["files"][filename] = msg
-    SESSION_STATUS[session_key]["completed_count"] += 1
-    
-    if stats:
-        cost_manager.log_usage(
-            model_name=GEMINI_ENGINE,
-            input_tokens=stats["input_tokens"],
-            output_tokens=stats["output_tokens"],
-            filename=filename
-        )
-        
+
+    if invoices:
+        await asyncio.to_thread(store_file_result, report_path, invoices, user_id, session_id)
+    log_file_usage(cost_manager, filename, stats)
+    await asyncio.to_thread(mark_file_done, session_key, filename, msg, stats, cost_manager.running_totals(),
+                            fair_scheduler.snapshot(session_key))
+
     return invoices
 
-async def background_extraction_task(user_id: str, session_id: str, saved_paths: List[str]):
-    """
-    Async Background Manager
-    """
-    session_key = f"{user_id}_{session_id}"
-    
-    # Initialize Status
+def initial_session_status(saved_paths, worker_pid=None):
     file_sizes_map = {}
     for p in saved_paths:
         try:
@@ -121,68 +99,65 @@ async def background_extraction_task(user_id: str, session_id: str, saved_paths:
         except:
             file_sizes_map[os.path.basename(p)] = 0
 
-    SESSION_STATUS[session_key] = {
+    return {
         "status": "processing",
+        "worker_pid": worker_pid,
         "files": {os.path.basename(p): "pending" for p in saved_paths},
         "file_sizes": file_sizes_map,
         "completed_count": 0,
         "total_count": len(saved_paths),
         "download_url": None,
-        "cost_analysis": None
+        "cost_analysis": None,
+        "cost": None,
+        "cache": {"hits": 0, "misses": 0}
     }
 
-    try:
-        print("💰 Updating Model Prices...")
-        update_model_prices()
+def new_report_path(user_id, session_id):
+    session_output_dir = os.path.join(BASE_OUTPUT_DIR, user_id, session_id)
+    os.makedirs(session_output_dir, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(session_output_dir, f"Report_{timestamp}.xlsx")
 
-        cost_manager = CostManager()
-        schemas = load_schemas()
-        
-        session_output_dir = os.path.join(BASE_OUTPUT_DIR, user_id, session_id)
-        os.makedirs(session_output_dir, exist_ok=True)
+async def background_extraction_task(user_id: str, session_id: str, saved_paths: List[str]):
+    """
+    Async Background Manager
+    """
+    session_key = f"{user_id}_{session_id}"
+    initial_state = initial_session_status(saved_paths, worker_pid=os.getpid())
+    await asyncio.to_thread(session_store.create, session_key, initial_state)
 
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        report_filename = f"Report_{timestamp}.xlsx"
-        report_path = os.path.join(session_output_dir, report_filename)
+    try:
+        cost_manager = CostManager(user_id=user_id, session_id=session_id)
+        schema = schema_registry.snapshot()
+        report_path = new_report_path(user_id, session_id)
 
         print(f"🚀 Processing {len(saved_paths)} files asynchronously for Session: {session_id}")
         
-        semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+        gemini_slot = functools.partial(fair_scheduler.slot, user_id, session_key=session_key)
+        prefetch_semaphore = asyncio.Semaphore(fair_scheduler.max_concurrent + RASTER_PREFETCH)
         
         tasks = [
-            process_and_track_file(path, schemas, semaphore, session_key, cost_manager)
+            process_and_track_file(path, schema, gemini_slot, prefetch_semaphore, session_key, cost_manager,
+                                   report_path, user_id, session_id)
             for path in saved_paths
         ]
-        results = await asyncio.gather(*tasks)
-
-        all_file_results = [res for res in results if res is not None]
+        await asyncio.gather(*tasks)
 
-        print(f"💾 Writing Excel...")
-        for file_batch in all_file_results:
-            if not file_batch: continue
-            first_item = file_batch[0]
-            vendor_name = first_item.get("Vendor Name", "Unknown_Vendor")
-            
-            final_columns = update_excel_sheet(vendor_name, file_batch, file_path=report_path)
-            if final_columns:
-                update_schema_memory(vendor_name, final_columns)
+        await asyncio.to_thread(session_store.update, session_key, queue=fair_scheduler.snapshot(session_key))
+        fair_scheduler.forget_session(session_key)
 
-        financial_summary = cost_manager.generate_total()
-        with open(os.path.join(session_output_dir, "costing.json"), "w") as f:
-            json.dump(financial_summary, f, indent=4)
+        download_link, financial_summary = write_session_report(user_id, session_id, report_path, cost_manager)
 
-        download_link = f"http://127.0.0.1:8000/download/{user_id}/{session_id}/{report_filename}"
-
-        SESSION_STATUS[session_key]["status"] = "completed"
-        SESSION_STATUS[session_key]["download_url"] = download_link
-        SESSION_STATUS[session_key]["cost_analysis"] = financial_summary
+        await asyncio.to_thread(
+            session_store.update,
+            session_key, status="completed", download_url=download_link, cost_analysis=financial_summary,
+        )
         
         print(f"✅ Session {session_id} Completed.")
 
     except Exception as e:
         print(f"❌ Global Error in Background Task: {e}")
-        SESSION_STATUS[session_key]["status"] = "failed"
-        SESSION_STATUS[session_key]["error"] = str(e)
+        await asyncio.to_thread(session_store.update, session_key, status="failed", error=str(e))
 
 
 @app.post("/extract")
@@ -190,7 +165,8 @@ async def extract_invoices(
     background_tasks: BackgroundTasks,
     user_id: str = Form(...),
     session_id: str = Form(...),
-    files: List[UploadFile] = File(...)
+    files: List[UploadFile] = File(...),
+    vendor: Optional[str] = Form(None),
 ):
     if len(files) > MAX_FILES_ALLOWED:
         raise HTTPException(status_code=400, detail=f"Too many files. Max {MAX_FILES_ALLOWED}.")
@@ -207,35 +183,130 @@ async def extract_invoices(
 
     if os.path.exists(session_upload_dir): shutil.rmtree(session_upload_dir)
     if os.path.exists(session_output_dir): shutil.rmtree(session_output_dir)
+    for report in result_store.reports_for_session(user_id, session_id):
+        result_store.drop_report(report)
     os.makedirs(session_upload_dir, exist_ok=True)
     os.makedirs(session_output_dir, exist_ok=True)
 
+    # Files of a named vendor go into its folder, which selects its INPUT_MODES override.
+    folder = vendor_folder(vendor)
+    file_dir = os.path.join(session_upload_dir, folder) if folder else session_upload_dir
+    os.makedirs(file_dir, exist_ok=True)
+
     saved_paths = []
     for file in files:
-        file_path = os.path.join(session_upload_dir, file.filename)
+        file_path = os.path.join(file_dir, file.filename)
         with open(file_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
         saved_paths.append(file_path)
 
-    background_tasks.add_task(background_extraction_task, user_id, session_id, saved_paths)
+    if EXTRACTION_QUEUE == "durable":
+        # worker.py picks the files up; the job survives API and worker restarts.
+        session_key = f"{user_id}_{session_id}"
+        await asyncio.to_thread(session_store.create, session_key, initial_session_status(saved_paths))
+        job_queue.enqueue(session_key, user_id, session_id, [os.path.abspath(p) for p in saved_paths],
+                          os.path.abspath(new_report_path(user_id, session_id)))
+        message = "Queued for the extraction workers (Durable Mode)."
+    else:
+        background_tasks.add_task(background_extraction_task, user_id, session_id, saved_paths)
+        message = "Processing started in background (Async Mode)."
 
     return {
         "status": "started",
-        "message": "Processing started in background (Async Mode).",
+        "message": message,
         "session_id": session_id,
         "check_status_url": f"http://127.0.0.1:8000/status/{user_id}/{session_id}"
     }
 
 @app.get("/status/{user_id}/{session_id}")
-def check_status(user_id: str, session_id: str):
+async def check_status(user_id: str, session_id: str, since: Optional[int] = None, timeout: float = 25):
+    """
+    Full status dict. With `since` (the "version" of the last response) this is a
+    long-poll: it answers as soon as the version moves, or 204 after `timeout` seconds.
+    """
     session_key = f"{user_id}_{session_id}"
-    status_data = SESSION_STATUS.get(session_key)
-    
+    if since is None:
+        status_data = await asyncio.to_thread(session_store.get, session_key)
+    else:
+        timeout = max(0.0, min(timeout, LONG_POLL_MAX_SECONDS))
+        status_data = await session_store.wait_for_change(session_key, since, timeout)
+
     if not status_data:
         raise HTTPException(status_code=404, detail="Session not found or expired.")
+    if since is not None and status_data.get("version") == since:
+        return Response(status_code=204)
+
+    # The live queue snapshot is only known to the worker process running the session.
+    if status_data.get("status") == "processing" and status_data.get("worker_pid") == os.getpid():
+        status_data = {**status_data, "queue": fair_scheduler.snapshot(session_key)}
     
     return status_data
 
+def _sse(event, data, version):
+    return f"id: {version}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def _status_events(previous, state):
+    """
+    Turns two successive status dicts into the SSE events between them.
+    The first event of a stream is a full "snapshot".
+    """
+    version = state.get("version")
+    if not previous:
+        yield _sse("snapshot", state, version)
+    else:
+        for filename, file_status in state["files"].items():
+            if previous["files"].get(filename) != file_status:
+                yield _sse("file", {
+                    "file": filename,
+                    "status": file_status,
+                    "completed_count": state["completed_count"],
+                    "total_count": state["total_count"],
+                    "cache": state["cache"],
+                }, version)
+        if state.get("cost") != previous.get("cost"):
+            yield _sse("cost", state.get("cost"), version)
+        if state.get("queue") != previous.get("queue"):
+            yield _sse("queue", state.get("queue"), version)
+
+    if state["status"] != previous.get("status") and state["status"] in FINAL_STATUSES:
+        yield _sse(state["status"], {
+            "download_url": state.get("download_url"),
+            "cost_analysis": state.get("cost_analysis"),
+            "error": state.get("error"),
+        }, version)
+
+@app.get("/events/{user_id}/{session_id}")
+async def session_events(user_id: str, session_id: str):
+    """
+    Server-sent events for one session: a "snapshot", then "file", "cost" and
+    "queue" events as they happen, and a final "completed" or "failed".
+    """
+    session_key = f"{user_id}_{session_id}"
+    if await asyncio.to_thread(session_store.get, session_key) is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired.")
+
+    async def stream():
+        previous, version = {}, None
+        while True:
+            state = await session_store.wait_for_change(session_key, version, SSE_KEEPALIVE_SECONDS)
+            if state is None:
+                yield _sse("expired", {}, version)
+                return
+            if state.get("version") == version:
+                yield ": keep-alive\n\n"
+                continue
+            for event in _status_events(previous, state):
+                yield event
+            if state["status"] in FINAL_STATUSES:
+                return
+            previous, version = state, state.get("version")
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.get("/download/{user_id}/{session_id}/{filename}")
 def download_excel(user_id: str, session_id: str, filename: str):
     base_path = os.path.join(BASE_OUTPUT_DIR, user_id, session_id)
@@ -246,14 +317,102 @@ def download_excel(user_id: str, session_id: str, filename: str):
             file_path += ".xlsx"
             filename += ".xlsx"
 
+    # Re-materializes the workbook from the result store if it is stale or missing.
+    export_report(file_path)
+
     if os.path.exists(file_path) and os.path.isfile(file_path):
         return FileResponse(
             path=file_path,
             filename=filename,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            media_type=EXPORT_MEDIA_TYPES["xlsx"]
         )
     raise HTTPException(status_code=404, detail="Report not found.")
 
+@app.get("/export/{user_id}/{session_id}")
+def export_session_report(user_id: str, session_id: str, format: str = "xlsx"):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format. Use one of {list(EXPORT_FORMATS)}.")
+
+    reports = result_store.reports_for_session(user_id, session_id)
+    if not reports:
+        raise HTTPException(status_code=404, detail="No results stored for this session.")
+
+    out_path = export_report(reports[0], fmt=format)
+    if not out_path:
+        raise HTTPException(status_code=500, detail="Report could not be generated.")
+    return FileResponse(path=out_path, filename=os.path.basename(out_path), media_type=EXPORT_MEDIA_TYPES[format])
+
+@app.get("/partial/{user_id}/{session_id}")
+def partial_session_report(user_id: str, session_id: str, format: str = "xlsx"):
+    """
+    The session's report covering the files finished so far, while the rest is still running.
+    X-Files-Completed / X-Files-Total tell how much of the session it covers.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format. Use one of {list(EXPORT_FORMATS)}.")
+
+    session_key = f"{user_id}_{session_id}"
+    status_data = session_store.get(session_key) or {}
+    reports = result_store.reports_for_session(user_id, session_id)
+    if not reports:
+        raise HTTPException(status_code=404, detail="No finished files stored for this session yet.")
+
+    # Re-exported only when a file finished since the last request.
+    out_path = export_report(reports[0], fmt=format)
+    if not out_path:
+        raise HTTPException(status_code=500, detail="Report could not be generated.")
+
+    filename = os.path.basename(out_path)
+    if status_data.get("status") == "processing":
+        stem, ext = os.path.splitext(filename)
+        filename = f"{stem}_partial{ext}"
+    headers = {
+        "X-Files-Completed": str(status_data.get("completed_count", "")),
+        "X-Files-Total": str(status_data.get("total_count", "")),
+    }
+    return FileResponse(path=out_path, filename=filename, media_type=EXPORT_MEDIA_TYPES[format], headers=headers)
+
+@app.get("/costs")
+def cost_rollup(month: Optional[str] = None, user_id: Optional[str] = None):
+    """
+    Cost per month, user and model from the usage ledger (month as YYYY-MM).
+    """
+    rows = usage_ledger.monthly(month, user_id)
+    return {
+        "total_cost": sum(row["total_cost"] for row in rows),
+        "rows": rows
+    }
+
+@app.get("/gemini")
+def gemini_health():
+    """
+    Per-key scheduler state, error counts by class and what hedged requests cost in this process.
+    """
+    return {"keys": key_scheduler.snapshot(), "retries": retry_policy.snapshot()}
+
+@app.get("/results")
+def search_results(
+    vendor: Optional[str] = None,
+    invoice_no: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    user_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+    limit: int = 100,
+    offset: int = 0
+):
+    """
+    Looks up stored rows by vendor, invoice number, invoice date range (YYYY-MM-DD) or session.
+    """
+    limit = max(1, min(limit, 1000))
+    rows = result_store.query(vendor, invoice_no, date_from, date_to, user_id, session_id, limit, max(offset, 0))
+    return {"count": len(rows), "limit": limit, "offset": offset, "results": rows}
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True, workers=1)
\ No newline at end of file
+    if API_WORKERS > 1 and SESSION_STORE == "memory":
+        print("⚠️ API_WORKERS > 1 with SESSION_STORE=memory: /status only sees sessions of the worker it hits. Use SESSION_STORE=sqlite.")
+    if API_WORKERS > 1 and EXTRACTION_QUEUE != "durable":
+        # Every API worker extracts, so each one enforces its share of the Gemini budgets.
+        os.environ["GEMINI_PROCESS_SHARE"] = str(GEMINI_PROCESS_SHARE * API_WORKERS)
+    uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=API_WORKERS == 1, workers=API_WORKERS)
\ No newline at end of file
@@ -0,0 +1,244 @@
+"""
+Micro-benchmark: flatten_invoices against the previous per-invoice, per-row flattener.
+
+Run from the ai/ directory:
+    python -m benchmarks.flatten_invoices_bench
+"""
+import random
+import timeit
+from datetime import datetime
+
+import pandas as pd
+
+from core.excel_writer import (
+    flatten_invoices, process_tags, get_clean_float, safe_divide,
+    PRORATION_KEYS, DELIVERY_LOCATION_PATTERN,
+)
+
+
+def legacy_flatten_invoice_data(data):
+    """
+    flatten_invoice_data as it was before flatten_invoices: enrichment runs
+    row by row, after every serial number has been exploded into its own row.
+    """
+    item_keys = ['Line Items', 'items', 'line_items']
+    target_key = next((k for k in item_keys if k in data and isinstance(data[k], list)), None)
+    items_list = data.get(target_key, [])
+    
+    global_tags = []
+    possible_tag_keys = ['Asset Serial Number', 'Tag Nos', 'Serial No', 'Sr No']
+    
+    for pk in possible_tag_keys:
+        if pk in data and data[pk]:
+            global_tags = process_tags(data[pk])
+            break 
+
+    flattened_rows = []
+
+    if not items_list:
+        items_list = [data] 
+
+    for i, item in enumerate(items_list):
+        row_base = data.copy()
+        if target_key in row_base: del row_base[target_key]
+        
+        if isinstance(item, dict):
+            row_base.update(item)
+            
+        item_tags = []
+        
+        for pk in possible_tag_keys:
+            if pk in item and item[pk]:
+                item_tags.extend(process_tags(item[pk]))
+        
+        desc = item.get('Asset Description') or item.get('Description') or ''
+        
+        if str(desc).strip().startswith('['):
+             item_tags.extend(process_tags(str(desc)))
+
+        item_tags = list(dict.fromkeys(item_tags))
+
+        if not item_tags and global_tags and i == 0:
+            item_tags = global_tags
+        if item_tags:
+            divisor = len(item_tags)
+            q_val = item.get('Quantity') or item.get('Qty')
+            extracted_qty = get_clean_float(q_val)
+            if extracted_qty > 0:
+                divisor = extracted_qty
+            
+            for tag in item_tags:
+                new_row = row_base.copy()
+                new_row['Asset Serial Number'] = tag
+                
+                for key, val in new_row.items():
+                    if key.lower() in PRORATION_KEYS:
+                        new_row[key] = safe_divide(val, divisor)
+                
+                if 'Net Amount' in new_row: new_row['Unit Price'] = new_row['Net Amount']
+                elif 'Total Base Price' in new_row: new_row['Unit Price'] = new_row['Total Base Price']
+                
+                new_row['Quantity'] = 1
+                new_row['Qty'] = 1
+                flattened_rows.append(new_row)
+        else:
+            new_row = row_base.copy()
+            if 'Qty' not in new_row:
+                new_row['Qty'] = new_row.get('Quantity', 1)
+            flattened_rows.append(new_row)
+
+    # 4. Final Metadata
+    current_date_str = datetime.now().strftime("%Y-%m-%d")
+
+    for row in flattened_rows:
+        row['Date of Entry'] = current_date_str
+        row['Data Entry Done By'] = "Auto"
+        
+        uom_val = row.get('UOM')
+        if not uom_val or str(uom_val).strip() == "":
+            row['UOM'] = "NUMBER"
+
+        currency_val = row.get('Currency Code')
+        currency_str = str(currency_val).strip().upper() if currency_val is not None else ""
+        
+        if not currency_str or 'INR' in currency_str or currency_str == 'NONE':
+            row['Total Bill Amount in INR'] = 1
+            row['Total Bill Amount in Foreign Currency'] = 0
+        else:
+            row['Total Bill Amount in INR'] = 0
+            row['Total Bill Amount in Foreign Currency'] = 1
+            
+        hsn_sac_val = str(row.get('HSN/SAC') or row.get('HSN Code') or row.get('SAC Code') or row.get('Code') or '').strip()
+        base_amt = row.get('Total Base Price') or row.get('Net Amount') or row.get('Unit Price') or ""
+        
+        if hsn_sac_val:
+            if hsn_sac_val.startswith("99"):
+                row['HSN/SAC'] = "SAC"
+                row['Code'] = hsn_sac_val
+                row['Base Inv Amt (Excl Tax) - Labour'] = base_amt
+                row['Base Inv Amt (Excl Tax) - Material'] = ""
+            else:
+                row['HSN/SAC'] = "HSN"
+                row['Code'] = hsn_sac_val
+                row['Base Inv Amt (Excl Tax) - Material'] = base_amt
+                row['Base Inv Amt (Excl Tax) - Labour'] = ""
+        else:
+            row['HSN/SAC'] = ""
+            row['Code'] = ""
+        
+        po_num = str(row.get('PO Number', '')).strip()
+        if po_num and not row.get('Client Code'):
+            parts = po_num.split('/')
+            if len(parts) > 1:
+                row['Client Code'] = parts[0].strip()
+
+        address = str(row.get('Deliver Address', '')).strip()
+        current_loc = str(row.get('Delivery Location', '')).strip()
+        if address and not current_loc:
+            match = DELIVERY_LOCATION_PATTERN.search(address)
+            if match:
+                loc_text = match.group(1).strip()
+                loc_parts = loc_text.split(',')
+                row['Delivery Location'] = loc_parts[-1].strip()
+
+        base_price = get_clean_float(row.get('Total Base Price') or row.get('Net Amount'))
+        total_tax = get_clean_float(row.get('Total Tax') or row.get('Tax Amount'))
+        
+        igst = get_clean_float(row.get('IGST') or row.get('IGST Amount'))
+        cgst = get_clean_float(row.get('CGST') or row.get('CGST Amount'))
+        sgst = get_clean_float(row.get('SGST') or row.get('SGST Amount'))
+
+        if total_tax == 0 and (igst > 0 or cgst > 0 or sgst > 0):
+            total_tax = igst + cgst + sgst
+            row['Total Tax'] = round(total_tax, 2)
+
+        if base_price > 0:
+            grand_total = base_price + total_tax
+            row['Total Purchase Price'] = round(grand_total, 2)
+            if 'Grand Total' in row: row['Grand Total'] = round(grand_total, 2)
+            if 'Total Amount' in row: row['Total Amount'] = round(grand_total, 2)
+
+    return flattened_rows
+
+
+def make_invoices(count, seed=11):
+    """
+    Invoices shaped like extraction output: a few line items each, some with
+    serial numbers (listed or in the description), HSN or SAC codes, and
+    foreign currency, PO numbers and addresses on a share of them.
+    """
+    rng = random.Random(seed)
+    alphabet = "ABCDEFGHJKLMNPQRSTUVWXYZ0123456789"
+    invoices = []
+    for n in range(count):
+        items = []
+        for _ in range(rng.randint(1, 6)):
+            qty = rng.choice([1, 2, 3, 5, "4", None])
+            serials = ["".join(rng.choice(alphabet) for _ in range(10)) for _ in range(rng.randint(0, 4))]
+            item = {
+                "Description": str(serials) if serials and rng.random() < 0.3 else "Laptop 14in",
+                "Quantity": qty,
+                "Net Amount": round(rng.uniform(100, 90000), 2),
+                "Tax Amount": rng.choice([0, round(rng.uniform(10, 9000), 2)]),
+                "IGST": rng.choice([0, 180.0, "1,250.50"]),
+                "HSN Code": rng.choice(["8471", "998314", "", None]),
+            }
+            if serials and rng.random() < 0.7:
+                item["Serial No"] = serials
+            items.append(item)
+        invoice = {
+            "Invoice Number": f"INV-{n:05d}",
+            "Vendor Name": rng.choice(["Acme", "Globex", "Initech"]),
+            "Currency Code": rng.choice(["INR", "USD", None, "EUR"]),
+            "PO Number": rng.choice(["C123/PO/88", "", "PO88"]),
+            "Deliver Address": rng.choice(["12 Park St, Kolkata - 700016", "", "Pune 411001"]),
+            "Line Items": items if rng.random() < 0.9 else [],
+        }
+        if rng.random() < 0.2:
+            invoice["Tag Nos"] = "".join(rng.choice(alphabet) for _ in range(12))
+        invoices.append(invoice)
+    return invoices
+
+
+def make_serial_invoice(serials=2000, seed=5):
+    """
+    One invoice whose single line item lists `serials` serial numbers.
+    """
+    rng = random.Random(seed)
+    alphabet = "ABCDEFGHJKLMNPQRSTUVWXYZ0123456789"
+    tags = ["".join(rng.choice(alphabet) for _ in range(12)) for _ in range(serials)]
+    return [{
+        "Invoice Number": "INV-BULK", "Vendor Name": "Acme", "Currency Code": "INR",
+        "PO Number": "C123/PO/88", "Deliver Address": "12 Park St, Kolkata - 700016",
+        "Line Items": [{
+            "Description": "Laptop 14in", "Serial No": tags, "Quantity": serials,
+            "Net Amount": 95000000.0, "Tax Amount": 17100000.0, "IGST": 17100000.0, "HSN Code": "8471",
+        }],
+    }]
+
+
+def legacy_flatten_invoices(invoices):
+    rows = []
+    for invoice in invoices:
+        rows.extend(legacy_flatten_invoice_data(invoice))
+    return pd.DataFrame(rows)
+
+
+def best_of(fn, runs):
+    return min(timeit.repeat(fn, number=runs, repeat=3)) / runs
+
+
+def main():
+    cases = [(f"{size} invoice(s)", make_invoices(size)) for size in (1, 3, 10, 100, 1000, 5000)]
+    cases += [(f"{serials} serials", make_serial_invoice(serials)) for serials in (20, 200, 2000)]
+    for label, invoices in cases:
+        pd.testing.assert_frame_equal(flatten_invoices(invoices), legacy_flatten_invoices(invoices))
+
+        runs = max(1, 300 // len(invoices))
+        legacy = best_of(lambda: legacy_flatten_invoices(invoices), runs)
+        current = best_of(lambda: flatten_invoices(invoices), runs)
+        print(f"{label:>16} | legacy {legacy * 1e3:8.2f} ms | flatten_invoices {current * 1e3:8.2f} ms "
+              f"| speedup x{legacy / current:.1f}")
+
+if __name__ == "__main__":
+    main()
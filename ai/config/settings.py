@@ -1,4 +1,5 @@
 import os
+import json
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,17 +13,118 @@ if not GEMINI_API_KEYS:
     print("⚠️  WARNING: No GEMINI_API_KEYS found in .env file!")
 
 GEMINI_ENGINE = os.getenv("Gemini_Engine")
-TIMEOUT_SECONDS = os.getenv("TIMEOUT_SECONDS")
+TIMEOUT_SECONDS = float(os.getenv("TIMEOUT_SECONDS")) if os.getenv("TIMEOUT_SECONDS") else None
+
+# Provider-side caching of the static extraction prompt.
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# Longest a cache create/refresh may take before the request sends the prompt inline instead.
+CONTEXT_CACHE_TIMEOUT_SECONDS = float(os.getenv("CONTEXT_CACHE_TIMEOUT_SECONDS", "20"))
+
+# Number of processes calling Gemini with the same keys. Every process enforces its share of
+# the budgets below; worker.py and the multi-worker API set it for the processes they start.
+# Set it by hand when several hosts (or the API and workers) share keys.
+GEMINI_PROCESS_SHARE = max(1, int(os.getenv("GEMINI_PROCESS_SHARE", "1")))
+
+
+def _process_share(total):
+    return max(1, total // GEMINI_PROCESS_SHARE)
+
+
+# Per-key rate limits and the adaptive (AIMD) bounds on concurrent Gemini calls, for all processes.
+GEMINI_RPM_PER_KEY = _process_share(int(os.getenv("GEMINI_RPM_PER_KEY", "60")))
+GEMINI_TPM_PER_KEY = _process_share(int(os.getenv("GEMINI_TPM_PER_KEY", "1000000")))
+GEMINI_MIN_CONCURRENCY = int(os.getenv("GEMINI_MIN_CONCURRENCY", "1"))
+GEMINI_INITIAL_CONCURRENCY = _process_share(int(os.getenv("GEMINI_INITIAL_CONCURRENCY", "3")))
+_max_concurrency = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+GEMINI_MAX_CONCURRENCY = _process_share(_max_concurrency)
+
+# Cross-session cap on Gemini calls, and optional per-user fair-share weights
+# as JSON, e.g. {"user_a": 2, "user_b": 1}.
+GLOBAL_MAX_CONCURRENT_CALLS = _process_share(int(os.getenv("GLOBAL_MAX_CONCURRENT_CALLS", str(_max_concurrency))))
+USER_SHARE_WEIGHTS = json.loads(os.getenv("USER_SHARE_WEIGHTS", "{}"))
 
 DATA_DIR = os.path.join(BASE_DIR, "data") 
 
 OUTPUT_DIR = os.path.join(BASE_DIR, "output")
 REGISTRY_DIR = os.path.join(BASE_DIR, "registry")
 LOG_DIR = os.path.join(BASE_DIR, "logs")
+CACHE_DIR = os.path.join(BASE_DIR, "cache")
 
 SCHEMA_FILE = os.path.join(REGISTRY_DIR, "vendor_schemas.json")
 EXCEL_FILE = os.path.join(OUTPUT_DIR, "Consolidated_Report.xlsx")
+# "openpyxl" edits the workbook in place through pandas; "streaming" rewrites it with a
+# write-only workbook in constant memory, which stays fast for very large reports.
+EXCEL_WRITE_ENGINE = os.getenv("EXCEL_WRITE_ENGINE", "openpyxl").lower()
+# Durable store of every extracted row; reports are materialized from it on demand.
+RESULT_STORE_FILE = os.path.join(OUTPUT_DIR, "results.sqlite3")
+# Every priced model call, kept across runs for monthly and per-user cost queries.
+USAGE_LEDGER_FILE = os.path.join(OUTPUT_DIR, "usage_ledger.sqlite3")
 LOG_FILE = os.path.join(LOG_DIR, "app.log")
 
-for path in [DATA_DIR, OUTPUT_DIR, REGISTRY_DIR, LOG_DIR]:
+# "background" runs extractions inside the API process; "durable" queues them per file in
+# SQLite for the worker.py process pool, which resumes unfinished files after a restart.
+EXTRACTION_QUEUE = os.getenv("EXTRACTION_QUEUE", "background").lower()
+JOB_QUEUE_FILE = os.path.join(OUTPUT_DIR, "jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_FILES_PER_WORKER = int(os.getenv("JOB_FILES_PER_WORKER", "4"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# API session status: "memory" for a single worker, "sqlite" to share it across API_WORKERS
+# processes (and with worker.py, so it is the default for the durable queue).
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite" if EXTRACTION_QUEUE == "durable" else "memory").lower()
+SESSION_STORE_FILE = os.path.join(CACHE_DIR, "sessions.sqlite3")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "1000"))
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+
+# Model prices are re-checked in the background once per TTL; offline mode only uses the bundled snapshot.
+PRICE_CACHE_FILE = os.path.join(CACHE_DIR, "model_prices.json")
+PRICE_REFRESH_TTL_SECONDS = int(os.getenv("PRICE_REFRESH_TTL_SECONDS", "86400"))
+PRICES_OFFLINE = os.getenv("PRICES_OFFLINE", "false").lower() == "true"
+
+EXTRACTION_CACHE_FILE = os.path.join(CACHE_DIR, "extraction_cache.sqlite3")
+EXTRACTION_CACHE_MAX_MB = float(os.getenv("EXTRACTION_CACHE_MAX_MB", "256"))
+
+RASTER_WORKERS = int(os.getenv("RASTER_WORKERS", os.cpu_count() or 1))
+RASTER_MODE = os.getenv("RASTER_MODE", "stream").lower()  # "stream" or "full"
+RASTER_DPI = int(os.getenv("RASTER_DPI", "200"))
+RASTER_GRAYSCALE = os.getenv("RASTER_GRAYSCALE", "false").lower() == "true"
+RASTER_MAX_DIMENSION = int(os.getenv("RASTER_MAX_DIMENSION", "2400"))
+RASTER_FORMAT = os.getenv("RASTER_FORMAT", "png").lower()  # "png" (lossless), "jpeg" or "webp"
+# Decoded page bitmaps across all rasterization workers; the pool gets fewer than RASTER_WORKERS
+# processes when one page per worker would not fit.
+RASTER_MEMORY_BUDGET_MB = int(os.getenv("RASTER_MEMORY_BUDGET_MB", "512"))
+
+# "auto" sends the native text layer for digitally generated pages and images for scanned ones,
+# "image" always rasterizes, "pdf" sends the raw PDF bytes as a single part.
+# Per-vendor overrides live under "INPUT_MODES" in the schema registry.
+EXTRACTION_INPUT_MODE = os.getenv("EXTRACTION_INPUT_MODE", "auto").lower()
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "200"))
+
+# Documents longer than PAGE_WINDOW_MIN_PAGES pages are split into windows of at most
+# PAGE_WINDOW_SIZE pages (cut at detected invoice boundaries), extracted concurrently and
+# merged by invoice number. Every window is admitted like a separate request, so the
+# fair scheduler and the AIMD limit bound them. PAGE_WINDOW_SIZE=0 sends every document as one request.
+PAGE_WINDOW_SIZE = int(os.getenv("PAGE_WINDOW_SIZE", "8"))
+PAGE_WINDOW_MIN_PAGES = int(os.getenv("PAGE_WINDOW_MIN_PAGES", "12"))
+
+# Retries of calls whose output was unusable, and hedging: a call still running after the p95
+# latency per request token of recent calls times its own size (at least HEDGE_MIN_DELAY_SECONDS,
+# once HEDGE_MIN_SAMPLES calls were timed) is duplicated on another key and the first answer wins.
+# Off by default: a hedged call pays its input tokens twice.
+BAD_OUTPUT_RETRIES = int(os.getenv("BAD_OUTPUT_RETRIES", "2"))
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "10"))
+
+# Follow-up requests for the rest of a response that hit the output token limit.
+MAX_CONTINUATIONS = int(os.getenv("MAX_CONTINUATIONS", "3"))
+
+# "json" asks for free-form JSON with full column names, "schema" constrains the response
+# with a response_schema built from MASTER_SCHEMA that uses short wire keys.
+EXTRACTION_OUTPUT_MODE = os.getenv("EXTRACTION_OUTPUT_MODE", "json").lower()
+
+for path in [DATA_DIR, OUTPUT_DIR, REGISTRY_DIR, LOG_DIR, CACHE_DIR]:
     os.makedirs(path, exist_ok=True)
\ No newline at end of file
@@ -1,10 +1,25 @@
 import asyncio
+import contextlib
+import email.utils
+import hashlib
 import json
+import random
 import re
-from google import genai
-from google.genai import types
-
-from config.settings import GEMINI_API_KEYS, GEMINI_ENGINE, TIMEOUT_SECONDS
+import time
+from collections import Counter, deque
+from google.genai import types, errors as genai_errors
+
+from config.settings import (
+    GEMINI_API_KEYS, GEMINI_ENGINE, TIMEOUT_SECONDS, EXTRACTION_OUTPUT_MODE,
+    MAX_CONTINUATIONS, BAD_OUTPUT_RETRIES, HEDGE_ENABLED, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY_SECONDS,
+)
+from core.pdf_utils import RasterPage, TextPage, PdfDocument, PageStream, count_pages
+from core.gemini_clients import gemini_clients
+from core.key_scheduler import key_scheduler, classify_key_error, estimate_request_tokens, NoAvailableKeyError
+from core.context_cache import prompt_cache
+from core.structured_output import build_wire_schema, expand_wire_output, WIRE_KEYS_NOTE
+from core.page_windows import plan_page_windows, window_note, merge_window_results, merge_usage_stats, ROW_NUMBER_KEY
+from core.partial_json import loads_partial
 
 
 def normalize_vendor_name(name):
@@ -13,26 +28,73 @@ def normalize_vendor_name(name):
     return name.strip().title()
 
 
-async def _generate_content_internal(client, images, prompt):
+def _to_content_part(page):
+    """
+    TextPages become text parts, encoded RasterPages become inline image parts,
+    and PIL Images are passed through for the SDK.
+    """
+    if isinstance(page, TextPage):
+        return types.Part.from_text(text=(
+            f"--- PAGE {page.page_number} (native PDF text layer; layout preserved, "
+            f"table columns are aligned with spaces and rows are separate lines) ---\n{page.text}"
+        ))
+    if isinstance(page, RasterPage):
+        return types.Part.from_bytes(data=page.data, mime_type=page.mime_type)
+    if isinstance(page, PdfDocument):
+        return types.Part.from_bytes(data=page.data, mime_type="application/pdf")
+    return page
+
+
+def _build_content_parts(pages):
+    """
+    Consumes the pages once, in order, into request parts.
+    Also records which path the pages took, so text-layer token savings can be measured.
+    """
+    parts = []
+    text_pages = 0
+    pdf_documents = 0
+    for page in pages:
+        if isinstance(page, TextPage):
+            text_pages += 1
+        elif isinstance(page, PdfDocument):
+            pdf_documents += 1
+        parts.append(_to_content_part(page))
+
+    image_pages = len(parts) - text_pages - pdf_documents
+    if pdf_documents:
+        input_mode = "pdf"
+    elif text_pages and image_pages:
+        input_mode = "mixed"
+    elif text_pages:
+        input_mode = "text"
+    else:
+        input_mode = "image"
+    return parts, {"input_mode": input_mode, "text_pages": text_pages, "image_pages": image_pages}
+
+
+async def _generate_content_internal(client, images, prompt, cached_content=None, response_schema=None):
     """
     Async wrapper for the Gemini API call.
+    With `cached_content`, the prompt is already held by the provider and only the pages are sent.
+    With `response_schema`, the output is constrained to the compact wire-key schema.
     """
+    if cached_content:
+        contents = [*images]
+    else:
+        contents = [*images, prompt]
     response = await client.aio.models.generate_content(
         model=GEMINI_ENGINE,
-        contents=[*images, prompt],
+        contents=contents,
         config=types.GenerateContentConfig(
-            response_mime_type="application/json"
+            response_mime_type="application/json",
+            response_schema=response_schema,
+            cached_content=cached_content
         ),
     )
     return response
 
 
-async def extract_invoice_with_rotation(images, master_schema_columns):
-    """
-    Orchestrates the extraction process Asynchronously.
-    """
-    
-    base_prompt = """
+BASE_PROMPT = """
 You are an expert invoice data extraction agent. Your PRIMARY MISSION is to extract EVERY SINGLE ROW from invoice tables.
 
 - "Asset Description":
@@ -138,7 +200,9 @@ You MUST create 5 objects in "Line Items" array - ONE FOR EACH ROW.
 - Product codes: FOR EXAMPLE CON-SNT-CSBA4LUK, CS-BAR-C-UK9,....
 """
 
-    schema_context = f"""
+
+def _build_schema_context(master_schema_columns):
+    return f"""
 Return a JSON list using these exact keys:
 {json.dumps(master_schema_columns)}
 
@@ -231,56 +295,525 @@ Return a JSON list using these exact keys:
 **IF YOUR "LINE ITEMS" ARRAY HAS FEWER OBJECTS THAN TABLE ROWS, YOU FAILED THE TASK.**
 """
 
-    full_prompt = base_prompt + schema_context
-    
-    MAX_RETRIES = 5
-    BASE_WAIT_TIME = 2
 
-    for api_key in GEMINI_API_KEYS:
-        attempt = 0
-        while attempt < MAX_RETRIES:
+def build_extraction_prompt(master_schema_columns):
+    """
+    Assembles the full extraction prompt for the given MASTER_SCHEMA columns.
+    """
+    return BASE_PROMPT + _build_schema_context(master_schema_columns)
+
+
+# Changes whenever the prompt wording changes, so cached extractions made
+# with an older prompt are never served.
+# The wire-key note is part of the prompt in schema mode, so the output mode is covered too.
+PROMPT_VERSION = hashlib.sha256(
+    (build_extraction_prompt([]) + (WIRE_KEYS_NOTE if EXTRACTION_OUTPUT_MODE == "schema" else "")).encode("utf-8")
+).hexdigest()[:16]
+
+
+async def extract_invoice_with_rotation(images, master_schema_columns, call_slot=None):
+    """
+    Orchestrates the extraction process Asynchronously.
+    `images` is a PageStream (pages rasterized while they are consumed) or any
+    iterable of pages. Windows are planned from the page plan up front (see
+    core.page_windows), and each window's request starts as soon as its pages
+    are ready, while the pages after it are still being rasterized; the pages
+    become request parts that every retry of that window reuses.
+    `call_slot(page_count)` gives the async context manager that admits one
+    request (a fair scheduler slot, the AIMD limiter); every window takes its own.
+    Returns (invoices, usage_stats); invoices is None on failure, while the
+    usage of the calls that were made is still returned for billing.
+    """
+    if call_slot is None:
+        call_slot = lambda page_count: contextlib.nullcontext()
+    full_prompt = build_extraction_prompt(master_schema_columns)
+    wire_schema = None
+    if EXTRACTION_OUTPUT_MODE == "schema":
+        wire_schema = build_wire_schema(master_schema_columns)
+        full_prompt += WIRE_KEYS_NOTE
+    start_time = time.monotonic()
+    stream = images if isinstance(images, PageStream) else PageStream(None, list(images))
+    plan = stream.plan
+    windows = plan_page_windows(plan)
+    pages = aiter(stream)
+
+    async def next_pages(count):
+        return [await anext(pages) for _ in range(count)]
+
+    if len(windows) == 1:
+        try:
+            parts, input_stats = _build_content_parts(await next_pages(len(plan)))
+        finally:
+            await pages.aclose()
+        async with call_slot(count_pages(plan)):
+            return await _extract_parts(parts, input_stats, full_prompt, wire_schema, start_time)
+
+    print(f"   > 📑 Splitting {len(plan)} pages into {len(windows)} windows: {windows}")
+
+    async def extract_window(start, end, parts, input_stats):
+        # Row numbers are asked for to deduplicate; a response_schema could not carry them.
+        note = window_note(start, end, len(plan), with_row_numbers=wire_schema is None)
+        async with call_slot(count_pages(plan[start:end])):
+            return await _extract_parts(
+                [types.Part.from_text(text=note), *parts], input_stats, full_prompt, wire_schema, time.monotonic()
+            )
+
+    tasks = []
+    try:
+        for start, end in windows:
+            parts, input_stats = _build_content_parts(await next_pages(end - start))
+            tasks.append(asyncio.create_task(extract_window(start, end, parts, input_stats)))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        await pages.aclose()
+
+    results = await asyncio.gather(*tasks)
+    window_stats = [stats for _, stats in results if stats]
+    usage_stats = merge_usage_stats(window_stats, round(time.monotonic() - start_time, 2)) if window_stats else None
+    # A window that failed all its retries would silently drop rows; fail the document instead.
+    if any(data is None for data, _ in results):
+        return None, usage_stats
+    return merge_window_results([data for data, _ in results]), usage_stats
+
+
+def _is_truncated(response):
+    candidates = response.candidates or []
+    return bool(candidates) and candidates[0].finish_reason == types.FinishReason.MAX_TOKENS
+
+
+def _parse_response(response, wire_schema, usage_stats):
+    """
+    Parses the response into invoices. Returns (invoices, truncated); a
+    truncated response yields the invoices and line items completed before the cut.
+    """
+    json_text = response.text.strip()
+
+    json_text = re.sub(r"^```[a-zA-Z]*\n", "", json_text)
+    json_text = re.sub(r"\n```$", "", json_text)
+    json_text = json_text.strip("`")
+
+    if _is_truncated(response):
+        data, truncated = loads_partial(json_text)
+    else:
+        data, truncated = json.loads(json_text), False
+    if data is None:
+        raise BadModelOutput("Response was cut off before the first complete invoice")
+
+    if wire_schema:
+        data, saved = expand_wire_output(data, wire_schema)
+        usage_stats["output_tokens_saved_est"] = usage_stats.get("output_tokens_saved_est", 0) + saved
+    elif isinstance(data, dict):
+        data = [data]
+
+    for invoice in data:
+        raw_name = invoice.get(
+            "Vendor Name",
+            invoice.get("vendor_name", "Unknown_Vendor"),
+        )
+
+        normalized_name = normalize_vendor_name(raw_name)
+        invoice["Vendor Name"] = normalized_name
+        invoice.pop("vendor_name", None)
+    return data, truncated
+
+
+def continuation_note(invoices, with_row_numbers):
+    """
+    Asks for the rest of an answer that hit the output limit, listing where it stopped.
+    """
+    lines = []
+    for invoice in invoices:
+        items = next((invoice[key] for key in ("Line Items", "items", "line_items")
+                      if isinstance(invoice.get(key), list)), [])
+        last = str(items[-1].get("Asset Description", ""))[:120] if items else ""
+        lines.append(f'- Invoice No "{invoice.get("Invoice No", "")}": {len(items)} line items, '
+                     f'the last one being "{last}"')
+    note = (
+        "--- CONTINUATION: your previous answer was cut off by the output length limit. It already "
+        "contains these invoices and line items:\n" + "\n".join(lines) + "\n"
+        "Return, in the same JSON format, ONLY what comes after that: the remaining line items of the "
+        "last invoice (repeat its Invoice No and header fields) and any invoices not listed yet. "
+        "Do not repeat line items already returned. ---"
+    )
+    if with_row_numbers:
+        note += f' Add "{ROW_NUMBER_KEY}" to every line item with the row number printed in the table.'
+    return note
+
+
+class BadModelOutput(ValueError):
+    """
+    The call itself succeeded, but its output could not be used (malformed or cut-off JSON).
+    """
+
+
+def retry_after_seconds(error):
+    """
+    Server-requested wait before retrying: the Retry-After header, or the
+    RetryInfo retryDelay ("17s") in the error details. None if not given.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
             try:
-                client = genai.Client(api_key=api_key,vertexai=False)
-                response = await asyncio.wait_for(
-                    _generate_content_internal(client, images, full_prompt),
-                    timeout=TIMEOUT_SECONDS
-                )
-
-                usage_stats = {"input_tokens": 0, "output_tokens": 0}
-                if response.usage_metadata:
-                    usage_stats["input_tokens"] = response.usage_metadata.prompt_token_count
-                    usage_stats["output_tokens"] = response.usage_metadata.candidates_token_count
-
-                json_text = response.text.strip()
-
-                json_text = re.sub(r"^```[a-zA-Z]*\n", "", json_text)
-                json_text = re.sub(r"\n```$", "", json_text)
-                json_text = json_text.strip("`")
-
-                data = json.loads(json_text)
-
-                if isinstance(data, dict):
-                    data = [data]
-
-                for invoice in data:
-                    raw_name = invoice.get(
-                        "Vendor Name",
-                        invoice.get("vendor_name", "Unknown_Vendor"),
-                    )
-
-                    normalized_name = normalize_vendor_name(raw_name)
-                    invoice["Vendor Name"] = normalized_name
-                    invoice.pop("vendor_name", None)
-
-                return data, usage_stats
-
-            except (asyncio.TimeoutError, json.JSONDecodeError, Exception) as e:
-                attempt += 1
-                wait_time = BASE_WAIT_TIME * (2 ** (attempt - 1))
-                print(f"   > ⚠️ Attempt {attempt}/{MAX_RETRIES} failed: {type(e).__name__}. Retrying in {wait_time}s...")
-                await asyncio.sleep(wait_time)
-                
-        print(f"   > ❌ Key failed {MAX_RETRIES} times. Moving to next API Key...")
-        continue
-        
-    return None, None
\ No newline at end of file
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in (details.get("error") or {}).get("details") or []:
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith("s"):
+                try:
+                    return max(0.0, float(delay[:-1]))
+                except ValueError:
+                    pass
+    return None
+
+
+def classify_error(error):
+    """
+    Error class of a failed call, which decides the retry:
+    "throttled" / "quota" / "auth" (key problems, see classify_key_error), "timeout",
+    "server" (5xx), "bad_output", "fatal" (the request itself is invalid) or "other".
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, (BadModelOutput, json.JSONDecodeError)):
+        return "bad_output"
+    kind = classify_key_error(error)
+    if kind != "other":
+        return kind
+    code = getattr(error, "code", None)
+    if isinstance(error, genai_errors.ServerError) or (isinstance(code, int) and code >= 500):
+        return "server"
+    if isinstance(error, genai_errors.ClientError) and code in (400, 404, 413):
+        return "fatal"
+    return "other"
+
+
+class RetryPolicy:
+    """
+    Decides how a failed Gemini call is retried, and when a slow one is hedged.
+
+      throttled       another key right away; the throttled key waits out Retry-After
+      quota / auth    another key right away (the key scheduler disabled this one)
+      timeout         another key right away, or backoff when there is only one key
+      server (5xx)    Retry-After, else jittered exponential backoff
+      bad_output      short pause, at most BAD_OUTPUT_RETRIES times; the key is not blamed
+      fatal           no retry: a 400/404/413 fails the same way every time
+      other           jittered exponential backoff
+
+    Hedging (off unless HEDGE_ENABLED): latency is sampled per estimated request
+    token, since large documents are slow without being stuck. Once HEDGE_MIN_SAMPLES
+    calls were timed, a call still running after the p95 of that rate times its own
+    size (at least HEDGE_MIN_DELAY_SECONDS) gets a duplicate on another key and the
+    first answer wins. The counters show what that costs.
+    """
+
+    BASE_WAIT_TIME = 2
+    MAX_WAIT_TIME = 32
+    BAD_OUTPUT_WAIT = 1
+
+    def __init__(self, bad_output_retries=BAD_OUTPUT_RETRIES, hedge_enabled=HEDGE_ENABLED,
+                 hedge_min_samples=HEDGE_MIN_SAMPLES, hedge_min_delay=HEDGE_MIN_DELAY_SECONDS):
+        self.bad_output_retries = bad_output_retries
+        self.hedge_enabled = hedge_enabled
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.latencies = deque(maxlen=200)
+        self.errors = Counter()
+        self.hedges = Counter()
+
+    def backoff(self, attempt):
+        return random.uniform(0.5, 1.0) * min(self.MAX_WAIT_TIME, self.BASE_WAIT_TIME * 2 ** (attempt - 1))
+
+    def next_delay(self, kind, error, attempt, kind_count, multiple_keys):
+        """
+        Seconds to wait before the next attempt, or None to give up.
+        `kind_count` is how many failures of this kind the request has had.
+        """
+        self.errors[kind] += 1
+        if kind == "fatal":
+            return None
+        if kind == "bad_output":
+            return self.BAD_OUTPUT_WAIT if kind_count <= self.bad_output_retries else None
+        if kind in ("throttled", "quota", "auth"):
+            return 0
+        if kind == "timeout" and multiple_keys:
+            return 0
+        if kind == "server":
+            retry_after = retry_after_seconds(error)
+            if retry_after is not None:
+                return min(retry_after, self.MAX_WAIT_TIME)
+        return self.backoff(attempt)
+
+    def record_latency(self, seconds, estimated_tokens):
+        self.latencies.append(seconds / max(1, estimated_tokens))
+
+    def _p95_seconds_per_token(self):
+        if len(self.latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def hedge_delay(self, estimated_tokens):
+        """
+        Seconds after which a call of `estimated_tokens` is hedged, or None
+        (disabled, a single key or too few samples).
+        """
+        if not self.hedge_enabled or len(GEMINI_API_KEYS) < 2:
+            return None
+        rate = self._p95_seconds_per_token()
+        if rate is None:
+            return None
+        return max(rate * estimated_tokens, self.hedge_min_delay)
+
+    def snapshot(self):
+        rate = self._p95_seconds_per_token()
+        return {
+            "errors": dict(self.errors),
+            "hedging": {
+                "enabled": self.hedge_enabled,
+                "p95_s_per_1k_tokens": round(rate * 1000, 3) if rate is not None else None,
+                "fired": self.hedges["fired"],
+                "won": self.hedges["won"],
+                "lost": self.hedges["lost"],
+                "skipped": self.hedges["skipped"],
+                "failed": self.hedges["failed"],
+                # Billed tokens of losing calls that answered, and estimated tokens of
+                # losing calls cancelled mid-flight (which may still be billed).
+                "loser_tokens": self.hedges["loser_tokens"],
+                "cancelled_tokens_est": self.hedges["cancelled_tokens_est"],
+            },
+        }
+
+
+retry_policy = RetryPolicy()
+
+
+async def _call_on(lease, contents, full_prompt, wire_schema):
+    client = gemini_clients.get(lease.api_key)
+
+    async def call():
+        cached_content = await prompt_cache.get_handle(client, lease.api_key, full_prompt)
+        return await _generate_content_internal(
+            client, contents, full_prompt, cached_content,
+            wire_schema["response_schema"] if wire_schema else None,
+        )
+
+    # The cache lookup is inside the timeout too; it also has its own (CONTEXT_CACHE_TIMEOUT_SECONDS).
+    return await asyncio.wait_for(call(), timeout=TIMEOUT_SECONDS)
+
+
+async def _hedged_call(lease, contents, full_prompt, wire_schema, estimated_tokens, usage_stats):
+    """
+    Runs the call on `lease`. If it is still running after the hedge delay, a
+    duplicate goes to another key and whichever answers first is kept.
+
+    Returns (response, lease that answered); the caller reports on that lease,
+    and every other lease is settled here, with the usage of a losing call that
+    answered added to `usage_stats`. If the call fails, the error of the primary
+    call is raised and the caller reports on `lease`.
+    """
+    started = time.monotonic()
+    primary = asyncio.create_task(_call_on(lease, contents, full_prompt, wire_schema))
+    try:
+        delay = retry_policy.hedge_delay(estimated_tokens)
+        if delay is not None:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done:
+                hedge_lease = await _acquire_hedge_lease(lease, estimated_tokens)
+                if hedge_lease is not None:
+                    return await _race(primary, lease, hedge_lease, contents, full_prompt, wire_schema,
+                                       estimated_tokens, usage_stats, started)
+        response = await primary
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+    retry_policy.record_latency(time.monotonic() - started, estimated_tokens)
+    return response, lease
+
+
+async def _acquire_hedge_lease(lease, estimated_tokens):
+    """
+    A lease on a key other than `lease`'s, or None when none frees up quickly.
+    """
+    try:
+        hedge_lease = await asyncio.wait_for(
+            key_scheduler.acquire(estimated_tokens, exclude={lease.api_key}), timeout=1.0
+        )
+    except (asyncio.TimeoutError, NoAvailableKeyError):
+        hedge_lease = None
+    if hedge_lease is not None and hedge_lease.api_key == lease.api_key:
+        # The scheduler falls back to an excluded key when it is the only usable one.
+        key_scheduler.release(hedge_lease)
+        hedge_lease = None
+    if hedge_lease is None:
+        retry_policy.hedges["skipped"] += 1
+    return hedge_lease
+
+
+async def _race(primary, lease, hedge_lease, contents, full_prompt, wire_schema, estimated_tokens, usage_stats,
+                started):
+    retry_policy.hedges["fired"] += 1
+    print(f"   > 🏁 {lease.label} slower than p95; hedging on {hedge_lease.label}...")
+    hedge = asyncio.create_task(_call_on(hedge_lease, contents, full_prompt, wire_schema))
+    pending = {primary, hedge}
+    winner = None
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # When both answered in the same step, the primary is kept.
+            winner = next((task for task in (primary, hedge) if task in done and task.exception() is None), None)
+    except asyncio.CancelledError:
+        primary.cancel()
+        hedge.cancel()
+        key_scheduler.release(hedge_lease)
+        raise
+
+    if winner is hedge:
+        _settle_loser(primary, lease, full_prompt, estimated_tokens, usage_stats)
+        retry_policy.hedges["won"] += 1
+        retry_policy.record_latency(time.monotonic() - started, estimated_tokens)
+        return hedge.result(), hedge_lease
+
+    _settle_loser(hedge, hedge_lease, full_prompt, estimated_tokens, usage_stats)
+    if winner is None:
+        retry_policy.hedges["failed"] += 1
+        raise primary.exception()
+    retry_policy.hedges["lost"] += 1
+    retry_policy.record_latency(time.monotonic() - started, estimated_tokens)
+    return primary.result(), lease
+
+
+def _settle_loser(task, lease, full_prompt, estimated_tokens, usage_stats):
+    if not task.done():
+        task.cancel()
+        key_scheduler.release(lease)
+        # Its real usage is never seen; a call cancelled mid-flight may still be billed.
+        retry_policy.hedges["cancelled_tokens_est"] += estimated_tokens
+        usage_stats["hedge_cancelled_tokens_est"] = usage_stats.get("hedge_cancelled_tokens_est", 0) + estimated_tokens
+    elif task.exception() is None:
+        call_tokens = _call_tokens(task.result())
+        for key, value in call_tokens.items():
+            usage_stats[key] += value
+        billed = call_tokens["input_tokens"] + call_tokens["output_tokens"]
+        key_scheduler.report_success(lease, billed)
+        retry_policy.hedges["loser_tokens"] += billed
+    else:
+        error = task.exception()
+        key_scheduler.report_failure(lease, error, retry_after=retry_after_seconds(error))
+        prompt_cache.invalidate(lease.api_key, full_prompt, error)
+
+
+def _call_tokens(response):
+    call_tokens = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+    if response.usage_metadata:
+        call_tokens["input_tokens"] = response.usage_metadata.prompt_token_count or 0
+        call_tokens["output_tokens"] = response.usage_metadata.candidates_token_count or 0
+        call_tokens["cached_tokens"] = response.usage_metadata.cached_content_token_count or 0
+    return call_tokens
+
+
+async def _extract_parts(images, input_stats, full_prompt, wire_schema, start_time):
+    """
+    One extraction request over prepared parts, retried across keys by the
+    retry policy and hedged when it runs slower than usual.
+    A response cut off at the output limit is not retried: the invoices parsed
+    from it are kept and continuation requests (up to MAX_CONTINUATIONS) ask for
+    the rest, which is merged in.
+    Returns (invoices, usage_stats). When the attempts are used up or the error
+    cannot be fixed by retrying, invoices is None, or the invoices parsed before a
+    failed continuation (marked "truncated"); usage_stats always holds the calls made.
+    """
+    # Same total attempt budget as trying each key 5 times, but spread across keys.
+    MAX_ATTEMPTS = 5 * max(1, len(GEMINI_API_KEYS))
+    multiple_keys = len(GEMINI_API_KEYS) > 1
+    estimated_tokens = estimate_request_tokens(images, full_prompt)
+
+    usage_stats = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0, **input_stats}
+    usage_stats["output_mode"] = "schema" if wire_schema else "json"
+    usage_stats["continuations"] = 0
+    collected = []
+    contents = images
+
+    attempt = 0
+    failures = Counter()
+    failed_keys = set()
+    while attempt < MAX_ATTEMPTS:
+        try:
+            lease = await key_scheduler.acquire(estimated_tokens, exclude=failed_keys)
+        except NoAvailableKeyError as e:
+            print(f"   > ❌ {e}")
+            break
+
+        settled = False
+        try:
+            response, lease = await _hedged_call(lease, contents, full_prompt, wire_schema, estimated_tokens,
+                                                 usage_stats)
+
+            call_tokens = _call_tokens(response)
+            # The key did its job even if the output turns out unusable; the tokens are billed either way.
+            for key, value in call_tokens.items():
+                usage_stats[key] += value
+            key_scheduler.report_success(lease, call_tokens["input_tokens"] + call_tokens["output_tokens"])
+            settled = True
+
+            data, truncated = _parse_response(response, wire_schema, usage_stats)
+
+            if truncated:
+                collected.append(data)
+                if usage_stats["continuations"] < MAX_CONTINUATIONS:
+                    usage_stats["continuations"] += 1
+                    print(f"   > ✂️ Response hit the output limit; requesting continuation "
+                          f"{usage_stats['continuations']}/{MAX_CONTINUATIONS}...")
+                    note = continuation_note(merge_window_results(collected), with_row_numbers=wire_schema is None)
+                    contents = [*images, types.Part.from_text(text=note)]
+                    continue
+                print(f"   > ⚠️ Still truncated after {MAX_CONTINUATIONS} continuations; keeping what was extracted.")
+                usage_stats["truncated"] = True
+                data = None
+            if collected:
+                data = merge_window_results(collected + ([data] if data else []))
+
+            usage_stats["latency_s"] = round(time.monotonic() - start_time, 2)
+            return data, usage_stats
+
+        except asyncio.CancelledError:
+            if not settled:
+                key_scheduler.release(lease)
+            raise
+
+        except Exception as e:
+            kind = classify_error(e)
+            if not settled:
+                key_scheduler.report_failure(lease, e, retry_after=retry_after_seconds(e))
+                prompt_cache.invalidate(lease.api_key, full_prompt, e)
+                failed_keys = {lease.api_key} if multiple_keys else set()
+            attempt += 1
+            failures[kind] += 1
+            wait_time = retry_policy.next_delay(kind, e, attempt, failures[kind], multiple_keys)
+            if wait_time is None:
+                print(f"   > ❌ Attempt {attempt} on {lease.label} failed ({kind}): {type(e).__name__}. Not retrying.")
+                break
+            if wait_time == 0:
+                print(f"   > ⚠️ Attempt {attempt}/{MAX_ATTEMPTS} on {lease.label} failed ({kind}). Rescheduling...")
+                continue
+            print(f"   > ⚠️ Attempt {attempt}/{MAX_ATTEMPTS} on {lease.label} failed ({kind}): {type(e).__name__}. "
+                  f"Retrying in {wait_time:.1f}s...")
+            await asyncio.sleep(wait_time)
+
+    usage_stats["latency_s"] = round(time.monotonic() - start_time, 2)
+    if collected:
+        print("   > ⚠️ Continuation failed; keeping the invoices parsed before the cut.")
+        usage_stats["truncated"] = True
+        return merge_window_results(collected), usage_stats
+    return None, usage_stats
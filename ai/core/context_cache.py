@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import time
+
+from google.genai import types
+
+from config.settings import GEMINI_ENGINE, CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_TTL_SECONDS, CONTEXT_CACHE_TIMEOUT_SECONDS
+
+# Refresh a handle's TTL once less than this fraction of it is left.
+REFRESH_MARGIN = 0.2
+# How long to stop trying after the provider refuses to create a cache
+# (e.g. model without caching support or a prompt below the minimum size).
+CREATE_BACKOFF_SECONDS = 600
+
+
+class PromptContextCache:
+    """
+    Provider-side context caching of the static extraction prompt.
+
+    The prompt only changes with MASTER_SCHEMA, so it is uploaded once as
+    cached content per (API key, model, prompt hash); requests then reference
+    the handle and send only the pages. Cached content is scoped to the
+    project behind an API key, hence one handle per key. Handles are refreshed
+    before their TTL runs out. Cache calls that hang past `timeout_seconds`
+    count as failed, so a request (and the others waiting on the key's lock)
+    falls back to the inline prompt instead of stalling.
+    """
+
+    def __init__(self, model_name=GEMINI_ENGINE, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS,
+                 enabled=CONTEXT_CACHE_ENABLED, timeout_seconds=CONTEXT_CACHE_TIMEOUT_SECONDS):
+        self.model_name = model_name
+        self.ttl_seconds = max(60, int(ttl_seconds))
+        self.enabled = enabled
+        self.timeout_seconds = timeout_seconds
+        self._handles = {}
+        self._disabled_until = {}
+        self._locks = {}
+
+    def _key(self, api_key, prompt):
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+        return (api_key, self.model_name, prompt_hash)
+
+    async def get_handle(self, client, api_key, prompt):
+        """
+        Returns the cached-content name to reference for this prompt, or None
+        to send the prompt inline.
+        """
+        if not self.enabled or not self.model_name:
+            return None
+
+        key = self._key(api_key, prompt)
+        if time.monotonic() < self._disabled_until.get(key, 0):
+            return None
+
+        handle = self._handles.get(key)
+        if handle and not self._needs_refresh(handle):
+            return handle["name"]
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # A create that failed (or timed out) while this request waited disables it for the others too.
+            if time.monotonic() < self._disabled_until.get(key, 0):
+                return None
+            handle = self._handles.get(key)
+            if handle and not self._needs_refresh(handle):
+                return handle["name"]
+            if handle and time.monotonic() < handle["expires_at"]:
+                if await self._refresh(client, handle):
+                    return handle["name"]
+            return await self._create(client, key, prompt)
+
+    def _needs_refresh(self, handle):
+        return time.monotonic() >= handle["expires_at"] - self.ttl_seconds * REFRESH_MARGIN
+
+    async def _refresh(self, client, handle):
+        try:
+            await asyncio.wait_for(
+                client.aio.caches.update(
+                    name=handle["name"],
+                    config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"),
+                ),
+                timeout=self.timeout_seconds,
+            )
+            handle["expires_at"] = time.monotonic() + self.ttl_seconds
+            return True
+        except Exception as e:
+            print(f"   > ⚠️ Context cache refresh failed, recreating: {type(e).__name__}")
+            return False
+
+    async def _create(self, client, key, prompt):
+        try:
+            cached = await asyncio.wait_for(
+                client.aio.caches.create(
+                    model=self.model_name,
+                    config=types.CreateCachedContentConfig(
+                        contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+                        ttl=f"{self.ttl_seconds}s",
+                        display_name=f"invoice-prompt-{key[2]}",
+                    ),
+                ),
+                timeout=self.timeout_seconds,
+            )
+        except Exception as e:
+            self._handles.pop(key, None)
+            self._disabled_until[key] = time.monotonic() + CREATE_BACKOFF_SECONDS
+            print(f"   > ⚠️ Context caching unavailable, sending the prompt inline: {type(e).__name__} {e}")
+            return None
+
+        self._handles[key] = {"name": cached.name, "expires_at": time.monotonic() + self.ttl_seconds}
+        print(f"   > 🧊 Cached extraction prompt as {cached.name} (ttl {self.ttl_seconds}s)")
+        return cached.name
+
+    def invalidate(self, api_key, prompt, error=None):
+        """
+        Drops the handle when the provider reports the cached content as gone.
+        """
+        key = self._key(api_key, prompt)
+        if error is None or getattr(error, "code", None) == 404 or "cachedcontent" in str(error).lower().replace(" ", ""):
+            self._handles.pop(key, None)
+
+
+prompt_cache = PromptContextCache()
@@ -1,138 +1,54 @@
 import os
 import re
 import ast
+import csv
+import json
+import tempfile
+import zipfile
+from functools import partial
 import pandas as pd
 import numpy as np
+from contextlib import contextmanager
 from datetime import datetime
 from openpyxl import load_workbook
 from openpyxl.styles import Alignment, PatternFill
-from config.settings import EXCEL_FILE
-from core.schema_manager import load_schemas
+from config.settings import EXCEL_FILE, EXCEL_WRITE_ENGINE
+from core.schema_manager import load_schemas, schema_registry, HEADER_COLORS, RED, BLUE, YELLOW, WHITE
+from core.result_store import result_store
+from core.xlsx_stream import StreamingXlsxWriter, reusable_sheet_parts
 
 def sanitize_sheet_name(name):
     if not name: return "Unknown_Vendor"
     clean_name = re.sub(r'[\[\]:*?/\\]', '', str(name))
     return clean_name[:25]
 
-def format_excel_sheet(file_path, sheet_name):
-    try:
-        wb = load_workbook(file_path)
-        if sheet_name in wb.sheetnames:
-            ws = wb[sheet_name]
-            
-            FILL_RED    = PatternFill(start_color="FF0000", end_color="FF0000", fill_type="solid")
-            FILL_BLUE   = PatternFill(start_color="0000FF", end_color="0000FF", fill_type="solid")
-            FILL_YELLOW = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
-            FILL_WHITE  = PatternFill(start_color="FFFFFF", end_color="FFFFFF", fill_type="solid")
-
-            HEADER_COLOR_MAP = {
-                "Asset Category": FILL_RED,
-                "Asset Class": FILL_RED,
-                "Total Base Price": FILL_RED,
-                "Total Tax": FILL_RED,
-                "Total Purchase Price": FILL_RED,
-                
-                "Vendor Name": FILL_BLUE,
-                "Date of Entry": FILL_BLUE,
-                "Data Entry Done By": FILL_BLUE,
-                "Customer Name": FILL_BLUE,
-                
-                "Client Code": FILL_YELLOW,
-                "PO Number": FILL_YELLOW,
-                "Invoice Status ( Proforma/ Final)": FILL_YELLOW,
-                "Invoice No": FILL_YELLOW,
-                "Invoice Date": FILL_YELLOW,
-                "Invoice Received Date": FILL_YELLOW,
-                "Vendor Code": FILL_YELLOW,
-                "Vendor State": FILL_YELLOW,
-                "Asset Type": FILL_YELLOW,
-                "RS #": FILL_YELLOW,
-                "Asset Description": FILL_YELLOW,
-                "Asset Serial Number": FILL_YELLOW,
-                "Qty": FILL_YELLOW,
-                "UOM": FILL_YELLOW,
-                "Deliver Address": FILL_YELLOW,
-                "Delivery Location": FILL_YELLOW,
-                "Delivery State": FILL_YELLOW,
-                "Currency Code": FILL_YELLOW,
-                "HSN/SAC": FILL_YELLOW,
-                "Code": FILL_YELLOW,
-                "Base Inv Amt (Excl Tax) - Material": FILL_YELLOW,
-                "Base Inv Amt (Excl Tax) - Labour": FILL_YELLOW,
-                "Reverse Charge": FILL_YELLOW,
-                "Others": FILL_YELLOW,
-                "CGST": FILL_YELLOW,
-                "SGST": FILL_YELLOW,
-                "IGST": FILL_YELLOW,
-                "BCD": FILL_YELLOW,
-                "% of Total Purchase Price being scheduled": FILL_YELLOW,
-                "Waybill Inward Required ": FILL_YELLOW,
-                "Waybill Outward Required ": FILL_YELLOW,
-                "TDS Section": FILL_YELLOW,
-                "TDS Base Value": FILL_YELLOW,
-                "Vend Inv Type": FILL_YELLOW,
-                "Remarks": FILL_YELLOW,
-                "RAPL Billing State ": FILL_YELLOW,
-                
-                "Asset Make": FILL_WHITE,
-                "Asset Model": FILL_WHITE,
-                "LBT Applicable (Yes/No)": FILL_WHITE,
-                "LBT Circle No": FILL_WHITE,
-                "LBT Rate": FILL_WHITE,
-                "Purchase Tax applicable": FILL_WHITE,
-                "Total Bill Amount in Foreign Currency": FILL_WHITE,
-                "Total Bill Amount in INR": FILL_WHITE,
-                "Schedule Value": FILL_WHITE,
-                "VAT": FILL_WHITE,
-                "CST": FILL_WHITE,
-                "C Form Applicable": FILL_WHITE,
-                "Waybill Inward Number": FILL_WHITE,
-                "Waybill Outward Number": FILL_WHITE,
-                "Waybill Inward Counterfoil Received ": FILL_WHITE,
-                "Waybill Outward Counterfoil Received ": FILL_WHITE,
-                "Transporter Name": FILL_WHITE,
-                "Transporter Address": FILL_WHITE,
-                "Vehicle Number": FILL_WHITE,
-                "SEZ": FILL_WHITE,
-                "SEZ Amount": FILL_WHITE,
-                "Import": FILL_WHITE,
-                "Service Code": FILL_WHITE,
-                "Service Tax Amount(If Applicable)": FILL_WHITE,
-                "Others (Freight/ Octroi,etc)": FILL_WHITE,
-                "Base Amt VAT": FILL_WHITE,
-                "VAT %": FILL_WHITE,
-                "Other Bill Component(Service/Freight)": FILL_WHITE,
-                "VAT Rebate": FILL_WHITE,
-                "WCT Base Value": FILL_WHITE,
-                "CENVAT Amount passed on to customer": FILL_WHITE,
-                "Retention": FILL_WHITE,
-                "HSN Code": FILL_WHITE,
-                "SAC Code": FILL_WHITE,
-                "HSN SGST": FILL_WHITE,
-                "HSN CGST": FILL_WHITE,
-                "HSN IGST": FILL_WHITE,
-                "SAC SGST": FILL_WHITE,
-                "SAC CGST": FILL_WHITE,
-                "SAC IGST": FILL_WHITE
-            }
-
-            for col in ws.columns:
-                col_letter = col[0].column_letter
-                ws.column_dimensions[col_letter].width = 50 
-                for cell in col:
-                    cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            
-            for cell in ws[1]:
-                header_text = str(cell.value).strip()
-                
-                if header_text in HEADER_COLOR_MAP:
-                    cell.fill = HEADER_COLOR_MAP[header_text]
-                else:
-                    cell.fill = FILL_WHITE
-
-            wb.save(file_path)
-    except Exception as e:
-        print(f"   > ⚠️ Formatting warning: {e}")
+FILLS_BY_COLOR = {color: PatternFill(start_color=color, end_color=color, fill_type="solid") for color in (RED, BLUE, YELLOW, WHITE)}
+FILL_RED, FILL_BLUE, FILL_YELLOW, FILL_WHITE = (FILLS_BY_COLOR[c] for c in (RED, BLUE, YELLOW, WHITE))
+
+HEADER_COLOR_MAP = {column: FILLS_BY_COLOR[color] for column, color in HEADER_COLORS.items()}
+
+CELL_ALIGNMENT = Alignment(horizontal='center', vertical='center', wrap_text=True)
+COLUMN_WIDTH = 50
+
+
+def format_worksheet(ws):
+    """
+    Applies column widths, alignment and header colours to an open worksheet.
+    """
+    for col in ws.columns:
+        col_letter = col[0].column_letter
+        ws.column_dimensions[col_letter].width = COLUMN_WIDTH
+        for cell in col:
+            cell.alignment = CELL_ALIGNMENT
+    
+    for cell in ws[1]:
+        header_text = str(cell.value).strip()
+        
+        if header_text in HEADER_COLOR_MAP:
+            cell.fill = HEADER_COLOR_MAP[header_text]
+        else:
+            cell.fill = FILL_WHITE
+
 
 def safe_divide(value, divisor):
     if divisor <= 1:
@@ -153,9 +69,25 @@ def get_clean_float(value):
     except (ValueError, TypeError):
         return 0.0
 
-def process_tags(raw_tags_input):
+# FILTER LISTS
+BAD_KEYWORDS = {
+    'VIDEO', 'AUDIO', 'CONF', 'KIT', 'UNIT', 'SYS', 'LIC', 'SUB', 'PRO', 'PLUS', 
+    'WARRANTY', 'PRESENTATION', 'REPEATER', 'CABLE', 'HDMI', 
+    'WINDOWS', 'SERVER', 'MICROSOFT', 'INTEL', 'PROCESSOR', 
+    '7D76', '4X40', '8471', 'STANDARD', 'WIRELESS'
+}
+BRAND_PREFIXES = ('CISCO', 'LENOVO', 'HP', 'DELL', 'POLY', 'LOGI', 'APPLE')
+
+# Built once: tags are joined with NUL and cleaned with one substitution, then
+# each keyword is located with str.find over the whole buffer. Keywords that
+# contain a shorter keyword (PROCESSOR has PRO) can never decide anything.
+TAG_SEPARATOR = "\0"
+TAG_JUNK_PATTERN = re.compile(r'[^a-zA-Z0-9\-\0]')
+BAD_KEYWORD_SCAN = tuple(sorted(k for k in BAD_KEYWORDS if not any(o != k and o in k for o in BAD_KEYWORDS)))
+
+def split_tags(raw_tags_input):
     """
-    Helper to clean and validate tags.
+    Splits raw serial-number input into candidate tags.
     STRICT MODE: Only splits if input is a List or Stringified List.
     """
     if not raw_tags_input:
@@ -185,188 +117,606 @@ def process_tags(raw_tags_input):
             if s:
                 initial_tags.append(s)
 
-    final_tags = []
-    
-    # FILTER LISTS
-    BAD_KEYWORDS = {
-        'VIDEO', 'AUDIO', 'CONF', 'KIT', 'UNIT', 'SYS', 'LIC', 'SUB', 'PRO', 'PLUS', 
-        'WARRANTY', 'PRESENTATION', 'REPEATER', 'CABLE', 'HDMI', 
-        'WINDOWS', 'SERVER', 'MICROSOFT', 'INTEL', 'PROCESSOR', 
-        '7D76', '4X40', '8471', 'STANDARD', 'WIRELESS'
-    }
-    BRAND_PREFIXES = ('CISCO', 'LENOVO', 'HP', 'DELL', 'POLY', 'LOGI', 'APPLE')
-
-    for t in initial_tags:
-        clean_t = re.sub(r'[^a-zA-Z0-9-]', '', t.upper())
-        length = len(clean_t)
-        
-        # VALIDATION GATE
-        if length < 5: continue
-        
-        is_bad = False
-        for bad in BAD_KEYWORDS:
-            if bad in clean_t:
-                is_bad = True
-                break
-        if is_bad: continue
+    return initial_tags
 
-        if clean_t.startswith(BRAND_PREFIXES): continue
-        
-        final_tags.append(clean_t)
-            
-    return list(dict.fromkeys(final_tags))
+def filter_tags(tags):
+    """
+    Cleans and validates a whole list of candidate tags in one call.
 
-def flatten_invoice_data(data):
+    Returns:
+        list: aligned with `tags`; the cleaned tag, or None where the tag is
+              too short, contains a bad keyword or starts with a brand name.
     """
-    Revised logic: "SMART READER / DUMB BUILDER"
+    if not tags:
+        return []
+
+    joined = TAG_SEPARATOR.join(tags)
+    if joined.count(TAG_SEPARATOR) != len(tags) - 1:
+        # A tag with an embedded NUL would shift the split; screen one by one.
+        return [filter_tags([t.replace(TAG_SEPARATOR, '')])[0] for t in tags]
+
+    cleaned_all = TAG_JUNK_PATTERN.sub('', joined.upper())
+    cleaned = cleaned_all.split(TAG_SEPARATOR)
+
+    hits = []
+    for keyword in BAD_KEYWORD_SCAN:
+        pos = cleaned_all.find(keyword)
+        while pos != -1:
+            hits.append(pos)
+            # One hit per tag is enough: resume at the next tag.
+            pos = cleaned_all.find(TAG_SEPARATOR, pos)
+            if pos != -1:
+                pos = cleaned_all.find(keyword, pos)
+    index, previous = 0, 0
+    for pos in sorted(hits):
+        index += cleaned_all.count(TAG_SEPARATOR, previous, pos)
+        previous = pos
+        # Rejected tags are blanked, so the length gate below drops them.
+        cleaned[index] = ""
+
+    return [None if len(t) < 5 or t.startswith(BRAND_PREFIXES) else t for t in cleaned]
+
+def process_tags(raw_tags_input):
+    """
+    Helper to clean and validate tags.
+    STRICT MODE: Only splits if input is a List or Stringified List.
+    """
+    return list(dict.fromkeys(t for t in filter_tags(split_tags(raw_tags_input)) if t))
+
+# Amount columns split evenly across the serial numbers of a line item (matched case-insensitively).
+PRORATION_KEYS = {k.lower() for k in [
+    "Total Value", "Total Purchase Price", "Total Amount", "Grand Total", 
+    "Sub Total", "Subtotal", "IGST Amount", "CGST Amount", "SGST Amount", 
+    "Total SGST", "Total CGST", "Total IGST", "Tax Total", "Total Tax Amount", 
+    "Net Amount", "Tax Amount", "Rate", "Amount", "Value (INR)", "Total Base Price",
+    "IGST", "CGST", "SGST", "Total Tax", "HSN IGST", "Base Inv Amt (Excl Tax) - Labour", "Base Inv Amt (Excl Tax) - Material"
+]}
+DELIVERY_LOCATION_PATTERN = re.compile(r'([\w\s]+?)[,\s-]*\d{6}')
+
+def _line_item_templates(invoices):
+    """
+    First pass of flatten_invoices: one row per line item (before serial
+    explosion), its serial numbers and the divisor used to prorate amounts.
+    Mirrors the item handling of the legacy per-invoice flattener; the
+    candidate tags of every invoice go through filter_tags in a single call.
     """
-    item_keys = ['Line Items', 'items', 'line_items']
-    target_key = next((k for k in item_keys if k in data and isinstance(data[k], list)), None)
-    items_list = data.get(target_key, [])
-    
-    global_tags = []
     possible_tag_keys = ['Asset Serial Number', 'Tag Nos', 'Serial No', 'Sr No']
-    
-    for pk in possible_tag_keys:
-        if pk in data and data[pk]:
-            global_tags = process_tags(data[pk])
-            break 
+    candidates = []
 
-    flattened_rows = []
+    def collect(raw_tags_input):
+        start = len(candidates)
+        candidates.extend(split_tags(raw_tags_input))
+        return start, len(candidates)
 
-    if not items_list:
-        items_list = [data] 
+    items = []
+    for data in invoices:
+        item_keys = ['Line Items', 'items', 'line_items']
+        target_key = next((k for k in item_keys if k in data and isinstance(data[k], list)), None)
+        items_list = data.get(target_key, [])
 
-    for i, item in enumerate(items_list):
-        row_base = data.copy()
-        if target_key in row_base: del row_base[target_key]
-        
-        if isinstance(item, dict):
-            row_base.update(item)
-            
-        item_tags = []
-        
+        global_spans = []
         for pk in possible_tag_keys:
-            if pk in item and item[pk]:
-                item_tags.extend(process_tags(item[pk]))
-        
-        desc = item.get('Asset Description') or item.get('Description') or ''
-        
-        if str(desc).strip().startswith('['):
-             item_tags.extend(process_tags(str(desc)))
+            if pk in data and data[pk]:
+                global_spans = [collect(data[pk])]
+                break
+
+        if not items_list:
+            items_list = [data]
+
+        for i, item in enumerate(items_list):
+            row_base = data.copy()
+            if target_key in row_base: del row_base[target_key]
+            if isinstance(item, dict):
+                row_base.update(item)
+
+            spans = []
+            for pk in possible_tag_keys:
+                if pk in item and item[pk]:
+                    spans.append(collect(item[pk]))
+
+            desc = item.get('Asset Description') or item.get('Description') or ''
+            if str(desc).strip().startswith('['):
+                spans.append(collect(str(desc)))
 
-        item_tags = list(dict.fromkeys(item_tags))
+            items.append((row_base, item, spans, global_spans if i == 0 else []))
 
-        if not item_tags and global_tags and i == 0:
-            item_tags = global_tags
+    screened = filter_tags(candidates)
+
+    def tags_in(spans):
+        return list(dict.fromkeys(t for start, end in spans for t in screened[start:end] if t))
+
+    templates, tag_lists, divisors = [], [], []
+    for row_base, item, spans, global_spans in items:
+        item_tags = tags_in(spans)
+        if not item_tags and global_spans:
+            item_tags = tags_in(global_spans)
+
+        divisor = None
         if item_tags:
             divisor = len(item_tags)
-            q_val = item.get('Quantity') or item.get('Qty')
-            extracted_qty = get_clean_float(q_val)
+            extracted_qty = get_clean_float(item.get('Quantity') or item.get('Qty'))
             if extracted_qty > 0:
                 divisor = extracted_qty
-            
-            for tag in item_tags:
-                new_row = row_base.copy()
-                new_row['Asset Serial Number'] = tag
-                
-                proration_keys = [
-                    "Total Value", "Total Purchase Price", "Total Amount", "Grand Total", 
-                    "Sub Total", "Subtotal", "IGST Amount", "CGST Amount", "SGST Amount", 
-                    "Total SGST", "Total CGST", "Total IGST", "Tax Total", "Total Tax Amount", 
-                    "Net Amount", "Tax Amount", "Rate", "Amount", "Value (INR)", "Total Base Price",
-                    "IGST", "CGST", "SGST", "Total Tax", "HSN IGST", "Base Inv Amt (Excl Tax) - Labour", "Base Inv Amt (Excl Tax) - Material"
-                ]
-                for key, val in new_row.items():
-                    if any(k.lower() == key.lower() for k in proration_keys):
-                        new_row[key] = safe_divide(val, divisor)
-                
-                if 'Net Amount' in new_row: new_row['Unit Price'] = new_row['Net Amount']
-                elif 'Total Base Price' in new_row: new_row['Unit Price'] = new_row['Total Base Price']
-                
-                new_row['Quantity'] = 1
-                new_row['Qty'] = 1
-                flattened_rows.append(new_row)
-        else:
-            new_row = row_base.copy()
-            if 'Qty' not in new_row:
-                new_row['Qty'] = new_row.get('Quantity', 1)
-            flattened_rows.append(new_row)
 
-    # 4. Final Metadata
-    current_date_str = datetime.now().strftime("%Y-%m-%d")
+        templates.append(row_base)
+        tag_lists.append(item_tags)
+        divisors.append(divisor)
 
-    for row in flattened_rows:
-        row['Date of Entry'] = current_date_str
-        row['Data Entry Done By'] = "Auto"
-        
-        uom_val = row.get('UOM')
-        if not uom_val or str(uom_val).strip() == "":
-            row['UOM'] = "NUMBER"
+    return templates, tag_lists, divisors
 
-        currency_val = row.get('Currency Code')
-        currency_str = str(currency_val).strip().upper() if currency_val is not None else ""
-        
-        if not currency_str or 'INR' in currency_str or currency_str == 'NONE':
-            row['Total Bill Amount in INR'] = 1
-            row['Total Bill Amount in Foreign Currency'] = 0
-        else:
-            row['Total Bill Amount in INR'] = 0
-            row['Total Bill Amount in Foreign Currency'] = 1
-            
-        hsn_sac_val = str(row.get('HSN/SAC') or row.get('HSN Code') or row.get('SAC Code') or row.get('Code') or '').strip()
-        base_amt = row.get('Total Base Price') or row.get('Net Amount') or row.get('Unit Price') or ""
-        
-        if hsn_sac_val:
-            if hsn_sac_val.startswith("99"):
-                row['HSN/SAC'] = "SAC"
-                row['Code'] = hsn_sac_val
-                row['Base Inv Amt (Excl Tax) - Labour'] = base_amt
-                row['Base Inv Amt (Excl Tax) - Material'] = ""
-            else:
-                row['HSN/SAC'] = "HSN"
-                row['Code'] = hsn_sac_val
-                row['Base Inv Amt (Excl Tax) - Material'] = base_amt
-                row['Base Inv Amt (Excl Tax) - Labour'] = ""
+
+def _object_array(values):
+    # 1-D even when the values are themselves lists (np.array would nest them).
+    return pd.Series(values, dtype=object).to_numpy()
+
+
+def _enrich_line_item(row, tags, divisor, today):
+    """
+    Enriches one line-item row in place, the way every serial row of it would
+    be; the serial numbers themselves are filled in when the rows are exploded.
+    """
+    if tags:
+        row['Asset Serial Number'] = tags[0]
+        for key, val in row.items():
+            if key.lower() in PRORATION_KEYS:
+                row[key] = safe_divide(val, divisor)
+
+        if 'Net Amount' in row: row['Unit Price'] = row['Net Amount']
+        elif 'Total Base Price' in row: row['Unit Price'] = row['Total Base Price']
+
+        row['Quantity'] = 1
+        row['Qty'] = 1
+    elif 'Qty' not in row:
+        row['Qty'] = row.get('Quantity', 1)
+
+    row['Date of Entry'] = today
+    row['Data Entry Done By'] = "Auto"
+
+    uom_val = row.get('UOM')
+    if not uom_val or str(uom_val).strip() == "":
+        row['UOM'] = "NUMBER"
+
+    currency_val = row.get('Currency Code')
+    currency_str = str(currency_val).strip().upper() if currency_val is not None else ""
+    inr = not currency_str or 'INR' in currency_str or currency_str == 'NONE'
+    row['Total Bill Amount in INR'] = 1 if inr else 0
+    row['Total Bill Amount in Foreign Currency'] = 0 if inr else 1
+
+    hsn_sac_val = str(row.get('HSN/SAC') or row.get('HSN Code') or row.get('SAC Code') or row.get('Code') or '').strip()
+    base_amt = row.get('Total Base Price') or row.get('Net Amount') or row.get('Unit Price') or ""
+    if hsn_sac_val:
+        sac = hsn_sac_val.startswith("99")
+        row['HSN/SAC'] = "SAC" if sac else "HSN"
+        row['Code'] = hsn_sac_val
+        if sac:
+            row['Base Inv Amt (Excl Tax) - Labour'] = base_amt
+            row['Base Inv Amt (Excl Tax) - Material'] = ""
         else:
-            row['HSN/SAC'] = ""
-            row['Code'] = ""
-        
-        po_num = str(row.get('PO Number', '')).strip()
-        if po_num and not row.get('Client Code'):
-            parts = po_num.split('/')
-            if len(parts) > 1:
-                row['Client Code'] = parts[0].strip()
-
-        address = str(row.get('Deliver Address', '')).strip()
-        current_loc = str(row.get('Delivery Location', '')).strip()
-        if address and not current_loc:
-            match = re.search(r'([\w\s]+?)[,\s-]*\d{6}', address)
-            if match:
-                loc_text = match.group(1).strip()
-                loc_parts = loc_text.split(',')
-                row['Delivery Location'] = loc_parts[-1].strip()
-
-        base_price = get_clean_float(row.get('Total Base Price') or row.get('Net Amount'))
-        total_tax = get_clean_float(row.get('Total Tax') or row.get('Tax Amount'))
-        
-        igst = get_clean_float(row.get('IGST') or row.get('IGST Amount'))
-        cgst = get_clean_float(row.get('CGST') or row.get('CGST Amount'))
-        sgst = get_clean_float(row.get('SGST') or row.get('SGST Amount'))
+            row['Base Inv Amt (Excl Tax) - Material'] = base_amt
+            row['Base Inv Amt (Excl Tax) - Labour'] = ""
+    else:
+        row['HSN/SAC'] = ""
+        row['Code'] = ""
+
+    po_num = str(row.get('PO Number', '')).strip()
+    if po_num and not row.get('Client Code'):
+        parts = po_num.split('/')
+        if len(parts) > 1:
+            row['Client Code'] = parts[0].strip()
+
+    address = str(row.get('Deliver Address', '')).strip()
+    current_loc = str(row.get('Delivery Location', '')).strip()
+    if address and not current_loc:
+        match = DELIVERY_LOCATION_PATTERN.search(address)
+        if match:
+            row['Delivery Location'] = match.group(1).strip().split(',')[-1].strip()
+
+    base_price = get_clean_float(row.get('Total Base Price') or row.get('Net Amount'))
+    total_tax = get_clean_float(row.get('Total Tax') or row.get('Tax Amount'))
+    igst = get_clean_float(row.get('IGST') or row.get('IGST Amount'))
+    cgst = get_clean_float(row.get('CGST') or row.get('CGST Amount'))
+    sgst = get_clean_float(row.get('SGST') or row.get('SGST Amount'))
+
+    if total_tax == 0 and (igst > 0 or cgst > 0 or sgst > 0):
+        total_tax = igst + cgst + sgst
+        row['Total Tax'] = round(total_tax, 2)
+
+    if base_price > 0:
+        grand_total = round(base_price + total_tax, 2)
+        row['Total Purchase Price'] = grand_total
+        if 'Grand Total' in row: row['Grand Total'] = grand_total
+        if 'Total Amount' in row: row['Total Amount'] = grand_total
+
+
+def flatten_invoices(invoices):
+    """
+    Flattens many invoices into one row per line item and serial number.
 
-        if total_tax == 0 and (igst > 0 or cgst > 0 or sgst > 0):
-            total_tax = igst + cgst + sgst
-            row['Total Tax'] = round(total_tax, 2)
+    Enrichment (proration, UOM, currency flags, HSN/SAC split, PO client code,
+    delivery location, tax totals) runs once per line item rather than once per
+    serial row; serial numbers are then exploded by repeating the line-item rows
+    of one object matrix, which becomes the frame in a single construction.
 
-        if base_price > 0:
-            grand_total = base_price + total_tax
-            row['Total Purchase Price'] = round(grand_total, 2)
-            if 'Grand Total' in row: row['Grand Total'] = round(grand_total, 2)
-            if 'Total Amount' in row: row['Total Amount'] = round(grand_total, 2)
+    Returns:
+        pd.DataFrame: identical to the legacy per-invoice flattener kept as the
+        reference in benchmarks/flatten_invoices_bench.py.
+    """
+    templates, tag_lists, divisors = _line_item_templates(invoices)
+    if not templates:
+        return pd.DataFrame()
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    for row, tags, divisor in zip(templates, tag_lists, divisors):
+        _enrich_line_item(row, tags, divisor, today)
+
+    keys = list(dict.fromkeys(k for row in templates for k in row))
+    position = {key: j for j, key in enumerate(keys)}
+    matrix = np.full((len(templates), len(keys)), np.nan, dtype=object)
+    for i, row in enumerate(templates):
+        for key, value in row.items():
+            matrix[i, position[key]] = value
+
+    exploded = matrix[np.repeat(np.arange(len(templates)), [len(tags) or 1 for tags in tag_lists])]
+    if 'Asset Serial Number' in position:
+        serial_column = position['Asset Serial Number']
+        exploded[:, serial_column] = _object_array([
+            serial
+            for row, tags in zip(matrix, tag_lists)
+            for serial in (tags or [row[serial_column]])
+        ])
+    return pd.DataFrame(exploded, columns=keys).infer_objects()
+
+EXPORT_FORMATS = ("xlsx", "csv", "jsonl")
+HEADER_FILL_RGBS = [fill.start_color.rgb for fill in FILLS_BY_COLOR.values()]
+
+
+def _combine(frames, target_schema):
+    blank_row = pd.DataFrame([[""] * len(frames[0].columns)], columns=frames[0].columns)
+    pieces = [frames[0]]
+    for df in frames[1:]:
+        pieces.extend([blank_row, df])
+    combined = pd.concat(pieces, ignore_index=True)
+    if target_schema:
+        combined = combined.reindex(columns=target_schema, fill_value="")
+    return combined.fillna("")
 
-    return flattened_rows
 
-def update_excel_sheet(vendor_name, data, file_path=EXCEL_FILE):
+def _group_by_sheet(batches):
+    sheets = {}
+    for batch in batches:
+        sheets.setdefault(batch["sheet_name"], []).append(batch)
+    return sheets
+
+
+def _report_columns(batches, target_schema, header=None):
+    if target_schema:
+        return list(target_schema)
+    columns = list(header or [])
+    for batch in batches:
+        columns += [c for c in batch["columns"] if c not in columns]
+    return columns
+
+
+def _temp_path_for(file_path, suffix):
+    fd, tmp_path = tempfile.mkstemp(suffix=suffix, dir=os.path.dirname(os.path.abspath(file_path)))
+    os.close(fd)
+    return tmp_path
+
+
+def _stream_sheet(writer, sheet_name, source_ws, batches, target_schema, open_raw_part=None):
+    """
+    Writes one sheet through the streaming writer: the existing rows of
+    `source_ws` (if any), then each stored batch behind a blank separator row.
+    `open_raw_part` opens the sheet's part when the file came from the streaming
+    writer itself; its rows are then copied verbatim instead of re-parsed.
+    """
+    header = None
+    existing_rows = None
+    existing_total = 0
+    if source_ws is not None:
+        existing_rows = source_ws.iter_rows(values_only=True)
+        first = next(existing_rows, None)
+        header = list(first) if first else None
+        existing_total = source_ws.max_row or 0
+
+    # A sheet without new batches is copied through unchanged.
+    columns = _report_columns(batches, target_schema, header) if batches else list(header or [])
+
+    row_total = max(existing_total, 1)
+    separated = header is not None
+    for batch in batches or []:
+        row_total += batch["row_count"] + (1 if separated else 0)
+        separated = True
+
+    if open_raw_part is not None and header == columns:
+        sheet = writer.add_sheet(sheet_name, len(columns), COLUMN_WIDTH, row_total, copy_from=open_raw_part())
+        wrote_rows = True
+    else:
+        sheet = writer.add_sheet(sheet_name, len(columns), COLUMN_WIDTH, row_total)
+        wrote_rows = _stream_existing(sheet, writer, columns, header, existing_rows)
+
+    for batch in batches or []:
+        if wrote_rows:
+            sheet.append(())
+        # Rows go from the store straight into the sheet, never a whole batch in memory.
+        for row in result_store.iter_batch_rows(batch["batch_id"]):
+            sheet.append([_stored_cell(row.get(column)) for column in columns])
+        wrote_rows = True
+
+
+def _stored_cell(value):
+    # Empty cells are not stored, and NaN stands for empty like in the DataFrame paths.
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    return value
+
+
+def _stream_existing(sheet, writer, columns, header, existing_rows):
+    """
+    Writes the styled header row and re-maps the existing rows onto `columns`.
+    Returns whether anything after it needs a blank separator row.
+    """
+    schema = schema_registry.snapshot()
+    if tuple(columns) == schema.columns:
+        colors = schema.header_colors
+    else:
+        colors = [HEADER_COLORS.get(str(c).strip(), WHITE) for c in columns]
+    header_styles = [writer.header_styles[FILLS_BY_COLOR[color].start_color.rgb] for color in colors]
+    sheet.append(columns, header_styles)
+
+    if existing_rows is None or not header:
+        return False
+    positions = {name: i for i, name in enumerate(header) if name is not None}
+    picks = [positions.get(column) for column in columns]
+    for row in existing_rows:
+        sheet.append([row[i] if i is not None and i < len(row) else None for i in picks])
+    return True
+
+
+def _write_openpyxl(file_path, sheets, target_schema):
+    """
+    Writes every sheet from the stored batches through pandas/openpyxl,
+    formatting each worksheet inside the same writer.
+    """
+    tmp_path = _temp_path_for(file_path, ".xlsx")
+    try:
+        with pd.ExcelWriter(tmp_path, engine='openpyxl', mode='w') as writer:
+            for sheet_name, batches in sheets.items():
+                frames = [result_store.batch_frame(batch) for batch in batches]
+                _combine(frames, target_schema).to_excel(writer, sheet_name=sheet_name, index=False)
+                format_worksheet(writer.sheets[sheet_name])
+        os.replace(tmp_path, file_path)
+        return True
+    except Exception as e:
+        print(f"   > ❌ Error writing Excel report '{file_path}': {e}")
+        return False
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_streaming(file_path, sheets, target_schema, append_to_existing):
+    """
+    Writes the workbook with StreamingXlsxWriter into a temp file next to the
+    report, then swaps it in. With `append_to_existing`, the current file's sheets
+    are streamed from a read-only workbook (or copied verbatim) and only the new
+    batches are added, so memory stays flat however large the report grows.
+    """
+    tmp_path = _temp_path_for(file_path, ".xlsx")
+    source = None
+    raw_source = None
+    try:
+        writer = StreamingXlsxWriter(tmp_path, header_colors=HEADER_FILL_RGBS)
+
+        sheet_names = []
+        raw_parts = {}
+        if append_to_existing:
+            source = load_workbook(file_path, read_only=True)
+            sheet_names = list(source.sheetnames)
+            raw_parts = reusable_sheet_parts(file_path, HEADER_FILL_RGBS)
+            if raw_parts:
+                raw_source = zipfile.ZipFile(file_path)
+        sheet_names += [name for name in sheets if name not in sheet_names]
+
+        for sheet_name in sheet_names:
+            source_ws = None
+            open_raw_part = None
+            if source is not None and sheet_name in source.sheetnames:
+                source_ws = source[sheet_name]
+                if sheet_name in raw_parts:
+                    open_raw_part = partial(raw_source.open, raw_parts[sheet_name])
+            _stream_sheet(writer, sheet_name, source_ws, sheets.get(sheet_name), target_schema, open_raw_part)
+
+        writer.close()
+        for handle in (source, raw_source):
+            if handle is not None:
+                handle.close()
+        source = raw_source = None
+        os.replace(tmp_path, file_path)
+        return True
+    except Exception as e:
+        print(f"   > ❌ Error writing Excel report '{file_path}': {e}")
+        return False
+    finally:
+        for handle in (source, raw_source):
+            if handle is not None:
+                handle.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_flat(file_path, fmt, batches, target_schema):
+    """
+    Writes the stored rows as one CSV (with a leading "Sheet" column) or as
+    JSON Lines, streaming them from the store.
+    """
+    columns = _report_columns(batches, target_schema)
+    tmp_path = _temp_path_for(file_path, f".{fmt}")
+    try:
+        with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            if fmt == "csv":
+                csv_writer = csv.writer(f)
+                csv_writer.writerow(["Sheet", *columns])
+            for batch in batches:
+                for row in result_store.iter_batch_rows(batch["batch_id"]):
+                    if fmt == "csv":
+                        csv_writer.writerow([batch["sheet_name"], *(row.get(c, "") for c in columns)])
+                    else:
+                        f.write(json.dumps({"Sheet": batch["sheet_name"], **row}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, file_path)
+        return True
+    except Exception as e:
+        print(f"   > ❌ Error writing {fmt.upper()} report '{file_path}': {e}")
+        return False
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _import_workbook(file_path, report):
+    """
+    One-time import of a workbook written before the result store existed, so
+    its rows stay part of the report. Blank separator rows split each sheet
+    back into batches.
+    """
+    try:
+        wb = load_workbook(file_path, read_only=True)
+    except Exception as e:
+        print(f"   > ⚠️ Could not import existing report '{file_path}': {e}")
+        return
+
+    try:
+        for ws in wb.worksheets:
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None)
+            if not header:
+                continue
+            batches, current = [], []
+            for row in rows:
+                record = {col: v for col, v in zip(header, row) if col is not None and v is not None and v != ""}
+                if record:
+                    current.append(record)
+                elif current:
+                    batches.append(current)
+                    current = []
+            if current:
+                batches.append(current)
+            result_store.import_rows(report, ws.title, [c for c in header if c is not None], batches)
+            print(f"   > 📥 Imported {sum(len(b) for b in batches)} existing rows from sheet '{ws.title}'")
+    finally:
+        wb.close()
+
+    # The file on disk already shows everything just imported.
+    generation, watermark = result_store.version(report)
+    result_store.record_export(report, "xlsx", file_path, generation, watermark)
+
+
+def export_report(file_path=EXCEL_FILE, fmt="xlsx", out_path=None):
+    """
+    Materializes the stored rows of the report at `file_path` as XLSX, CSV or JSONL.
+    The output is reused until new rows are stored for the report.
+    Returns the output path, or None if nothing is stored or writing failed.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported report format '{fmt}'. Use one of {EXPORT_FORMATS}.")
+
+    report = result_store.report_key(file_path)
+    out_path = out_path or (file_path if fmt == "xlsx" else f"{os.path.splitext(file_path)[0]}.{fmt}")
+    generation, watermark = result_store.version(report)
+    if not generation:
+        return None
+
+    state = result_store.export_state(report, fmt, out_path)
+    if state and state["generation"] == generation and os.path.exists(out_path):
+        return out_path
+
+    target_schema = load_schemas()
+    if fmt == "xlsx" and EXCEL_WRITE_ENGINE == "streaming":
+        # Only batches stored since the last export are appended to the existing file.
+        incremental = state is not None and os.path.exists(out_path)
+        batches = result_store.batches(report, state["watermark"] if incremental else 0, watermark)
+        written = _write_streaming(out_path, _group_by_sheet(batches), target_schema, incremental)
+    elif fmt == "xlsx":
+        written = _write_openpyxl(out_path, _group_by_sheet(result_store.batches(report, 0, watermark)), target_schema)
+    else:
+        written = _write_flat(out_path, fmt, result_store.batches(report, 0, watermark), target_schema)
+
+    if not written:
+        return None
+    result_store.record_export(report, fmt, out_path, generation, watermark)
+    print(f"   > 💾 Report written: {out_path}")
+    return out_path
+
+
+class ReportBuilder:
+    """
+    Collects the rows of every sheet during a session, stores them in the
+    result store in one go and then materializes the workbook once.
+
+    Each add() becomes one batch; in the workbook, batches of the same sheet
+    are separated by a blank row, exactly as repeated update_excel_sheet calls
+    used to do. EXCEL_WRITE_ENGINE picks how the workbook is written.
+    """
+
+    def __init__(self, file_path, user_id=None, session_id=None):
+        self.file_path = file_path
+        self.user_id = user_id
+        self.session_id = session_id
+        self.sheets = {}
+
+    def add(self, sheet_name, df):
+        self.sheets.setdefault(sheet_name, []).append(df)
+
+    def write(self):
+        if self.store():
+            export_report(self.file_path)
+
+    def store(self):
+        """
+        Appends the collected rows to the result store without writing the report.
+        """
+        if not self.sheets:
+            return False
+
+        report = result_store.report_key(self.file_path)
+        try:
+            if not result_store.version(report)[0] and os.path.exists(self.file_path):
+                _import_workbook(self.file_path, report)
+            result_store.append(report, self.sheets, self.user_id, self.session_id)
+        except Exception as e:
+            print(f"   > ❌ Error storing results for '{self.file_path}': {e}")
+            return False
+        return True
+
+
+_active_reports = {}
+
+
+@contextmanager
+def report_session(file_path=EXCEL_FILE, user_id=None, session_id=None):
+    """
+    Buffers every update_excel_sheet call for `file_path` inside the block;
+    the rows are stored and the workbook is written once when the block exits.
+    """
+    key = os.path.abspath(file_path)
+    if key in _active_reports:
+        yield _active_reports[key]
+        return
+
+    builder = ReportBuilder(file_path, user_id, session_id)
+    _active_reports[key] = builder
+    try:
+        yield builder
+    finally:
+        del _active_reports[key]
+        builder.write()
+
+
+def _report_frame(vendor_name, data):
+    """
+    Flattens one file's invoices into (sheet_name, rows aligned to the schema);
+    (None, None) when there is nothing to write.
+    """
     if isinstance(data, list) and len(data) > 0:
         data_to_process = data
         if vendor_name == "Unknown_Vendor":
@@ -374,20 +724,17 @@ def update_excel_sheet(vendor_name, data, file_path=EXCEL_FILE):
     elif isinstance(data, dict):
         data_to_process = [data]
     else:
-        return [] 
+        return None, None
 
     sheet_name = sanitize_sheet_name(vendor_name)
-    all_rows = []
     
     for item in data_to_process:
         item['Vendor Name'] = vendor_name 
-        extracted_rows = flatten_invoice_data(item)
-        all_rows.extend(extracted_rows)
 
-    if not all_rows:
-        return []
+    new_data_df = flatten_invoices(data_to_process)
+    if new_data_df.empty:
+        return None, None
 
-    new_data_df = pd.DataFrame(all_rows)
     target_schema = load_schemas()
     
     if target_schema:
@@ -404,38 +751,30 @@ def update_excel_sheet(vendor_name, data, file_path=EXCEL_FILE):
         if 'Vendor Name' in cols:
             cols.insert(0, cols.pop(cols.index('Vendor Name')))
         final_df = final_df[cols]
+    return sheet_name, final_df
 
-    try:
-        if not os.path.exists(file_path):
-            with pd.ExcelWriter(file_path, engine='openpyxl', mode='w') as writer:
-                final_df.to_excel(writer, sheet_name=sheet_name, index=False)
-            print(f"   > 🆕 Created new Excel file: {sheet_name}")
-            columns = list(final_df.columns)
-        else:
-            xls = pd.ExcelFile(file_path)
-            sheet_exists = sheet_name in xls.sheet_names
-            
-            if sheet_exists:
-                existing_df = pd.read_excel(file_path, sheet_name=sheet_name)
-                if target_schema:
-                    existing_df = existing_df.reindex(columns=target_schema, fill_value="")
-                
-                blank_row = pd.DataFrame([[""] * len(final_df.columns)], columns=final_df.columns)
-                updated_df = pd.concat([existing_df, blank_row, final_df], ignore_index=True)
-                updated_df = updated_df.fillna("")
-                
-                with pd.ExcelWriter(file_path, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-                    updated_df.to_excel(writer, sheet_name=sheet_name, index=False)
-                columns = list(updated_df.columns)
-            else:
-                with pd.ExcelWriter(file_path, engine='openpyxl', mode='a') as writer:
-                    final_df.to_excel(writer, sheet_name=sheet_name, index=False)
-                print(f"   > 🆕 Added new sheet: {sheet_name}")
-                columns = list(final_df.columns)
 
-        format_excel_sheet(file_path, sheet_name)
-        return columns
+def update_excel_sheet(vendor_name, data, file_path=EXCEL_FILE):
+    sheet_name, final_df = _report_frame(vendor_name, data)
+    if final_df is None:
+        return []
 
-    except Exception as e:
-        print(f"   > ❌ Error updating Excel sheet '{sheet_name}': {e}")
-        return []
\ No newline at end of file
+    # Outside a report_session this is a one-sheet session written right away.
+    with report_session(file_path) as report:
+        report.add(sheet_name, final_df)
+    return list(final_df.columns)
+
+
+def store_file_rows(vendor_name, data, file_path, user_id=None, session_id=None):
+    """
+    Stores one file's rows under the report at `file_path` as soon as the file is
+    extracted, without writing the report; export_report assembles the partial or
+    final report from these stored pieces. Returns the columns stored.
+    """
+    sheet_name, final_df = _report_frame(vendor_name, data)
+    if final_df is None:
+        return []
+
+    builder = ReportBuilder(file_path, user_id, session_id)
+    builder.add(sheet_name, final_df)
+    return list(final_df.columns) if builder.store() else []
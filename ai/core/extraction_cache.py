@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from config.settings import EXTRACTION_CACHE_FILE, EXTRACTION_CACHE_MAX_MB, GEMINI_ENGINE
+from core.ai_extractor import PROMPT_VERSION
+from core.pdf_utils import input_signature
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """
+    SHA-256 of the file contents, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Persistent, content-addressed cache of Gemini extraction results.
+
+    Entries are keyed on the PDF content hash, the model, the prompt version, the
+    MASTER_SCHEMA hash and the input signature (input mode and raster settings,
+    so switching modes re-extracts instead of serving the old mode), and evicted
+    least-recently-used once the stored payloads exceed the size budget. Entries
+    of another prompt version or schema are never deleted outright: processes
+    sharing the cache may run with a different prompt or schema, and every entry
+    was a paid extraction. Every operation opens its own SQLite connection, so
+    the cache can be shared by concurrent sessions and processes.
+    """
+
+    def __init__(self, db_path=EXTRACTION_CACHE_FILE, max_mb=EXTRACTION_CACHE_MAX_MB,
+                 model_name=GEMINI_ENGINE, prompt_version=PROMPT_VERSION):
+        self.db_path = db_path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.model_name = model_name or ""
+        self.prompt_version = prompt_version
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS extractions (
+                    cache_key TEXT PRIMARY KEY,
+                    pdf_hash TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    schema_hash TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_lru ON extractions (last_used)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def key_for(self, file_path, schema_hash):
+        """
+        Builds the cache key for a PDF under the current model, prompt, schema
+        (`schema_hash` of the registry snapshot in use) and input signature.
+        Returns None if the file cannot be read.
+        """
+        try:
+            pdf_hash = hash_file(file_path)
+        except OSError as e:
+            print(f"   > ⚠️ Cache: could not hash {file_path}: {e}")
+            return None
+
+        key = f"{pdf_hash}:{self.model_name}:{self.prompt_version}:{schema_hash}:{input_signature(file_path)}"
+        return {"cache_key": key, "pdf_hash": pdf_hash, "schema_hash": schema_hash}
+
+    def get(self, key):
+        """
+        Returns (invoices_list, usage_stats) for a cached extraction, or None.
+        """
+        if not key:
+            self.misses += 1
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT payload FROM extractions WHERE cache_key = ?", (key["cache_key"],)
+                ).fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE extractions SET last_used = ? WHERE cache_key = ?",
+                        (time.time(), key["cache_key"]),
+                    )
+        except sqlite3.Error as e:
+            print(f"   > ⚠️ Cache read failed: {e}")
+            row = None
+
+        if not row:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        payload = json.loads(row[0])
+        usage_stats = payload.get("usage_stats") or {}
+        usage_stats["cache_hit"] = True
+        return payload.get("invoices", []), usage_stats
+
+    def put(self, key, invoices_list, usage_stats):
+        """
+        Stores a successful extraction and evicts LRU entries over the size budget.
+        A truncated extraction is not stored, so the next run tries for all of it.
+        """
+        if not key or not invoices_list or (usage_stats or {}).get("truncated"):
+            return
+        payload = json.dumps(
+            {"invoices": invoices_list, "usage_stats": usage_stats or {}},
+            ensure_ascii=False,
+            default=str,
+        )
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO extractions
+                        (cache_key, pdf_hash, model_name, prompt_version, schema_hash,
+                         payload, size_bytes, created_at, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        key["cache_key"], key["pdf_hash"], self.model_name, self.prompt_version,
+                        key["schema_hash"], payload, len(payload.encode("utf-8")), now, now,
+                    ),
+                )
+                self._evict(conn)
+        except sqlite3.Error as e:
+            print(f"   > ⚠️ Cache write failed: {e}")
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM extractions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for cache_key, size_bytes in conn.execute(
+            "SELECT cache_key, size_bytes FROM extractions ORDER BY last_used ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM extractions WHERE cache_key = ?", (cache_key,))
+            total -= size_bytes
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+extraction_cache = ExtractionCache()
@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+from config.settings import GLOBAL_MAX_CONCURRENT_CALLS, USER_SHARE_WEIGHTS
+from core.key_scheduler import key_scheduler
+
+
+class FairScheduler:
+    """
+    Process-wide admission control for Gemini calls across every session.
+
+    The number of calls in flight is capped by GLOBAL_MAX_CONCURRENT_CALLS and
+    by the current AIMD limit of the key scheduler. Waiting jobs are queued per
+    user: the next slot goes to the backlogged user with the smallest virtual
+    time (weighted fair queuing, charged by page count / weight), and within a
+    user to the job with the fewest pages (shortest job first).
+    """
+
+    def __init__(self, limiter=None, max_concurrent=GLOBAL_MAX_CONCURRENT_CALLS, weights=USER_SHARE_WEIGHTS):
+        self.limiter = limiter
+        self.max_concurrent = max(1, max_concurrent)
+        self.weights = dict(weights or {})
+        self.in_flight = 0
+        self._queues = {}
+        self._virtual_time = {}
+        self._sequence = itertools.count()
+        self._session_waits = {}
+        self._recent_waits = []
+
+    def capacity(self):
+        if self.limiter is None:
+            return self.max_concurrent
+        return max(1, min(self.max_concurrent, int(self.limiter.limit)))
+
+    def _global_virtual_time(self):
+        backlogged = [self._virtual_time[user] for user, queue in self._queues.items() if queue]
+        return min(backlogged) if backlogged else max(self._virtual_time.values(), default=0.0)
+
+    def _dispatch(self):
+        while self.in_flight < self.capacity():
+            backlogged = [user for user, queue in self._queues.items() if queue]
+            if not backlogged:
+                return
+            user = min(backlogged, key=lambda u: self._virtual_time[u])
+            job_size, _, waiter = heapq.heappop(self._queues[user])
+            if waiter["future"].done():
+                continue
+            self._virtual_time[user] += job_size / self.weights.get(user, 1.0)
+            self.in_flight += 1
+            waiter["future"].set_result(None)
+
+    def _record_wait(self, session_key, wait_s):
+        self._recent_waits = (self._recent_waits + [wait_s])[-200:]
+        stats = self._session_waits.setdefault(session_key, {"jobs": 0, "total_wait_s": 0.0, "max_wait_s": 0.0})
+        stats["jobs"] += 1
+        stats["total_wait_s"] += wait_s
+        stats["max_wait_s"] = max(stats["max_wait_s"], wait_s)
+
+    @asynccontextmanager
+    async def slot(self, user_id, job_size=1, session_key=None):
+        """
+        Waits for a fair share slot, then holds it for the duration of the block.
+        """
+        queue = self._queues.setdefault(user_id, [])
+        if not queue:
+            # A user returning from idle must not spend credit banked while away.
+            self._virtual_time[user_id] = max(self._virtual_time.get(user_id, 0.0), self._global_virtual_time())
+
+        waiter = {
+            "future": asyncio.get_running_loop().create_future(),
+            "session_key": session_key,
+            "enqueued_at": time.monotonic(),
+        }
+        heapq.heappush(queue, (max(1, job_size), next(self._sequence), waiter))
+        self._dispatch()
+
+        try:
+            await waiter["future"]
+        except asyncio.CancelledError:
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                self.in_flight -= 1
+                self._dispatch()
+            else:
+                self._queues[user_id] = [entry for entry in queue if entry[2] is not waiter]
+                heapq.heapify(self._queues[user_id])
+            raise
+
+        self._record_wait(session_key, time.monotonic() - waiter["enqueued_at"])
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._dispatch()
+
+    def snapshot(self, session_key=None):
+        """
+        Queue depth and wait times, overall and (optionally) for one session.
+        """
+        now = time.monotonic()
+        waiting = [entry[2] for queue in self._queues.values() for entry in queue if not entry[2]["future"].done()]
+        recent = self._recent_waits
+        data = {
+            "queue_depth": len(waiting),
+            "in_flight": self.in_flight,
+            "capacity": self.capacity(),
+            "avg_wait_s": round(sum(recent) / len(recent), 2) if recent else 0.0,
+            "max_wait_s": round(max(recent), 2) if recent else 0.0,
+        }
+        if session_key is not None:
+            mine = [w for w in waiting if w["session_key"] == session_key]
+            session_stats = self._session_waits.get(session_key, {})
+            jobs = session_stats.get("jobs", 0)
+            data["session"] = {
+                "waiting": len(mine),
+                "oldest_wait_s": round(max((now - w["enqueued_at"] for w in mine), default=0.0), 2),
+                "started": jobs,
+                "avg_wait_s": round(session_stats["total_wait_s"] / jobs, 2) if jobs else 0.0,
+                "max_wait_s": round(session_stats.get("max_wait_s", 0.0), 2),
+            }
+        return data
+
+    def forget_session(self, session_key):
+        self._session_waits.pop(session_key, None)
+
+
+# One scheduler for every session of the process: global cap on Gemini calls (bounded by
+# the AIMD limit), fair share across user_ids, shortest job (fewest pages) first per user.
+fair_scheduler = FairScheduler(limiter=key_scheduler.concurrency)
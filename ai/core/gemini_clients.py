@@ -0,0 +1,45 @@
+from google import genai
+
+from config.settings import GEMINI_API_KEYS
+
+
+class GeminiClientPool:
+    """
+    Long-lived genai.Client per API key, shared by every session in the process.
+    Reusing a client keeps its HTTP connections (and TLS sessions) warm across
+    files and retries instead of paying the setup cost on every attempt.
+    """
+
+    def __init__(self, api_keys=GEMINI_API_KEYS):
+        self.api_keys = list(api_keys)
+        self._clients = {}
+
+    def start(self):
+        """
+        Creates a client for every configured key up front.
+        """
+        for api_key in self.api_keys:
+            self.get(api_key)
+
+    def get(self, api_key):
+        client = self._clients.get(api_key)
+        if client is None:
+            client = genai.Client(api_key=api_key, vertexai=False)
+            self._clients[api_key] = client
+        return client
+
+    async def aclose(self):
+        """
+        Closes the async and sync transports of every pooled client.
+        """
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            try:
+                await client.aio.aclose()
+                client.close()
+            except Exception as e:
+                print(f"   > ⚠️ Error closing Gemini client: {e}")
+
+
+gemini_clients = GeminiClientPool()
@@ -0,0 +1,303 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from config.settings import JOB_QUEUE_FILE, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS
+
+# A file is finished once it is "done" or "failed"; a job is ready for its report then.
+UNFINISHED_FILE_STATUSES = ("pending", "leased")
+
+
+class JobQueue:
+    """
+    Durable queue of extraction jobs, in one SQLite file (WAL) shared by the API
+    and the worker processes.
+
+    A job is one /extract session; its work items are the uploaded files. Workers
+    lease files for `lease_seconds` and keep the lease alive with heartbeats; a
+    lease that runs out (worker killed, OOM, redeploy) makes the file available
+    again. The extracted invoices and usage of every finished file are stored
+    here, so a restarted job only runs its unfinished files and nothing already
+    extracted is billed twice. When the last file finishes, one worker claims the
+    job (with the same lease scheme) and writes its report.
+    """
+
+    def __init__(self, db_path=JOB_QUEUE_FILE, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._connect(transaction=False) as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    report_path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    file_path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    invoices TEXT,
+                    stats TEXT,
+                    message TEXT,
+                    PRIMARY KEY (job_id, position)
+                );
+                CREATE INDEX IF NOT EXISTS idx_job_files_status ON job_files (status, lease_expires);
+                """
+            )
+
+    @contextmanager
+    def _connect(self, transaction=True):
+        # Every operation takes the write lock up front, so two workers never lease the same file.
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if not transaction:
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def enqueue(self, job_id, user_id, session_id, file_paths, report_path):
+        """
+        Queues a job, replacing any earlier job with the same id (a restarted session).
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO jobs
+                    (job_id, user_id, session_id, report_path, status, lease_owner, lease_expires, error,
+                     created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'queued', NULL, NULL, NULL, ?, ?)
+                """,
+                (job_id, user_id, session_id, report_path, now, now),
+            )
+            conn.executemany(
+                "INSERT INTO job_files (job_id, position, file_path, status) VALUES (?, ?, ?, 'pending')",
+                [(job_id, i, path) for i, path in enumerate(file_paths)],
+            )
+
+    def lease_files(self, worker_id, limit):
+        """
+        Leases up to `limit` pending (or abandoned) files, oldest job first.
+        Files that already used up their attempts are failed instead.
+        Returns a list of {"job_id", "position", "file_path", "user_id", "session_id", "report_path", "attempts"}.
+        """
+        if limit <= 0:
+            return []
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT f.job_id, f.position, f.file_path, f.attempts, j.user_id, j.session_id, j.report_path
+                FROM job_files f JOIN jobs j ON j.job_id = f.job_id
+                WHERE f.status = 'pending' OR (f.status = 'leased' AND f.lease_expires < ?)
+                ORDER BY j.created_at, f.position
+                LIMIT ?
+                """,
+                (now, limit),
+            ).fetchall()
+
+            leased = []
+            for job_id, position, file_path, attempts, user_id, session_id, report_path in rows:
+                if attempts >= self.max_attempts:
+                    conn.execute(
+                        "UPDATE job_files SET status = 'failed', lease_owner = NULL, message = ? "
+                        "WHERE job_id = ? AND position = ?",
+                        (f"Error: gave up after {attempts} attempts", job_id, position),
+                    )
+                    continue
+                conn.execute(
+                    """
+                    UPDATE job_files SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1
+                    WHERE job_id = ? AND position = ?
+                    """,
+                    (worker_id, now + self.lease_seconds, job_id, position),
+                )
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', updated_at = ? WHERE job_id = ? AND status = 'queued'",
+                    (now, job_id),
+                )
+                leased.append({
+                    "job_id": job_id, "position": position, "file_path": file_path,
+                    "user_id": user_id, "session_id": session_id, "report_path": report_path,
+                    "attempts": attempts + 1,
+                })
+        return leased
+
+    def heartbeat(self, worker_id, files=()):
+        """
+        Extends the leases `worker_id` holds on `files` ((job_id, position) pairs it is
+        still processing) and on the jobs it is writing. Leases on any other file are
+        left to run out, so a file the worker lost track of is retried.
+        """
+        expires = time.time() + self.lease_seconds
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE job_files SET lease_expires = ? "
+                "WHERE job_id = ? AND position = ? AND lease_owner = ? AND status = 'leased'",
+                [(expires, job_id, position, worker_id) for job_id, position in files],
+            )
+            conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE lease_owner = ? AND status = 'writing'",
+                (expires, worker_id),
+            )
+
+    def complete_file(self, job_id, position, worker_id, invoices, stats, message, failed=False):
+        """
+        Stores the outcome of a leased file. Returns False when the lease was lost
+        (expired and taken over, or the job was replaced); the outcome is then dropped.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE job_files SET status = ?, lease_owner = NULL, lease_expires = NULL,
+                    invoices = ?, stats = ?, message = ?
+                WHERE job_id = ? AND position = ? AND status = 'leased' AND lease_owner = ?
+                """,
+                (
+                    "failed" if failed else "done",
+                    json.dumps(invoices, ensure_ascii=False) if invoices is not None else None,
+                    json.dumps(stats) if stats is not None else None,
+                    message, job_id, position, worker_id,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def abandon_file(self, job_id, position, worker_id, error=None):
+        """
+        Gives up a leased file after its processing raised. The attempt taken by the
+        lease stays used: the file goes back to pending, or is failed once it used up
+        `max_attempts`. Returns False when the lease was already lost.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE job_files SET
+                    status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    message = CASE WHEN attempts >= ? THEN ? ELSE message END,
+                    lease_owner = NULL, lease_expires = NULL
+                WHERE job_id = ? AND position = ? AND status = 'leased' AND lease_owner = ?
+                """,
+                (
+                    self.max_attempts, self.max_attempts, f"Error: {error or 'processing failed'}",
+                    job_id, position, worker_id,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, worker_id):
+        """
+        Hands every lease of `worker_id` back, e.g. on shutdown, without using up an attempt.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE job_files SET status = 'pending', lease_owner = NULL, lease_expires = NULL,
+                    attempts = MAX(attempts - 1, 0)
+                WHERE lease_owner = ? AND status = 'leased'
+                """,
+                (worker_id,),
+            )
+            conn.execute(
+                "UPDATE jobs SET status = 'running', lease_owner = NULL, lease_expires = NULL "
+                "WHERE lease_owner = ? AND status = 'writing'",
+                (worker_id,),
+            )
+
+    def claim_finished_job(self, worker_id):
+        """
+        Claims one job whose files are all finished (or whose report writer vanished)
+        for writing its report. Returns {"job_id", "user_id", "session_id", "report_path"} or None.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                f"""
+                SELECT job_id, user_id, session_id, report_path FROM jobs j
+                WHERE (status IN ('queued', 'running') OR (status = 'writing' AND lease_expires < ?))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM job_files f
+                      WHERE f.job_id = j.job_id AND f.status IN {UNFINISHED_FILE_STATUSES}
+                  )
+                ORDER BY created_at LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'writing', lease_owner = ?, lease_expires = ?, updated_at = ? WHERE job_id = ?",
+                (worker_id, now + self.lease_seconds, now, row[0]),
+            )
+        return {"job_id": row[0], "user_id": row[1], "session_id": row[2], "report_path": row[3]}
+
+    def file_results(self, job_id):
+        """
+        Finished files of a job in upload order: [{"file_path", "status", "invoices", "stats", "message"}].
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT file_path, status, invoices, stats, message FROM job_files
+                WHERE job_id = ? AND status IN ('done', 'failed') ORDER BY position
+                """,
+                (job_id,),
+            ).fetchall()
+        return [
+            {
+                "file_path": path, "status": status, "message": message,
+                "invoices": json.loads(invoices) if invoices else None,
+                "stats": json.loads(stats) if stats else None,
+            }
+            for path, status, invoices, stats, message in rows
+        ]
+
+    def finish_job(self, job_id, worker_id, error=None):
+        """
+        Marks a claimed job completed (or failed with `error`).
+        """
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE jobs SET status = ?, error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ?
+                WHERE job_id = ? AND lease_owner = ?
+                """,
+                ("failed" if error else "completed", error, time.time(), job_id, worker_id),
+            )
+
+    def counts(self):
+        """
+        Number of files per status, for monitoring.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM job_files GROUP BY status").fetchall()
+        return dict(rows)
+
+
+job_queue = JobQueue()
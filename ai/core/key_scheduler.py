@@ -0,0 +1,332 @@
+import asyncio
+import time
+
+from config.settings import (
+    GEMINI_API_KEYS, GEMINI_RPM_PER_KEY, GEMINI_TPM_PER_KEY,
+    GEMINI_MIN_CONCURRENCY, GEMINI_INITIAL_CONCURRENCY, GEMINI_MAX_CONCURRENCY,
+)
+
+# Rough request size used for TPM accounting before the real usage is known.
+TOKENS_PER_IMAGE_ESTIMATE = 1500
+TOKENS_PER_PDF_ESTIMATE = 6000
+OUTPUT_TOKENS_ESTIMATE = 4000
+
+THROTTLE_COOLDOWN = 5
+QUOTA_COOLDOWN = 600
+AUTH_COOLDOWN = 3600
+# Longest a request waits for a disabled key to come back before giving up.
+MAX_KEY_WAIT = 60
+
+
+class NoAvailableKeyError(Exception):
+    """
+    Raised when every API key is disabled by its circuit breaker.
+    """
+
+
+def classify_key_error(error):
+    """
+    Maps an exception from a Gemini call to how the key scheduler should react:
+    "throttled" (429), "quota" (quota exhausted), "auth" (invalid/forbidden key) or "other".
+    """
+    code = getattr(error, "code", None)
+    text = str(error).lower()
+    if code == 429 or "resource_exhausted" in text:
+        if "quota" in text and ("per day" in text or "perday" in text or "billing" in text):
+            return "quota"
+        return "throttled"
+    if code in (401, 403) or "api_key_invalid" in text or "api key not valid" in text or "permission_denied" in text:
+        return "auth"
+    return "other"
+
+
+def estimate_request_tokens(parts, prompt):
+    """
+    Estimates total (input + output) tokens of a request for TPM accounting.
+    """
+    tokens = len(prompt) // 4 + OUTPUT_TOKENS_ESTIMATE
+    for part in parts:
+        text = getattr(part, "text", None)
+        inline = getattr(part, "inline_data", None)
+        if text:
+            tokens += len(text) // 4
+        elif inline is not None and getattr(inline, "mime_type", "") == "application/pdf":
+            tokens += TOKENS_PER_PDF_ESTIMATE
+        else:
+            tokens += TOKENS_PER_IMAGE_ESTIMATE
+    return tokens
+
+
+class TokenBucket:
+    """
+    Classic token bucket refilled continuously at `rate_per_minute`.
+    The balance may go negative when actual usage exceeds the estimate,
+    which simply delays the next request on that key.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(max(1, rate_per_minute))
+        self.tokens = self.capacity
+        self.refill_per_second = self.capacity / 60.0
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """
+        Seconds until `amount` tokens are available (0 if available now).
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def drain(self):
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class CircuitBreaker:
+    """
+    Closed -> open on a quota/auth failure -> half-open after the cooldown,
+    where a single trial request decides whether to close or re-open (with a
+    doubled cooldown).
+    """
+
+    def __init__(self):
+        self.state = "closed"
+        self.open_until = 0.0
+        self.cooldown = 0.0
+        self.trial_in_flight = False
+
+    def allows_request(self):
+        if self.state == "open" and time.monotonic() >= self.open_until:
+            self.state = "half_open"
+        if self.state == "closed":
+            return True
+        return self.state == "half_open" and not self.trial_in_flight
+
+    def on_request(self):
+        if self.state == "half_open":
+            self.trial_in_flight = True
+
+    def on_success(self):
+        # A request started before the breaker tripped does not prove the key recovered.
+        if self.state == "open":
+            return
+        self.state = "closed"
+        self.cooldown = 0.0
+        self.trial_in_flight = False
+
+    def trip(self, cooldown):
+        if self.state == "half_open":
+            cooldown = max(cooldown, self.cooldown * 2)
+        self.state = "open"
+        self.cooldown = cooldown
+        self.open_until = time.monotonic() + cooldown
+        self.trial_in_flight = False
+
+    def release_trial(self):
+        self.trial_in_flight = False
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Process-wide cap on concurrent Gemini calls, adapted with AIMD:
+    the limit grows by ~1 per window of successful calls and halves on a 429.
+    Usable as `async with limiter:` in place of an asyncio.Semaphore.
+    """
+
+    def __init__(self, initial=GEMINI_INITIAL_CONCURRENCY, minimum=GEMINI_MIN_CONCURRENCY,
+                 maximum=GEMINI_MAX_CONCURRENCY):
+        self.min_limit = max(1, minimum)
+        self.max_limit = max(self.min_limit, maximum)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = None
+
+    def _get_condition(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def __aenter__(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self._notify()
+
+    def on_throttle(self):
+        # A burst of 429s from one overload should only halve the limit once.
+        now = time.monotonic()
+        if now - self._last_decrease < THROTTLE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit / 2)
+
+    def _notify(self):
+        condition = self._condition
+        if condition is None:
+            return
+
+        async def wake():
+            async with condition:
+                condition.notify_all()
+
+        try:
+            asyncio.get_running_loop().create_task(wake())
+        except RuntimeError:
+            pass
+
+
+class KeyLease:
+    """
+    One request's claim on an API key, returned by KeyScheduler.acquire.
+    """
+
+    def __init__(self, key_state, estimated_tokens):
+        self.key_state = key_state
+        self.api_key = key_state.api_key
+        self.label = key_state.label
+        self.estimated_tokens = estimated_tokens
+
+
+class KeyState:
+    def __init__(self, index, api_key, rpm, tpm):
+        self.api_key = api_key
+        self.label = f"key#{index + 1}"
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.breaker = CircuitBreaker()
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+
+
+class KeyScheduler:
+    """
+    Spreads Gemini requests across every configured API key.
+
+    Each key has token buckets for requests/minute and tokens/minute and a
+    circuit breaker that takes keys with exhausted quota or bad credentials out
+    of rotation. Among usable keys the least busy one is picked, so load is
+    balanced instead of hammering the first key until it fails.
+    """
+
+    def __init__(self, api_keys=GEMINI_API_KEYS, rpm=GEMINI_RPM_PER_KEY, tpm=GEMINI_TPM_PER_KEY):
+        self.keys = [KeyState(i, key, rpm, tpm) for i, key in enumerate(api_keys)]
+        self.concurrency = AdaptiveConcurrencyLimiter()
+
+    async def acquire(self, estimated_tokens, exclude=()):
+        """
+        Waits until some key has request and token budget, then leases it.
+        Keys whose api_key is in `exclude` are skipped while others are usable.
+        Raises NoAvailableKeyError if every key stays disabled beyond MAX_KEY_WAIT.
+        """
+        while True:
+            usable = [k for k in self.keys if k.breaker.allows_request()]
+            preferred = [k for k in usable if k.api_key not in exclude] or usable
+            if not preferred:
+                if not self.keys:
+                    raise NoAvailableKeyError("No Gemini API keys configured.")
+                reopen = min(k.breaker.open_until for k in self.keys) - time.monotonic()
+                if reopen > MAX_KEY_WAIT:
+                    raise NoAvailableKeyError("All Gemini API keys are disabled.")
+                await asyncio.sleep(max(0.05, reopen))
+                continue
+
+            waits = {
+                id(k): max(k.requests.wait_time(1), k.tokens.wait_time(estimated_tokens))
+                for k in preferred
+            }
+            ready = [k for k in preferred if waits[id(k)] == 0]
+            if ready:
+                chosen = min(ready, key=lambda k: (k.in_flight, -k.tokens.tokens))
+                chosen.requests.consume(1)
+                chosen.tokens.consume(estimated_tokens)
+                chosen.breaker.on_request()
+                chosen.in_flight += 1
+                return KeyLease(chosen, estimated_tokens)
+
+            await asyncio.sleep(max(0.05, min(waits.values())))
+
+    def release(self, lease):
+        """
+        Returns a lease whose request was cancelled, without judging the key.
+        """
+        lease.key_state.in_flight -= 1
+        lease.key_state.breaker.release_trial()
+
+    def report_success(self, lease, actual_tokens=None):
+        state = lease.key_state
+        state.in_flight -= 1
+        state.successes += 1
+        if actual_tokens is not None:
+            state.tokens.consume(actual_tokens - lease.estimated_tokens)
+        state.breaker.on_success()
+        self.concurrency.on_success()
+
+    def report_failure(self, lease, error, retry_after=None):
+        """
+        Updates the key's buckets/breaker and the AIMD limit for a failed call.
+        A throttled key with a server-given `retry_after` is rested for that long.
+        Returns the error class from classify_key_error.
+        """
+        state = lease.key_state
+        state.in_flight -= 1
+        state.failures += 1
+        kind = classify_key_error(error)
+        if kind == "throttled":
+            state.requests.drain()
+            state.breaker.release_trial()
+            self.concurrency.on_throttle()
+            if retry_after:
+                state.breaker.trip(retry_after)
+        elif kind == "quota":
+            state.breaker.trip(QUOTA_COOLDOWN)
+            print(f"   > 🔌 {state.label} quota exhausted; disabled for {int(state.breaker.cooldown)}s.")
+        elif kind == "auth":
+            state.breaker.trip(AUTH_COOLDOWN)
+            print(f"   > 🔌 {state.label} rejected (auth); disabled for {int(state.breaker.cooldown)}s.")
+        else:
+            state.breaker.release_trial()
+        return kind
+
+    def snapshot(self):
+        return {
+            "concurrency_limit": int(self.concurrency.limit),
+            "in_flight": self.concurrency.in_flight,
+            "keys": [
+                {
+                    "key": k.label,
+                    "state": k.breaker.state,
+                    "in_flight": k.in_flight,
+                    "successes": k.successes,
+                    "failures": k.failures,
+                }
+                for k in self.keys
+            ],
+        }
+
+
+key_scheduler = KeyScheduler()
@@ -0,0 +1,208 @@
+import json
+import re
+from collections import Counter
+
+from config.settings import PAGE_WINDOW_SIZE, PAGE_WINDOW_MIN_PAGES
+from core.pdf_utils import TextPage, PdfDocument
+
+# Keys the model uses for the line-item array, as accepted by the Excel flattener.
+LINE_ITEM_KEYS = ("Line Items", "items", "line_items")
+
+# Row number printed on the invoice, requested from window calls to deduplicate
+# line items; dropped again once the windows are merged.
+ROW_NUMBER_KEY = "Sr. No."
+
+# Only the top of a text page is searched, where invoice headers are printed.
+HEADER_LINES = 25
+INVOICE_NUMBER_PATTERN = re.compile(
+    r"\binvoice\s*(?:no|number|#)\.?\s*[:\-]?\s*([A-Z0-9][A-Z0-9/\-]{2,})", re.IGNORECASE
+)
+
+
+def _page_invoice_number(page):
+    """
+    Invoice number printed in the header of a text page, or None (raster pages,
+    continuation pages without a header).
+    """
+    if not isinstance(page, TextPage):
+        return None
+    header = "\n".join(page.text.splitlines()[:HEADER_LINES])
+    match = INVOICE_NUMBER_PATTERN.search(header)
+    return match.group(1).upper() if match else None
+
+
+def invoice_boundaries(pages):
+    """
+    Indexes of pages that start a different invoice than the page before,
+    judged by the invoice number in the page header. Repeated headers of the
+    same invoice on every page are not boundaries.
+    """
+    boundaries = set()
+    previous = None
+    for i, page in enumerate(pages):
+        number = _page_invoice_number(page)
+        if number and previous and number != previous:
+            boundaries.add(i)
+        if number:
+            previous = number
+    return boundaries
+
+
+def plan_page_windows(pages, window_size=PAGE_WINDOW_SIZE, min_pages=PAGE_WINDOW_MIN_PAGES):
+    """
+    Splits a document into (start, end) page ranges of at most `window_size`
+    pages. A window is cut at the last invoice boundary inside it when there is
+    one, so bundled invoices are not split across calls. Returns a single window
+    when the document is short, splitting is disabled, or it is a raw PDF part.
+    """
+    count = len(pages)
+    if (window_size <= 0 or count <= max(window_size, min_pages)
+            or any(isinstance(page, PdfDocument) for page in pages)):
+        return [(0, count)]
+
+    boundaries = invoice_boundaries(pages)
+    windows = []
+    start = 0
+    while start < count:
+        end = min(start + window_size, count)
+        if end < count:
+            cut = max((b for b in boundaries if start < b <= end), default=None)
+            if cut is not None:
+                end = cut
+        windows.append((start, end))
+        start = end
+    return windows
+
+
+def window_note(start, end, total, with_row_numbers):
+    """
+    Instructions sent with one window, ahead of its pages.
+    """
+    note = (
+        f"--- DOCUMENT WINDOW: pages {start + 1}-{end} of a {total}-page PDF. The other pages are "
+        "extracted separately and merged by Invoice No. Extract every invoice and every table row "
+        "that appears on THESE pages only. Fill header fields only from what these pages show and "
+        "leave the rest empty; always give the Invoice No when it is printed on these pages. ---"
+    )
+    if with_row_numbers:
+        note += f' Add "{ROW_NUMBER_KEY}" to every line item with the row number printed in the table.'
+    return note
+
+
+def _line_items_key(invoice):
+    return next((key for key in LINE_ITEM_KEYS if isinstance(invoice.get(key), list)), None)
+
+
+def _invoice_key(invoice):
+    number = str(invoice.get("Invoice No") or "").strip().upper()
+    return re.sub(r"\s+", "", number) or None
+
+
+def _filled(value):
+    return value not in (None, "", [], {})
+
+
+def _item_key(item, position):
+    # Without a printed row number every row is kept: identical rows are legitimate on invoices.
+    row = item.get(ROW_NUMBER_KEY)
+    if _filled(row):
+        return ("row", str(row).strip())
+    return ("position", position)
+
+
+def _reconcile(values):
+    """
+    Header value agreed by most windows; the earliest one wins a tie.
+    """
+    filled = [v for v in values if _filled(v)]
+    if not filled:
+        return values[0] if values else ""
+    counts = Counter(json.dumps(v, sort_keys=True, default=str) for v in filled)
+    best = max(counts.values())
+    return next(v for v in filled if counts[json.dumps(v, sort_keys=True, default=str)] == best)
+
+
+def merge_window_results(window_results):
+    """
+    Merges the invoice lists of consecutive windows into one list.
+
+    Invoices are matched by Invoice No; one without a number (a continuation
+    page with no header) belongs to the invoice before it. Header fields are
+    reconciled by majority across windows, and line items are concatenated in
+    page order, deduplicated by their printed row number.
+    """
+    merged = {}  # invoice key -> {"headers": {field: [values]}, "items": {item key: item}, "items_key"}
+    order = []
+    last_key = None
+    position = 0
+
+    for invoices in window_results:
+        for invoice in invoices or []:
+            key = _invoice_key(invoice)
+            if key is None:
+                key = last_key if last_key is not None else ("unnumbered", len(order))
+            if key not in merged:
+                merged[key] = {"headers": {}, "items": {}, "items_key": None}
+                order.append(key)
+            entry = merged[key]
+
+            items_key = _line_items_key(invoice)
+            if items_key:
+                entry["items_key"] = entry["items_key"] or items_key
+                for item in invoice[items_key]:
+                    if not isinstance(item, dict):
+                        continue
+                    position += 1
+                    item_key = _item_key(item, position)
+                    seen = entry["items"].get(item_key)
+                    # A row reported by two windows is kept in its most complete form.
+                    if seen is None or sum(map(_filled, item.values())) > sum(map(_filled, seen.values())):
+                        entry["items"][item_key] = item
+
+            for field, value in invoice.items():
+                if field not in LINE_ITEM_KEYS:
+                    entry["headers"].setdefault(field, []).append(value)
+            last_key = key
+
+    results = []
+    for key in order:
+        entry = merged[key]
+        invoice = {field: _reconcile(values) for field, values in entry["headers"].items()}
+        if entry["items_key"]:
+            items = []
+            for item in entry["items"].values():
+                item = dict(item)
+                item.pop(ROW_NUMBER_KEY, None)
+                items.append(item)
+            invoice[entry["items_key"]] = items
+        results.append(invoice)
+    return results
+
+
+def merge_usage_stats(window_stats, latency_s):
+    """
+    Adds up the usage of every window call into one stats dict for the document.
+    """
+    totals = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "text_pages": 0, "image_pages": 0,
+              "continuations": 0}
+    saved = 0
+    hedged = 0
+    modes = set()
+    for stats in window_stats:
+        for key in totals:
+            totals[key] += stats.get(key) or 0
+        saved += stats.get("output_tokens_saved_est") or 0
+        hedged += stats.get("hedge_cancelled_tokens_est") or 0
+        modes.add(stats.get("input_mode"))
+
+    merged = {**window_stats[0], **totals}
+    merged["input_mode"] = modes.pop() if len(modes) == 1 else "mixed"
+    merged["latency_s"] = latency_s
+    merged["windows"] = len(window_stats)
+    if any(stats.get("truncated") for stats in window_stats):
+        merged["truncated"] = True
+    if saved:
+        merged["output_tokens_saved_est"] = saved
+    if hedged:
+        merged["hedge_cancelled_tokens_est"] = hedged
+    return merged
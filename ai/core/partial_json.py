@@ -0,0 +1,50 @@
+import json
+
+CLOSERS = {"{": "}", "[": "]"}
+
+
+def loads_partial(text):
+    """
+    Parses JSON that may have been cut off mid-way (a response that hit the
+    output token limit).
+
+    Returns (data, truncated). Complete JSON is parsed as is. Otherwise the text
+    is cut after the last object or array that was closed, the containers still
+    open at that point are closed, and whatever parses is returned; an element
+    that was only half written is dropped. (None, True) if nothing complete is left.
+    """
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError:
+        pass
+
+    # One pass over the text records, for every position where an object or
+    # array closes, the closers that would make the text up to there valid.
+    stack = []
+    cut_points = []
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in CLOSERS:
+            stack.append(CLOSERS[ch])
+        elif ch in "}]":
+            if not stack or stack[-1] != ch:
+                break
+            stack.pop()
+            cut_points.append((i, "".join(reversed(stack))))
+
+    for i, closers in reversed(cut_points):
+        try:
+            return json.loads(text[:i + 1] + closers), True
+        except json.JSONDecodeError:
+            continue
+    return None, True
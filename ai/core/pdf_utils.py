@@ -1,9 +1,51 @@
 import os
-from pdf2image import convert_from_path
+import io
+import re
+import string
+import asyncio
+import tempfile
+import subprocess
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from pdf2image import convert_from_path, pdfinfo_from_path
 from dotenv import load_dotenv
 
+from core.schema_manager import load_input_modes
+from config.settings import (
+    RASTER_WORKERS, RASTER_MODE, RASTER_DPI, RASTER_GRAYSCALE,
+    RASTER_MAX_DIMENSION, RASTER_FORMAT, RASTER_MEMORY_BUDGET_MB,
+    EXTRACTION_INPUT_MODE, TEXT_LAYER_MIN_CHARS,
+)
+
 load_dotenv()
 
+_raster_pool = None
+
+# One encoded page image, ready to be sent to the model as an inline part.
+RasterPage = namedtuple("RasterPage", ["page_number", "data", "mime_type"])
+
+# The native text layer of one page, with poppler's layout-preserving spacing.
+TextPage = namedtuple("TextPage", ["page_number", "text"])
+
+# The whole PDF, sent to the model as a single application/pdf part.
+PdfDocument = namedtuple("PdfDocument", ["data", "page_count"])
+
+# A page that still has to be rasterized; PageStream renders it when it is reached.
+PendingPage = namedtuple("PendingPage", ["page_number"])
+
+INPUT_MODES = ("auto", "image", "pdf")
+
+RASTER_MIME_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+# Most pages rendered by one poppler call, which bounds the temporary files on disk.
+RENDER_RUN_PAGES = 16
+# Runs a PageStream has rendering in the pool ahead of the page being consumed.
+RENDER_RUNS_AHEAD = 2
+
+PAGE_SIZE_PATTERN = re.compile(r"^Page\s+(\d+)\s+size:\s+([\d.]+)\s+x\s+([\d.]+)", re.MULTILINE)
+
 def convert_pdf_to_images(pdf_path):
     """
     Converts all pages of a PDF file into a list of PIL Images.
@@ -26,4 +68,343 @@ def convert_pdf_to_images(pdf_path):
         
     except Exception as e:
         print(f"   > ❌ Error converting PDF to images: {e}")
-        return []
\ No newline at end of file
+        return []
+
+def _max_page_bytes(grayscale, max_dimension, dpi):
+    """
+    Largest decoded bitmap of one page: neither side exceeds `max_dimension`
+    pixels (see _render_dpis). Without a cap, an A4 page rendered at `dpi`.
+    """
+    channels = 1 if grayscale else 3
+    if max_dimension:
+        return max_dimension * max_dimension * channels
+    return int((595 / 72 * dpi) * (842 / 72 * dpi) * channels)
+
+def raster_worker_count():
+    """
+    Size of the rasterization pool: RASTER_WORKERS, lowered so that the largest
+    decoded page of every worker fits in RASTER_MEMORY_BUDGET_MB. Each worker
+    decodes one page at a time (see iter_pdf_pages), so this bounds the bitmaps
+    in memory across all workers.
+    """
+    page_bytes = _max_page_bytes(RASTER_GRAYSCALE, RASTER_MAX_DIMENSION, RASTER_DPI)
+    fits = int(RASTER_MEMORY_BUDGET_MB * 1024 * 1024 // page_bytes)
+    return max(1, min(RASTER_WORKERS, fits))
+
+def _encode_page(image, page_number, fmt):
+    fmt = fmt if fmt in RASTER_MIME_TYPES else "png"
+    if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    save_kwargs = {"quality": 85} if fmt in ("jpeg", "webp") else {"optimize": True}
+    image.save(buffer, format=fmt.upper(), **save_kwargs)
+    return RasterPage(page_number, buffer.getvalue(), RASTER_MIME_TYPES[fmt])
+
+def _page_runs(page_numbers, dpis, max_run=RENDER_RUN_PAGES):
+    """
+    Groups sorted page numbers into (first, last) runs of consecutive pages
+    rendered at the same DPI, each at most `max_run` long.
+    """
+    runs = []
+    for number in sorted(set(page_numbers)):
+        if (runs and number == runs[-1][1] + 1 and number - runs[-1][0] < max_run
+                and dpis[number] == dpis[runs[-1][0]]):
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    return [tuple(run) for run in runs]
+
+def _page_sizes(pdf_path, first, last):
+    """
+    {page number: (width, height)} in points for pages first..last, from pdfinfo.
+    Empty if pdfinfo fails.
+    """
+    try:
+        result = subprocess.run(
+            ["pdfinfo", "-f", str(first), "-l", str(last), pdf_path],
+            capture_output=True, timeout=60, check=True,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"   > ⚠️ Page sizes unavailable, rendering at the configured DPI: {e}")
+        return {}
+    text = result.stdout.decode("utf-8", errors="replace")
+    return {int(n): (float(w), float(h)) for n, w, h in PAGE_SIZE_PATTERN.findall(text)}
+
+def _render_dpis(pdf_path, page_numbers, dpi, max_dimension):
+    """
+    DPI to render each page at: `dpi`, lowered for large pages so that poppler
+    decodes them with neither side above `max_dimension` pixels.
+    """
+    dpis = dict.fromkeys(page_numbers, dpi)
+    if not max_dimension or not dpis:
+        return dpis
+    for number, size in _page_sizes(pdf_path, min(dpis), max(dpis)).items():
+        if number in dpis and max(size) > 0:
+            dpis[number] = max(1, min(dpi, int(max_dimension * 72 / max(size))))
+    return dpis
+
+def iter_pdf_pages(pdf_path, dpi=RASTER_DPI, grayscale=RASTER_GRAYSCALE,
+                   max_dimension=RASTER_MAX_DIMENSION, fmt=RASTER_FORMAT, page_numbers=None):
+    """
+    Lazily rasterizes a PDF.
+
+    Every page is rendered at `dpi`, or at the lower DPI that keeps both sides
+    within `max_dimension` pixels, so one decoded bitmap never exceeds that
+    bound. Consecutive pages are rendered by one poppler call per run of up to
+    RENDER_RUN_PAGES pages into a temporary folder (pdf2image runs pdfinfo and
+    pdftoppm for every call, so a call per page would spawn 2N processes). The
+    rendered files are then opened one at a time, encoded to `fmt` and deleted.
+    `page_numbers` limits rendering to those (1-based) pages.
+
+    Yields:
+        RasterPage: (page_number, encoded bytes, mime type).
+    """
+    if not os.path.exists(pdf_path):
+        print(f"   > ❌ Error: File not found at {pdf_path}")
+        return
+
+    if page_numbers is None:
+        page_count = int(pdfinfo_from_path(pdf_path).get("Pages", 0))
+        page_numbers = range(1, page_count + 1)
+    dpis = _render_dpis(pdf_path, page_numbers, dpi, max_dimension)
+
+    with tempfile.TemporaryDirectory(prefix="raster_") as folder:
+        for first, last in _page_runs(page_numbers, dpis):
+            paths = convert_from_path(
+                pdf_path, dpi=dpis[first], first_page=first, last_page=last, grayscale=grayscale,
+                output_folder=folder, paths_only=True,
+            )
+            for path in sorted(paths):
+                # pdf2image names the files <uuid>-<zero-padded page number>.<fmt>.
+                page_number = int(re.search(r"-(\d+)\.\w+$", path).group(1))
+                with Image.open(path) as image:
+                    if max_dimension:
+                        # Only trims poppler's rounding; the render itself is already bounded.
+                        image.thumbnail((max_dimension, max_dimension))
+                    page = _encode_page(image, page_number, fmt)
+                os.remove(path)
+                yield page
+
+def render_pages(pdf_path, page_numbers):
+    """
+    Rasterizes the given pages into a list of RasterPages (run in the process pool).
+    """
+    return list(iter_pdf_pages(pdf_path, page_numbers=page_numbers))
+
+def extract_text_layer(pdf_path):
+    """
+    Returns the native text of every page via poppler's `pdftotext -layout`,
+    which keeps table columns aligned with whitespace. Empty list if unavailable.
+    """
+    try:
+        result = subprocess.run(
+            ["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"],
+            capture_output=True, timeout=60, check=True,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"   > ⚠️ Text layer extraction failed: {e}")
+        return []
+
+    pages = result.stdout.decode("utf-8", errors="replace").split("\f")
+    # pdftotext terminates every page with a form feed, leaving an empty tail.
+    if pages and not pages[-1].strip():
+        pages = pages[:-1]
+    return pages
+
+def has_usable_text(text, min_chars=TEXT_LAYER_MIN_CHARS):
+    """
+    True when a page's text layer is long enough and mostly readable characters,
+    i.e. it is not a scan, an image-only page or a garbled font encoding.
+    """
+    visible = [c for c in text if not c.isspace()]
+    if len(visible) < min_chars:
+        return False
+    readable = sum(1 for c in visible if c.isalnum() or c in string.punctuation or c in "₹€£")
+    return readable / len(visible) >= 0.85 and text.count("\ufffd") < 5
+
+def _vendor_pattern(vendor):
+    """
+    Matches the vendor name as whole words: "HP" matches "hp_invoice_03.pdf"
+    and "HP Inc" matches "HP-Inc March.pdf", but "HP" does not match "shipment.pdf".
+    """
+    words = re.findall(r"[a-z0-9]+", vendor.lower())
+    if not words:
+        return None
+    return re.compile(r"(?<![a-z0-9])" + r"[^a-z0-9]+".join(map(re.escape, words)) + r"(?![a-z0-9])")
+
+def vendor_folder(vendor):
+    """
+    Folder name for the files of `vendor` ("HP Inc." -> "HP-Inc"), which
+    resolve_input_mode matches back to the vendor; None for an empty name.
+    """
+    words = re.findall(r"[A-Za-z0-9]+", vendor or "")
+    return "-".join(words) or None
+
+def resolve_input_mode(pdf_path):
+    """
+    Picks the input mode for a PDF: a vendor override from the registry's
+    INPUT_MODES when the vendor name is the PDF's folder or appears as whole
+    words in its file name, otherwise the deployment-wide EXTRACTION_INPUT_MODE.
+
+    The folder is the reliable signal: the CLI reads DATA_DIR/<vendor>/*.pdf,
+    and /extract stores the uploads of a request that names its `vendor` in
+    vendor_folder(vendor). The file name is a fallback for uploads without one.
+    """
+    folder = os.path.basename(os.path.dirname(pdf_path)).lower()
+    filename = os.path.splitext(os.path.basename(pdf_path))[0].lower()
+    for vendor, mode in load_input_modes().items():
+        pattern = _vendor_pattern(vendor)
+        if pattern and mode in INPUT_MODES and (pattern.fullmatch(folder) or pattern.search(filename)):
+            return mode
+    return EXTRACTION_INPUT_MODE if EXTRACTION_INPUT_MODE in INPUT_MODES else "auto"
+
+def input_signature(pdf_path):
+    """
+    Describes what the model is sent for a PDF: the resolved input mode and the
+    settings that shape its pages. Extractions are only reused under the same one.
+    """
+    input_mode = resolve_input_mode(pdf_path)
+    if input_mode == "pdf":
+        return "pdf"
+    if RASTER_MODE == "full":
+        raster = "full"
+    else:
+        raster = (f"{RASTER_FORMAT}-{RASTER_DPI}dpi-{RASTER_MAX_DIMENSION}px"
+                  f"-{'gray' if RASTER_GRAYSCALE else 'color'}")
+    if input_mode == "auto":
+        return f"auto-{TEXT_LAYER_MIN_CHARS}:{raster}"
+    return f"{input_mode}:{raster}"
+
+def plan_pdf_pages(pdf_path, input_mode=None):
+    """
+    Decides how each page of a PDF is sent to the model, without rasterizing.
+
+    In "auto" mode, pages with a usable text layer become TextPages and the
+    remaining (scanned) pages PendingPages; a PDF without any text layer is
+    rasterized whole. "image" mode makes every page a PendingPage, and "pdf"
+    mode sends the raw bytes as one PdfDocument (poppler only counts its pages).
+    With RASTER_MODE "full" the pages are PIL Images from convert_pdf_to_images
+    (the legacy path). `input_mode` defaults to resolve_input_mode(pdf_path).
+    Returns an empty list if the PDF cannot be read.
+    """
+    input_mode = input_mode or resolve_input_mode(pdf_path)
+
+    if input_mode == "pdf":
+        try:
+            with open(pdf_path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            print(f"   > ❌ Error reading PDF: {e}")
+            return []
+        return [PdfDocument(data, _pdf_page_count(pdf_path, data))]
+
+    if not os.path.exists(pdf_path):
+        print(f"   > ❌ Error: File not found at {pdf_path}")
+        return []
+
+    if input_mode == "auto":
+        page_texts = extract_text_layer(pdf_path)
+        pages = [
+            TextPage(number, text) if has_usable_text(text) else PendingPage(number)
+            for number, text in enumerate(page_texts, start=1)
+        ]
+        if any(isinstance(page, TextPage) for page in pages):
+            return pages
+
+    if RASTER_MODE == "full":
+        return convert_pdf_to_images(pdf_path)
+    try:
+        page_count = int(pdfinfo_from_path(pdf_path).get("Pages", 0))
+    except Exception as e:
+        print(f"   > ❌ Error reading PDF page count: {e}")
+        return []
+    return [PendingPage(number) for number in range(1, page_count + 1)]
+
+class PageStream:
+    """
+    The pages of one PDF, rasterized as they are consumed.
+
+    `plan` (from plan_pdf_pages) is known up front, so callers can size and
+    split the document before any page is rendered. Iterating with `async for`
+    yields the pages in order; PendingPages are rendered in the process pool
+    one run at a time, at most RENDER_RUNS_AHEAD runs ahead of the consumer,
+    so encoded pages are handed over as they are ready instead of all at once.
+    """
+
+    def __init__(self, pdf_path, plan):
+        self.pdf_path = pdf_path
+        self.plan = plan
+
+    def __len__(self):
+        return len(self.plan)
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        pending = [page.page_number for page in self.plan if isinstance(page, PendingPage)]
+        runs = _page_runs(pending, dict.fromkeys(pending))
+        in_flight = []
+        rendered = {}
+        try:
+            for page in self.plan:
+                if not isinstance(page, PendingPage):
+                    yield page
+                    continue
+                while page.page_number not in rendered:
+                    while runs and len(in_flight) < RENDER_RUNS_AHEAD:
+                        first, last = runs.pop(0)
+                        in_flight.append(loop.run_in_executor(
+                            get_raster_pool(), render_pages, self.pdf_path, list(range(first, last + 1))
+                        ))
+                    rendered.update((p.page_number, p) for p in await in_flight.pop(0))
+                yield rendered.pop(page.page_number)
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+def _pdf_page_count(pdf_path, data):
+    """
+    Page count of a PDF from pdfinfo. Without poppler, the page objects are
+    counted in the raw bytes, which misses pages kept in compressed object streams.
+    """
+    try:
+        return max(1, int(pdfinfo_from_path(pdf_path).get("Pages", 0)))
+    except Exception as e:
+        print(f"   > ⚠️ pdfinfo failed, estimating the page count: {e}")
+        return max(1, len(re.findall(rb"/Type\s*/Page[^s]", data)))
+
+def count_pages(pages):
+    """
+    Page count of prepared (or planned) pages, used as the job size when scheduling.
+    """
+    return sum(page.page_count if isinstance(page, PdfDocument) else 1 for page in pages)
+
+def get_raster_pool():
+    """
+    Returns the shared rasterization process pool, creating it on first use.
+    Uses 'spawn' so workers never inherit the event loop's threads or sockets.
+    """
+    global _raster_pool
+    if _raster_pool is None:
+        _raster_pool = ProcessPoolExecutor(
+            max_workers=raster_worker_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _raster_pool
+
+async def prepare_pdf_pages_async(pdf_path):
+    """
+    Plans the pages of a PDF in the worker process pool and returns them as a
+    PageStream, which rasterizes the scanned pages while they are consumed.
+    """
+    loop = asyncio.get_running_loop()
+    plan = await loop.run_in_executor(get_raster_pool(), plan_pdf_pages, pdf_path)
+    return PageStream(pdf_path, plan)
+
+def shutdown_raster_pool():
+    """
+    Stops the rasterization workers. Safe to call when the pool was never started.
+    """
+    global _raster_pool
+    if _raster_pool is not None:
+        _raster_pool.shutdown(wait=True, cancel_futures=True)
+        _raster_pool = None
@@ -0,0 +1,142 @@
+"""
+Per-file extraction steps shared by the API (background sessions) and worker.py
+(durable queue): extracting one file, billing it, recording its progress in the
+session store, storing its rows and writing the finished session report.
+"""
+import os
+import json
+import time
+
+from config.settings import GEMINI_ENGINE
+from core.pdf_utils import prepare_pdf_pages_async
+from core.schema_manager import update_schema_memory
+from core.ai_extractor import extract_invoice_with_rotation
+from core.extraction_cache import extraction_cache
+from core.excel_writer import update_excel_sheet, store_file_rows, report_session, export_report
+from core.session_store import session_store
+
+# Files allowed to rasterize ahead of the Gemini calls, so CPU and network overlap.
+RASTER_PREFETCH = 3
+
+
+async def process_single_file_async(file_path, schema, gemini_slot, prefetch_semaphore):
+    """
+    Async Worker: Performs the extraction.
+    Does NOT update global status (keeps it pure).
+    prefetch_semaphore bounds files in flight; gemini_slot(page_count) waits for a
+    fair-share slot in the process-wide scheduler before each Gemini request.
+    """
+    filename = os.path.basename(file_path)
+    start_time = time.time()
+    cache_key = extraction_cache.key_for(file_path, schema.schema_hash)
+    cached = extraction_cache.get(cache_key)
+
+    async with prefetch_semaphore:
+        try:
+            if cached:
+                invoices_list, usage_stats = cached
+            else:
+                images = await prepare_pdf_pages_async(file_path)
+                if not images:
+                    return None, None, f"Skipped (Image Conversion Failed): {filename}"
+
+                # Rasterizing runs ahead of the model calls; only the Gemini requests are gated.
+                invoices_list, usage_stats = await extract_invoice_with_rotation(images, schema.columns, gemini_slot)
+                extraction_cache.put(cache_key, invoices_list, usage_stats)
+            
+            end_time = time.time()
+            duration = round(end_time - start_time, 2)
+
+            if invoices_list:
+                unique_invoices = []
+                seen_invoice_numbers = set()
+                
+                for invoice in invoices_list:
+                    inv_no = str(invoice.get("Invoice No", "")).strip()
+                    if inv_no and inv_no in seen_invoice_numbers:
+                        continue
+                    if inv_no:
+                        seen_invoice_numbers.add(inv_no)
+                    unique_invoices.append(invoice)
+
+                if unique_invoices:
+                    cached_note = " (cached)" if cached else ""
+                    return unique_invoices, usage_stats, f"Completed{cached_note} ({duration}s)"
+                else:
+                    return None, usage_stats, f"Skipped (Duplicate) ({duration}s)"
+            else:
+                # The calls that were made are billed even when they produced nothing.
+                return None, usage_stats, f"Failed (AI returned no data) ({duration}s)"
+
+        except Exception as e:
+            end_time = time.time()
+            duration = round(end_time - start_time, 2)
+            return None, None, f"Error: {str(e)} ({duration}s)"
+
+
+def log_file_usage(cost_manager, filename, stats):
+    # Cache hits were already billed when first extracted.
+    if stats and not stats.get("cache_hit"):
+        cost_manager.log_usage(
+            model_name=GEMINI_ENGINE,
+            input_tokens=stats["input_tokens"],
+            output_tokens=stats["output_tokens"],
+            filename=filename,
+            input_mode=stats.get("input_mode"),
+            latency_s=stats.get("latency_s"),
+            cached_tokens=stats.get("cached_tokens", 0),
+            output_tokens_saved_est=stats.get("output_tokens_saved_est", 0)
+        )
+
+
+def mark_file_done(session_key, filename, msg, stats, cost, queue):
+    cache_counter = "hits" if stats and stats.get("cache_hit") else "misses"
+
+    def mark_done(state):
+        state["files"][filename] = msg
+        state["completed_count"] += 1
+        state["cache"][cache_counter] += 1
+        state["cost"] = cost
+        # Last known queue position, for /status served by another worker process.
+        state["queue"] = queue
+    session_store.mutate(session_key, mark_done)
+
+
+def store_file_result(report_path, file_batch, user_id, session_id):
+    """
+    Stores the rows of one finished file under the session's report.
+    """
+    vendor_name = file_batch[0].get("Vendor Name", "Unknown_Vendor")
+    final_columns = store_file_rows(vendor_name, file_batch, report_path, user_id=user_id, session_id=session_id)
+    if final_columns:
+        update_schema_memory(vendor_name, final_columns)
+
+
+def write_session_report(user_id, session_id, report_path, cost_manager, all_file_results=None):
+    """
+    Writes the report and costing.json of a finished session. The report is
+    assembled from the rows stored as each file finished; `all_file_results`
+    is only given when those rows have to be stored again in one go.
+    Returns (download_link, financial_summary).
+    """
+    print(f"💾 Writing Excel...")
+    if all_file_results is None:
+        export_report(report_path)
+    else:
+        with report_session(report_path, user_id=user_id, session_id=session_id):
+            for file_batch in all_file_results:
+                if not file_batch: continue
+                first_item = file_batch[0]
+                vendor_name = first_item.get("Vendor Name", "Unknown_Vendor")
+                
+                final_columns = update_excel_sheet(vendor_name, file_batch, file_path=report_path)
+                if final_columns:
+                    update_schema_memory(vendor_name, final_columns)
+
+    financial_summary = cost_manager.generate_total()
+    with open(os.path.join(os.path.dirname(report_path), "costing.json"), "w") as f:
+        json.dump(financial_summary, f, indent=4)
+
+    report_filename = os.path.basename(report_path)
+    download_link = f"http://127.0.0.1:8000/download/{user_id}/{session_id}/{report_filename}"
+    return download_link, financial_summary
@@ -0,0 +1,285 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from config.settings import RESULT_STORE_FILE
+
+# Rows fetched from SQLite per round trip when streaming a report out.
+FETCH_ROWS = 5000
+
+
+def _text(value):
+    if value is None:
+        return None
+    text = str(value).strip()
+    return text or None
+
+
+def _iso_dates(values):
+    """
+    Normalizes invoice dates as extracted ("27/11/2025", "04-November-2025", ...)
+    to YYYY-MM-DD for range queries; unparseable dates become None.
+    """
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), format="mixed", dayfirst=True, errors="coerce")
+    return [None if pd.isna(d) else d.strftime("%Y-%m-%d") for d in parsed]
+
+
+class ResultStore:
+    """
+    Durable record of every flattened invoice row, in an indexed SQLite file.
+
+    Rows are appended in batches (one per update_excel_sheet call) under the
+    report file they belong to, indexed by vendor, invoice number, invoice date
+    and session. Reports (XLSX / CSV / JSONL) are materialized from here on
+    demand; each report has a generation counter that is bumped on every append,
+    so an exported file stays valid until new rows arrive.
+    """
+
+    def __init__(self, db_path=RESULT_STORE_FILE):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS batches (
+                    batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    report TEXT NOT NULL,
+                    sheet_name TEXT NOT NULL,
+                    columns TEXT NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    user_id TEXT,
+                    session_id TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_batches_report ON batches (report, batch_id);
+
+                CREATE TABLE IF NOT EXISTS result_rows (
+                    row_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    batch_id INTEGER NOT NULL,
+                    report TEXT NOT NULL,
+                    sheet_name TEXT NOT NULL,
+                    vendor TEXT,
+                    invoice_no TEXT,
+                    invoice_date TEXT,
+                    invoice_date_iso TEXT,
+                    user_id TEXT,
+                    session_id TEXT,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_rows_batch ON result_rows (batch_id, row_id);
+                CREATE INDEX IF NOT EXISTS idx_rows_vendor ON result_rows (vendor, invoice_no);
+                CREATE INDEX IF NOT EXISTS idx_rows_invoice ON result_rows (invoice_no);
+                CREATE INDEX IF NOT EXISTS idx_rows_date ON result_rows (invoice_date_iso);
+                CREATE INDEX IF NOT EXISTS idx_rows_session ON result_rows (user_id, session_id);
+
+                CREATE TABLE IF NOT EXISTS reports (
+                    report TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS exports (
+                    report TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    out_path TEXT NOT NULL,
+                    generation INTEGER NOT NULL,
+                    watermark INTEGER NOT NULL,
+                    PRIMARY KEY (report, format, out_path)
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def report_key(file_path):
+        return os.path.abspath(file_path)
+
+    def append(self, report, sheets, user_id=None, session_id=None):
+        """
+        Stores {sheet_name: [DataFrame, ...]} as one batch per DataFrame and
+        bumps the report's generation. Cost is proportional to the new rows only.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            for sheet_name, frames in sheets.items():
+                for df in frames:
+                    self._insert_batch(conn, report, sheet_name, list(df.columns),
+                                       df.to_dict("records"), user_id, session_id, now)
+            self._bump(conn, report, now)
+
+    def import_rows(self, report, sheet_name, columns, batches):
+        """
+        Stores rows read back from an existing workbook, one batch per list in `batches`.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            for rows in batches:
+                self._insert_batch(conn, report, sheet_name, list(columns), rows, None, None, now)
+            self._bump(conn, report, now)
+
+    def _insert_batch(self, conn, report, sheet_name, columns, records, user_id, session_id, now):
+        batch_id = conn.execute(
+            """
+            INSERT INTO batches (report, sheet_name, columns, row_count, user_id, session_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (report, sheet_name, json.dumps(columns, ensure_ascii=False), len(records), user_id, session_id, now),
+        ).lastrowid
+
+        invoice_dates = [_text(r.get("Invoice Date")) for r in records]
+        iso_dates = _iso_dates(invoice_dates) if records else []
+        conn.executemany(
+            """
+            INSERT INTO result_rows
+                (batch_id, report, sheet_name, vendor, invoice_no, invoice_date, invoice_date_iso,
+                 user_id, session_id, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                (
+                    batch_id, report, sheet_name, _text(r.get("Vendor Name")), _text(r.get("Invoice No")),
+                    invoice_date, iso_date, user_id, session_id,
+                    # Empty cells are not stored; they come back as "" when materialized.
+                    json.dumps({k: v for k, v in r.items() if v is not None and v != ""},
+                               ensure_ascii=False, default=str),
+                )
+                for r, invoice_date, iso_date in zip(records, invoice_dates, iso_dates)
+            ),
+        )
+
+    def _bump(self, conn, report, now):
+        conn.execute(
+            """
+            INSERT INTO reports (report, generation, updated_at) VALUES (?, 1, ?)
+            ON CONFLICT (report) DO UPDATE SET generation = generation + 1, updated_at = excluded.updated_at
+            """,
+            (report, now),
+        )
+
+    def version(self, report):
+        """
+        Returns (generation, last batch id) of a report, read together; (0, 0) if unknown.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT generation FROM reports WHERE report = ?", (report,)).fetchone()
+            last = conn.execute("SELECT MAX(batch_id) FROM batches WHERE report = ?", (report,)).fetchone()
+        return (row[0] if row else 0), (last[0] or 0)
+
+    def batches(self, report, after, upto):
+        """
+        Metadata of the report's batches with after < batch_id <= upto, in insertion order.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT batch_id, sheet_name, columns, row_count FROM batches
+                WHERE report = ? AND batch_id > ? AND batch_id <= ? ORDER BY batch_id
+                """,
+                (report, after, upto),
+            ).fetchall()
+        return [
+            {"batch_id": b, "sheet_name": s, "columns": json.loads(c), "row_count": n}
+            for b, s, c, n in rows
+        ]
+
+    def iter_batch_rows(self, batch_id):
+        """
+        Yields the row dicts of one batch, fetched in chunks.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute("SELECT data FROM result_rows WHERE batch_id = ? ORDER BY row_id", (batch_id,))
+            while True:
+                chunk = cursor.fetchmany(FETCH_ROWS)
+                if not chunk:
+                    break
+                for (data,) in chunk:
+                    yield json.loads(data)
+
+    def batch_frame(self, batch):
+        return pd.DataFrame(list(self.iter_batch_rows(batch["batch_id"])), columns=batch["columns"])
+
+    def export_state(self, report, fmt, out_path):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT generation, watermark FROM exports WHERE report = ? AND format = ? AND out_path = ?",
+                (report, fmt, os.path.abspath(out_path)),
+            ).fetchone()
+        return {"generation": row[0], "watermark": row[1]} if row else None
+
+    def record_export(self, report, fmt, out_path, generation, watermark):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO exports (report, format, out_path, generation, watermark) VALUES (?, ?, ?, ?, ?)",
+                (report, fmt, os.path.abspath(out_path), generation, watermark),
+            )
+
+    def drop_report(self, report):
+        """
+        Forgets every row and export of a report, e.g. when its session is restarted.
+        """
+        with self._connect() as conn:
+            for table in ("result_rows", "batches", "exports", "reports"):
+                conn.execute(f"DELETE FROM {table} WHERE report = ?", (report,))
+
+    def reports_for_session(self, user_id, session_id):
+        """
+        Report files holding rows of a session, most recent first.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT report FROM batches WHERE user_id = ? AND session_id = ?
+                GROUP BY report ORDER BY MAX(batch_id) DESC
+                """,
+                (user_id, session_id),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def query(self, vendor=None, invoice_no=None, date_from=None, date_to=None,
+              user_id=None, session_id=None, limit=100, offset=0):
+        """
+        Looks rows up through the indexes. Dates are compared as YYYY-MM-DD.
+        Returns a list of {"vendor", "invoice_no", "invoice_date", "session_id", "row"}.
+        """
+        clauses, params = [], []
+        for column, value in (("vendor", vendor), ("invoice_no", invoice_no),
+                              ("user_id", user_id), ("session_id", session_id)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if date_from:
+            clauses.append("invoice_date_iso >= ?")
+            params.append(date_from)
+        if date_to:
+            clauses.append("invoice_date_iso <= ?")
+            params.append(date_to)
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT vendor, invoice_no, invoice_date, session_id, data FROM result_rows
+                {where} ORDER BY row_id DESC LIMIT ? OFFSET ?
+                """,
+                (*params, int(limit), int(offset)),
+            ).fetchall()
+        return [
+            {"vendor": v, "invoice_no": n, "invoice_date": d, "session_id": s, "row": json.loads(data)}
+            for v, n, d, s, data in rows
+        ]
+
+
+result_store = ResultStore()
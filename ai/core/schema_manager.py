@@ -56,24 +56,199 @@
 #     if vendor_key not in schemas or keys_added: 
 #          save_schemas(schemas)
 
+import hashlib
 import json
 import os
+import threading
+from collections import namedtuple
+from types import MappingProxyType
 from config.settings import SCHEMA_FILE
 
+RED, BLUE, YELLOW, WHITE = "FF0000", "0000FF", "FFFF00", "FFFFFF"
+
+# Header colour of each report column; columns not listed are white.
+HEADER_COLORS = {
+    "Asset Category": RED,
+    "Asset Class": RED,
+    "Total Base Price": RED,
+    "Total Tax": RED,
+    "Total Purchase Price": RED,
+    
+    "Vendor Name": BLUE,
+    "Date of Entry": BLUE,
+    "Data Entry Done By": BLUE,
+    "Customer Name": BLUE,
+    
+    "Client Code": YELLOW,
+    "PO Number": YELLOW,
+    "Invoice Status ( Proforma/ Final)": YELLOW,
+    "Invoice No": YELLOW,
+    "Invoice Date": YELLOW,
+    "Invoice Received Date": YELLOW,
+    "Vendor Code": YELLOW,
+    "Vendor State": YELLOW,
+    "Asset Type": YELLOW,
+    "RS #": YELLOW,
+    "Asset Description": YELLOW,
+    "Asset Serial Number": YELLOW,
+    "Qty": YELLOW,
+    "UOM": YELLOW,
+    "Deliver Address": YELLOW,
+    "Delivery Location": YELLOW,
+    "Delivery State": YELLOW,
+    "Currency Code": YELLOW,
+    "HSN/SAC": YELLOW,
+    "Code": YELLOW,
+    "Base Inv Amt (Excl Tax) - Material": YELLOW,
+    "Base Inv Amt (Excl Tax) - Labour": YELLOW,
+    "Reverse Charge": YELLOW,
+    "Others": YELLOW,
+    "CGST": YELLOW,
+    "SGST": YELLOW,
+    "IGST": YELLOW,
+    "BCD": YELLOW,
+    "% of Total Purchase Price being scheduled": YELLOW,
+    "Waybill Inward Required ": YELLOW,
+    "Waybill Outward Required ": YELLOW,
+    "TDS Section": YELLOW,
+    "TDS Base Value": YELLOW,
+    "Vend Inv Type": YELLOW,
+    "Remarks": YELLOW,
+    "RAPL Billing State ": YELLOW,
+    
+    "Asset Make": WHITE,
+    "Asset Model": WHITE,
+    "LBT Applicable (Yes/No)": WHITE,
+    "LBT Circle No": WHITE,
+    "LBT Rate": WHITE,
+    "Purchase Tax applicable": WHITE,
+    "Total Bill Amount in Foreign Currency": WHITE,
+    "Total Bill Amount in INR": WHITE,
+    "Schedule Value": WHITE,
+    "VAT": WHITE,
+    "CST": WHITE,
+    "C Form Applicable": WHITE,
+    "Waybill Inward Number": WHITE,
+    "Waybill Outward Number": WHITE,
+    "Waybill Inward Counterfoil Received ": WHITE,
+    "Waybill Outward Counterfoil Received ": WHITE,
+    "Transporter Name": WHITE,
+    "Transporter Address": WHITE,
+    "Vehicle Number": WHITE,
+    "SEZ": WHITE,
+    "SEZ Amount": WHITE,
+    "Import": WHITE,
+    "Service Code": WHITE,
+    "Service Tax Amount(If Applicable)": WHITE,
+    "Others (Freight/ Octroi,etc)": WHITE,
+    "Base Amt VAT": WHITE,
+    "VAT %": WHITE,
+    "Other Bill Component(Service/Freight)": WHITE,
+    "VAT Rebate": WHITE,
+    "WCT Base Value": WHITE,
+    "CENVAT Amount passed on to customer": WHITE,
+    "Retention": WHITE,
+    "HSN Code": WHITE,
+    "SAC Code": WHITE,
+    "HSN SGST": WHITE,
+    "HSN CGST": WHITE,
+    "HSN IGST": WHITE,
+    "SAC SGST": WHITE,
+    "SAC CGST": WHITE,
+    "SAC IGST": WHITE
+}
+
+# One parsed version of the registry file. Every field is immutable, so all
+# sessions can share the same snapshot.
+SchemaSnapshot = namedtuple(
+    "SchemaSnapshot",
+    ["columns", "column_index", "header_colors", "input_modes", "schema_hash", "file_hash"],
+)
+
+def hash_schema(master_schema_columns):
+    """
+    Stable hash of the MASTER_SCHEMA column list.
+    """
+    payload = json.dumps(list(master_schema_columns or []), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+def build_snapshot(data, file_hash=None):
+    columns = tuple(data.get("MASTER_SCHEMA", []))
+    return SchemaSnapshot(
+        columns=columns,
+        column_index=MappingProxyType({column: i for i, column in enumerate(columns)}),
+        header_colors=tuple(HEADER_COLORS.get(str(column).strip(), WHITE) for column in columns),
+        input_modes=MappingProxyType(dict(data.get("INPUT_MODES", {}))),
+        schema_hash=hash_schema(columns),
+        file_hash=file_hash,
+    )
+
+class SchemaRegistry:
+    """
+    Parses the JSON registry once and hands out the same immutable snapshot
+    until the file changes. Each call costs one stat(); the file is re-read
+    only when its mtime or size moved, and re-parsed only when its content
+    hash differs. A corrupted file keeps the last good snapshot.
+    """
+
+    def __init__(self, path=SCHEMA_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat = None
+        self._snapshot = build_snapshot({})
+
+    def snapshot(self):
+        try:
+            st = os.stat(self.path)
+            stat = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stat = None
+
+        if stat == self._stat:
+            return self._snapshot
+
+        with self._lock:
+            if stat != self._stat:
+                self._reload(stat)
+            return self._snapshot
+
+    def _reload(self, stat):
+        if stat is None:
+            self._snapshot = build_snapshot({})
+            self._stat = None
+            return
+
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+        except OSError as e:
+            print(f"   > ⚠️ Warning: Could not read schema file at {self.path}: {e}")
+            return
+
+        file_hash = hashlib.sha256(raw).hexdigest()
+        if file_hash != self._snapshot.file_hash:
+            try:
+                self._snapshot = build_snapshot(json.loads(raw), file_hash)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                print(f"   > ⚠️ Warning: Schema file at {self.path} is corrupted.")
+        # Published after the snapshot, so a reader never pairs the new stat with the old content.
+        self._stat = stat
+
+schema_registry = SchemaRegistry()
+
 def load_schemas():
     """
     Loads the MASTER_SCHEMA from the JSON registry.
-    Returns: A LIST of column strings (The Blueprint).
+    Returns: A tuple of column strings (The Blueprint).
     """
-    if os.path.exists(SCHEMA_FILE):
-        try:
-            with open(SCHEMA_FILE, "r") as f:
-                data = json.load(f)
-                return data.get("MASTER_SCHEMA", [])
-        except json.JSONDecodeError:
-            print(f"   > ⚠️ Warning: Schema file at {SCHEMA_FILE} is corrupted.")
-            return []
-    return []
+    return schema_registry.snapshot().columns
+
+def load_input_modes():
+    """
+    Loads the per-vendor input mode overrides from the JSON registry.
+    Returns: A read-only mapping of vendor name -> "auto" / "image" / "pdf".
+    """
+    return schema_registry.snapshot().input_modes
 
 def save_schemas(schemas):
     """
@@ -0,0 +1,246 @@
+import abc
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config.settings import SESSION_STORE, SESSION_STORE_FILE, SESSION_TTL_SECONDS, SESSION_MAX_ENTRIES
+
+
+class SessionStore(abc.ABC):
+    """
+    Where the API keeps per-session status dicts.
+
+    `mutate(key, fn)` is the one write primitive: `fn` receives the current
+    state and changes it in place, atomically with respect to other writers
+    (threads for the memory store, processes for the shared one). Every write
+    bumps the state's "version", which `wait_for_change` watches. Sessions
+    expire `ttl_seconds` after their last write. The methods block (the SQLite
+    store takes a file lock), so async code calls them via asyncio.to_thread.
+    """
+
+    # Seconds between store reads while waiting for a change; None when every
+    # writer is in this process, so the local notification is enough.
+    CHANGE_POLL_SECONDS = None
+
+    def __init__(self):
+        self._waiters = {}  # key -> {(loop, asyncio.Event), ...}
+        self._waiters_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def create(self, key, state):
+        """
+        Stores a new session (replacing any with the same key) at version 1.
+        """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """
+        Returns a copy of the session state, or None if it is unknown or expired.
+        """
+
+    @abc.abstractmethod
+    def mutate(self, key, fn):
+        """
+        Applies `fn` to the session state in place and bumps its version.
+        """
+
+    def update(self, key, **fields):
+        self.mutate(key, lambda state: state.update(fields))
+
+    def _notify(self, key):
+        with self._waiters_lock:
+            waiters = list(self._waiters.get(key, ()))
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    async def wait_for_change(self, key, version, timeout):
+        """
+        Returns the session state as soon as its version differs from `version`,
+        or the unchanged state after `timeout` seconds; None if the session is gone.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self._waiters_lock:
+            self._waiters.setdefault(key, set()).add(waiter)
+
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                # Cleared before the read, so a write landing in between is not missed.
+                event.clear()
+                state = await asyncio.to_thread(self.get, key)
+                remaining = deadline - loop.time()
+                if state is None or state.get("version") != version or remaining <= 0:
+                    return state
+                if self.CHANGE_POLL_SECONDS is not None:
+                    remaining = min(remaining, self.CHANGE_POLL_SECONDS)
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._waiters_lock:
+                waiters = self._waiters.get(key)
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[key]
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Process-local store with TTL expiry and LRU eviction above `max_entries`.
+    Sessions still processing are never evicted for space.
+    """
+
+    def __init__(self, ttl_seconds=SESSION_TTL_SECONDS, max_entries=SESSION_MAX_ENTRIES):
+        super().__init__()
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()  # key -> (expires_at, state)
+        self._lock = threading.Lock()
+
+    def create(self, key, state):
+        state = {**state, "version": 1}
+        with self._lock:
+            self._sessions[key] = (time.time() + self.ttl_seconds, state)
+            self._sessions.move_to_end(key)
+            self._evict()
+        self._notify(key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                return None
+            self._sessions.move_to_end(key)
+            return json.loads(json.dumps(entry[1]))
+
+    def mutate(self, key, fn):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                return
+            fn(entry[1])
+            entry[1]["version"] = entry[1].get("version", 0) + 1
+            self._sessions[key] = (time.time() + self.ttl_seconds, entry[1])
+            self._sessions.move_to_end(key)
+        self._notify(key)
+
+    def _live(self, key):
+        entry = self._sessions.get(key)
+        if entry is not None and entry[0] < time.time():
+            del self._sessions[key]
+            return None
+        return entry
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, (expires_at, _) in self._sessions.items() if expires_at < now]:
+            del self._sessions[key]
+        if len(self._sessions) <= self.max_entries:
+            return
+        for key in list(self._sessions):
+            if len(self._sessions) <= self.max_entries:
+                break
+            if self._sessions[key][1].get("status") != "processing":
+                del self._sessions[key]
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Store shared by every API worker process on the host, in one SQLite file
+    (WAL). Writes take the database write lock for the read-modify-write, so
+    concurrent updates from different workers are not lost.
+    """
+
+    # Expired rows are purged on every this many creates.
+    PURGE_EVERY = 50
+    # Writes from other worker processes are only seen by reading the table.
+    CHANGE_POLL_SECONDS = 1.0
+
+    def __init__(self, db_path=SESSION_STORE_FILE, ttl_seconds=SESSION_TTL_SECONDS):
+        super().__init__()
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self._creates = 0
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_key TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            yield conn
+        finally:
+            conn.close()
+
+    def create(self, key, state):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_key, state, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps({**state, "version": 1}), now + self.ttl_seconds),
+            )
+            self._creates += 1
+            if self._creates % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+        self._notify(key)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT state FROM sessions WHERE session_key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def mutate(self, key, fn):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT state FROM sessions WHERE session_key = ? AND expires_at >= ?", (key, now)
+                ).fetchone()
+                if row is not None:
+                    state = json.loads(row[0])
+                    fn(state)
+                    state["version"] = state.get("version", 0) + 1
+                    conn.execute(
+                        "UPDATE sessions SET state = ?, expires_at = ? WHERE session_key = ?",
+                        (json.dumps(state), now + self.ttl_seconds, key),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        self._notify(key)
+
+
+def create_session_store(kind=SESSION_STORE):
+    """
+    "memory" (one worker) or "sqlite" (shared by every worker on the host).
+    """
+    if kind == "sqlite":
+        return SQLiteSessionStore()
+    if kind != "memory":
+        print(f"⚠️ Unknown SESSION_STORE '{kind}', using memory.")
+    return MemorySessionStore()
+
+
+session_store = create_session_store()
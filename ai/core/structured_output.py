@@ -0,0 +1,131 @@
+import json
+
+from google.genai import types
+
+# Columns that vary per table row; everything else in MASTER_SCHEMA is invoice-level.
+LINE_ITEM_FIELDS = {
+    "Asset Category", "Asset Class", "Asset Make", "Asset Type", "Asset Model", "RS #",
+    "Asset Description", "Asset Serial Number", "Qty", "UOM", "HSN/SAC", "Code",
+    "Base Inv Amt (Excl Tax) - Material", "Base Inv Amt (Excl Tax) - Labour",
+    "Others", "CGST", "SGST", "IGST", "BCD", "Total Base Price", "Total Tax",
+    "Total Purchase Price", "Schedule Value", "VAT", "CST", "VAT %",
+    "HSN Code", "SAC Code", "HSN SGST", "HSN CGST", "HSN IGST", "SAC SGST", "SAC CGST", "SAC IGST",
+}
+
+# Filled in by flatten_invoices, never by the model.
+PIPELINE_FIELDS = {
+    "Date of Entry", "Data Entry Done By",
+    "Total Bill Amount in Foreign Currency", "Total Bill Amount in INR",
+}
+
+LINE_ITEMS_WIRE_KEY = "li"
+
+WIRE_KEYS_NOTE = """
+### OUTPUT FORMAT (STRUCTURED)
+
+Your response is constrained by a JSON schema that uses SHORT property keys.
+Each property's description is the exact column name used in the examples above.
+Put invoice-level fields on the invoice object and one object per table row inside "li".
+OMIT any property you cannot fill from the document. Never output empty strings, "N/A" placeholders or nulls for missing values.
+"""
+
+
+def build_wire_schema(master_schema_columns):
+    """
+    Builds a Gemini response_schema from MASTER_SCHEMA with short wire keys.
+
+    Returns:
+        dict: {"response_schema": types.Schema, "header": {wire: column}, "line_items": {wire: column}}.
+              Wire keys are derived from the column's position in MASTER_SCHEMA ("h7", "l18").
+    """
+    header, line_items = {}, {}
+    header_props, item_props = {}, {}
+
+    for index, column in enumerate(master_schema_columns):
+        if column in PIPELINE_FIELDS:
+            continue
+        if column == "Asset Serial Number":
+            prop = types.Schema(type=types.Type.ARRAY, items=types.Schema(type=types.Type.STRING), description=column)
+        elif column == "Qty":
+            prop = types.Schema(type=types.Type.NUMBER, description=column)
+        else:
+            prop = types.Schema(type=types.Type.STRING, description=column)
+
+        if column in LINE_ITEM_FIELDS:
+            wire_key = f"l{index}"
+            line_items[wire_key] = column
+            item_props[wire_key] = prop
+        else:
+            wire_key = f"h{index}"
+            header[wire_key] = column
+            header_props[wire_key] = prop
+
+    header_props[LINE_ITEMS_WIRE_KEY] = types.Schema(
+        type=types.Type.ARRAY,
+        description="Line Items",
+        items=types.Schema(type=types.Type.OBJECT, properties=item_props),
+    )
+    response_schema = types.Schema(
+        type=types.Type.ARRAY,
+        items=types.Schema(type=types.Type.OBJECT, properties=header_props, required=[LINE_ITEMS_WIRE_KEY]),
+    )
+    return {"response_schema": response_schema, "header": header, "line_items": line_items}
+
+
+def _is_empty(value):
+    if value is None:
+        return True
+    if isinstance(value, str):
+        return not value.strip()
+    if isinstance(value, list):
+        return not any(not _is_empty(v) for v in value)
+    return False
+
+
+def _expand_fields(wire_obj, key_map):
+    expanded = {}
+    saved_chars = 0
+    for wire_key, value in wire_obj.items():
+        column = key_map.get(wire_key)
+        if column is None or _is_empty(value):
+            continue
+        if isinstance(value, list):
+            value = [v for v in value if not _is_empty(v)]
+        expanded[column] = value
+        saved_chars += len(json.dumps(column)) - len(json.dumps(wire_key))
+    return expanded, saved_chars
+
+
+def expand_wire_output(data, wire_schema):
+    """
+    Maps a structured response back to the real column names, dropping fields the
+    model left empty.
+
+    Returns:
+        (list, int): the invoices in the usual {"...", "Line Items": [...]} shape, and
+                     an estimate of the output tokens saved by the short keys.
+    """
+    if isinstance(data, dict):
+        data = [data]
+
+    invoices = []
+    saved_chars = 0
+    for wire_invoice in data or []:
+        if not isinstance(wire_invoice, dict):
+            continue
+        invoice, saved = _expand_fields(wire_invoice, wire_schema["header"])
+        saved_chars += saved
+
+        line_items = []
+        for wire_item in wire_invoice.get(LINE_ITEMS_WIRE_KEY) or []:
+            if not isinstance(wire_item, dict):
+                continue
+            item, saved = _expand_fields(wire_item, wire_schema["line_items"])
+            saved_chars += saved
+            line_items.append(item)
+        invoice["Line Items"] = line_items
+        saved_chars += len(json.dumps("Line Items")) - len(json.dumps(LINE_ITEMS_WIRE_KEY))
+        invoices.append(invoice)
+
+    # ~4 characters per output token.
+    return invoices, saved_chars // 4
@@ -0,0 +1,274 @@
+import math
+import re
+import zipfile
+from datetime import datetime, date
+from xml.sax.saxutils import escape, unescape
+
+import numpy as np
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import to_excel
+
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+# Characters XML 1.0 does not allow (same set openpyxl rejects).
+ILLEGAL_XML_CHARS = re.compile(r"[\000-\010]|[\013-\014]|[\016-\037]")
+TEXT_NEEDS_WORK = re.compile(r"[&<>\000-\010\013\014\016-\037]|^\s|\s\Z")
+ALIGNMENT_XML = '<alignment horizontal="center" vertical="center" wrapText="1"/>'
+# Rows are buffered and flushed to the zip in chunks of this many.
+FLUSH_EVERY_ROWS = 1000
+
+BODY_STYLE = 1
+DATE_STYLE = 2
+
+SHEET_DATA_OPEN = b"<sheetData>"
+SHEET_SUFFIX = b"</sheetData></worksheet>"
+LAST_ROW_TAG = re.compile(rb'.*<row r="(\d+)"', re.DOTALL)
+COPY_CHUNK_BYTES = 1 << 20
+
+
+class SheetStream:
+    """
+    One worksheet being written; rows are serialized on append and streamed
+    into the archive, so nothing but the current chunk is held in memory.
+    """
+
+    def __init__(self, handle, column_count, column_width, row_total=None, copy_from=None):
+        self._handle = handle
+        self._letters = [get_column_letter(i + 1) for i in range(max(1, column_count))]
+        self._buffer = []
+        self.row_count = 0
+
+        # Readers (openpyxl read-only mode in particular) scan the whole sheet when no size is declared.
+        dimension = ""
+        if row_total:
+            dimension = f'<dimension ref="A1:{self._letters[-1]}{row_total}"/>'
+        cols = ""
+        if column_count:
+            cols = f'<cols><col min="1" max="{column_count}" width="{column_width}" customWidth="1" style="{BODY_STYLE}"/></cols>'
+        self._handle.write(f'{XML_HEADER}<worksheet xmlns="{MAIN_NS}">{dimension}{cols}<sheetData>'.encode("utf-8"))
+        if copy_from is not None:
+            self.row_count = _copy_sheet_rows(copy_from, handle)
+
+    def append(self, values, styles=None):
+        """
+        Writes one row. `styles` is an optional per-column list of style ids;
+        by default every cell gets the body style. Empty values produce no cell.
+        """
+        self.row_count += 1
+        r = self.row_count
+        letters = self._letters
+        cells = []
+        for index, value in enumerate(values):
+            if value is None or value == "":
+                continue
+            style = styles[index] if styles else BODY_STYLE
+            if isinstance(value, str):
+                cells.append(f'<c r="{letters[index]}{r}" s="{style}" t="inlineStr"><is>{_text_element(value)}</is></c>')
+                continue
+            if isinstance(value, np.generic):
+                value = value.item()
+            if isinstance(value, bool):
+                cells.append(f'<c r="{letters[index]}{r}" s="{style}" t="b"><v>{int(value)}</v></c>')
+            elif isinstance(value, (int, float)):
+                if isinstance(value, float) and not math.isfinite(value):
+                    continue
+                number = repr(value)
+                if number.endswith(".0"):
+                    number = number[:-2]
+                cells.append(f'<c r="{letters[index]}{r}" s="{style}"><v>{number}</v></c>')
+            elif isinstance(value, (datetime, date)):
+                cells.append(f'<c r="{letters[index]}{r}" s="{DATE_STYLE}"><v>{to_excel(value)!r}</v></c>')
+            else:
+                cells.append(f'<c r="{letters[index]}{r}" s="{style}" t="inlineStr"><is>{_text_element(str(value))}</is></c>')
+        self._buffer.append(f'<row r="{r}">{"".join(cells)}</row>')
+        if len(self._buffer) >= FLUSH_EVERY_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._handle.write("".join(self._buffer).encode("utf-8"))
+            self._buffer = []
+
+    def close(self):
+        self._flush()
+        self._handle.write(b"</sheetData></worksheet>")
+        self._handle.close()
+
+
+def _copy_sheet_rows(source, handle):
+    """
+    Copies the rows of a sheet part written by SheetStream (everything between
+    its <sheetData> tags) and returns the number of its last row, so appending
+    can continue after it.
+    """
+    data = b""
+    prologue_done = False
+    while True:
+        chunk = source.read(COPY_CHUNK_BYTES)
+        if not chunk:
+            break
+        data = data[-64:] + chunk
+        if not prologue_done:
+            start = data.find(SHEET_DATA_OPEN)
+            if start < 0:
+                continue
+            data = data[start + len(SHEET_DATA_OPEN):]
+            prologue_done = True
+        # Hold back a little, so the closing tags are never written out.
+        handle.write(data[:-64])
+    source.close()
+
+    tail = data[-64:]
+    if not prologue_done or not tail.endswith(SHEET_SUFFIX):
+        raise ValueError("Sheet part was not written by StreamingXlsxWriter.")
+    handle.write(tail[:-len(SHEET_SUFFIX)])
+
+    # The last chunk (up to COPY_CHUNK_BYTES) always holds the start of the last row.
+    match = LAST_ROW_TAG.search(data)
+    return int(match.group(1)) if match else 0
+
+
+def reusable_sheet_parts(path, header_colors=()):
+    """
+    If `path` was written by StreamingXlsxWriter with the same styles, returns
+    {sheet name: part name} so its sheets can be copied through verbatim;
+    otherwise {}.
+    """
+    try:
+        with zipfile.ZipFile(path) as source:
+            if source.read("xl/styles.xml").decode("utf-8") != StreamingXlsxWriter.styles_xml(header_colors):
+                return {}
+            workbook = source.read("xl/workbook.xml").decode("utf-8")
+    except (OSError, KeyError, zipfile.BadZipFile, UnicodeDecodeError):
+        return {}
+    names = re.findall(r'<sheet name="([^"]*)" sheetId="(\d+)"', workbook)
+    return {unescape(name, {"&quot;": '"'}): f"xl/worksheets/sheet{index}.xml" for name, index in names}
+
+
+def _text_element(text):
+    # Most cells need neither escaping nor whitespace preservation.
+    if TEXT_NEEDS_WORK.search(text) is None:
+        return f"<t>{text}</t>"
+    if ILLEGAL_XML_CHARS.search(text):
+        text = ILLEGAL_XML_CHARS.sub("", text)
+    space = ' xml:space="preserve"' if text != text.strip() else ""
+    return f"<t{space}>{escape(text)}</t>"
+
+
+class StreamingXlsxWriter:
+    """
+    Minimal write-only XLSX writer for large reports.
+
+    Sheets are written one after another straight into the zip archive with
+    inline strings (no shared-string table), so memory stays flat whatever the
+    row count. Formatting is declared once as named styles (a body style and
+    one header style per fill colour) and referenced by id as cells are written.
+    """
+
+    def __init__(self, path, header_colors=(), compresslevel=1):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self._sheets = []
+        self._open_sheet = None
+        self._header_colors = list(dict.fromkeys(header_colors))
+        # Header styles follow the body and date cell formats.
+        self.header_styles = {color: DATE_STYLE + 1 + i for i, color in enumerate(self._header_colors)}
+
+    def add_sheet(self, name, column_count, column_width=50, row_total=None, copy_from=None):
+        """
+        Starts the next sheet. `row_total`, when known, is declared as the sheet's size.
+        With `copy_from` (an open part from reusable_sheet_parts) its rows are
+        copied verbatim and appends continue after them.
+        """
+        if self._open_sheet is not None:
+            self._open_sheet.close()
+        self._sheets.append(name)
+        handle = self._zip.open(f"xl/worksheets/sheet{len(self._sheets)}.xml", "w", force_zip64=True)
+        self._open_sheet = SheetStream(handle, column_count, column_width, row_total, copy_from)
+        return self._open_sheet
+
+    def close(self):
+        if self._open_sheet is not None:
+            self._open_sheet.close()
+            self._open_sheet = None
+        if not self._sheets:
+            self.add_sheet("Sheet1", 0).close()
+            self._open_sheet = None
+
+        count = len(self._sheets)
+        overrides = "".join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+            f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in range(1, count + 1)
+        )
+        self._zip.writestr("[Content_Types].xml", (
+            f'{XML_HEADER}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{overrides}</Types>'
+        ))
+        self._zip.writestr("_rels/.rels", (
+            f'{XML_HEADER}<Relationships xmlns="{PKG_REL_NS}">'
+            f'<Relationship Id="rId1" Type="{REL_NS}/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ))
+        sheets = "".join(
+            f'<sheet name="{escape(name, {chr(34): "&quot;"})}" sheetId="{i}" r:id="rId{i}"/>'
+            for i, name in enumerate(self._sheets, 1)
+        )
+        self._zip.writestr("xl/workbook.xml", (
+            f'{XML_HEADER}<workbook xmlns="{MAIN_NS}" xmlns:r="{REL_NS}"><sheets>{sheets}</sheets></workbook>'
+        ))
+        rels = "".join(
+            f'<Relationship Id="rId{i}" Type="{REL_NS}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+            for i in range(1, count + 1)
+        )
+        self._zip.writestr("xl/_rels/workbook.xml.rels", (
+            f'{XML_HEADER}<Relationships xmlns="{PKG_REL_NS}">{rels}'
+            f'<Relationship Id="rId{count + 1}" Type="{REL_NS}/styles" Target="styles.xml"/>'
+            '</Relationships>'
+        ))
+        self._zip.writestr("xl/styles.xml", self.styles_xml(self._header_colors))
+        self._zip.close()
+
+    @staticmethod
+    def styles_xml(header_colors):
+        header_colors = list(dict.fromkeys(header_colors))
+        fills = ['<fill><patternFill patternType="none"/></fill>', '<fill><patternFill patternType="gray125"/></fill>']
+        fills += [
+            f'<fill><patternFill patternType="solid"><fgColor rgb="{c}"/><bgColor rgb="{c}"/></patternFill></fill>'
+            for c in header_colors
+        ]
+        base = 'numFmtId="0" fontId="0" borderId="0"'
+
+        # Named styles: Normal, report_cell, then one report_header_<rgb> per colour.
+        style_xfs = [f'<xf {base} fillId="0"/>', f'<xf {base} fillId="0" applyAlignment="1">{ALIGNMENT_XML}</xf>']
+        style_xfs += [f'<xf {base} fillId="{2 + i}" applyFill="1" applyAlignment="1">{ALIGNMENT_XML}</xf>'
+                      for i in range(len(header_colors))]
+        cell_styles = ['<cellStyle name="Normal" xfId="0" builtinId="0"/>', '<cellStyle name="report_cell" xfId="1"/>']
+        cell_styles += [f'<cellStyle name="report_header_{c[-6:]}" xfId="{2 + i}"/>'
+                        for i, c in enumerate(header_colors)]
+
+        cell_xfs = [
+            f'<xf {base} fillId="0" xfId="0"/>',
+            f'<xf {base} fillId="0" xfId="1" applyAlignment="1">{ALIGNMENT_XML}</xf>',
+            f'<xf numFmtId="22" fontId="0" borderId="0" fillId="0" xfId="1" applyNumberFormat="1" applyAlignment="1">{ALIGNMENT_XML}</xf>',
+        ]
+        cell_xfs += [f'<xf {base} fillId="{2 + i}" xfId="{2 + i}" applyFill="1" applyAlignment="1">{ALIGNMENT_XML}</xf>'
+                     for i in range(len(header_colors))]
+
+        return (
+            f'{XML_HEADER}<styleSheet xmlns="{MAIN_NS}">'
+            '<fonts count="1"><font><sz val="11"/><name val="Calibri"/><family val="2"/></font></fonts>'
+            f'<fills count="{len(fills)}">{"".join(fills)}</fills>'
+            '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+            f'<cellStyleXfs count="{len(style_xfs)}">{"".join(style_xfs)}</cellStyleXfs>'
+            f'<cellXfs count="{len(cell_xfs)}">{"".join(cell_xfs)}</cellXfs>'
+            f'<cellStyles count="{len(cell_styles)}">{"".join(cell_styles)}</cellStyles>'
+            '</styleSheet>'
+        )
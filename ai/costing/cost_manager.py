@@ -74,108 +74,168 @@
 
 
 # Mizhou Speical Costing per pdf
-import json
-import pandas as pd
-import os
+import threading
+
+from costing.price_service import price_service
+from costing.usage_ledger import usage_ledger
 
 class CostManager:
-    def __init__(self, cost_file="model_prices.json"):
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        self.cost_file = os.path.join(base_dir, cost_file)
-        self.cost_data = {}
-        self.map = {}
-
-        try:
-            print(f"CostManager: Loading prices from {self.cost_file}")
-            with open(self.cost_file,"r") as f:
-                self.cost_data=json.load(f)
-                for full_name in self.cost_data.keys():
-                    short_name=full_name.split("/")[-1]
-                    self.map[short_name]=full_name
-        except FileNotFoundError:
-            pass
-
-        self.logger=[]  
-
-    def log_usage(self, model_name, input_tokens, output_tokens, filename="Unknown_File"):
+    def __init__(self, user_id=None, session_id=None, prices=price_service, ledger=usage_ledger):
+        # Prices are served from the process-wide price index; nothing is parsed per session.
+        self.prices = prices
+
+        self.user_id = user_id
+        self.session_id = session_id
+        self.ledger = ledger
+
+        # Running aggregates, updated by log_usage; sessions may log from several threads.
+        self._lock = threading.Lock()
+        self.entries = 0
+        self.totals = dict.fromkeys(
+            ["input_tokens", "cached_tokens", "output_tokens", "output_tokens_saved_est",
+             "input_cost", "output_cost", "total_cost"], 0)
+        self.by_model = {}
+        self.by_input_mode = {}
+        self.by_file = {}
+
+    def log_usage(self, model_name, input_tokens, output_tokens, filename="Unknown_File",
+                  input_mode=None, latency_s=None, cached_tokens=0, output_tokens_saved_est=0):
         """
         Logs usage with a specific filename tag.
+        input_mode / latency_s let cost and latency be compared per input mode.
+        cached_tokens (part of input_tokens) are billed at cache_read_input_token_cost.
+        output_tokens_saved_est is what the compact wire keys saved versus full column names.
         """
-        full_model_name = self.map.get(model_name)
-        if full_model_name is None:
+        priced = self.prices.lookup(model_name)
+        if priced is None:
             print(f"Warning: Model short-name '{model_name}' not found in price map. Skipping cost.")
             return
-        
-        model_costs=self.cost_data.get(full_model_name)
-        if model_costs is None:
-            print(f"Warning: Model full-name '{full_model_name}' not found in cost data. Skipping cost.")
-            return
+        full_model_name, model_costs = priced
 
-        input_cost=model_costs["input_cost_per_token"] * input_tokens
+        cached_tokens = min(cached_tokens or 0, input_tokens)
+        cache_read_price = model_costs.get("cache_read_input_token_cost")
+        if cache_read_price is None:
+            cache_read_price = model_costs["input_cost_per_token"]
+
+        input_cost=model_costs["input_cost_per_token"] * (input_tokens - cached_tokens) + cache_read_price * cached_tokens
         output_cost=model_costs["output_cost_per_token"] * output_tokens
         total_cost=input_cost + output_cost
         
-        self.logger.append({
+        entry = {
             "filename": filename,
             "model_name": full_model_name,
             "input_tokens": input_tokens,
+            "cached_tokens": cached_tokens,
             "output_tokens": output_tokens,
             "input_cost": input_cost,
             "output_cost": output_cost,
-            "total_cost": total_cost
-        })
+            "total_cost": total_cost,
+            "input_mode": input_mode or "unknown",
+            "latency_s": latency_s,
+            "output_tokens_saved_est": output_tokens_saved_est or 0
+        }
+
+        with self._lock:
+            self.entries += 1
+            for key in self.totals:
+                self.totals[key] += entry[key]
+
+            self.by_model[full_model_name] = self.by_model.get(full_model_name, 0) + total_cost
+
+            mode = self.by_input_mode.setdefault(entry["input_mode"], {
+                "files": 0, "input_tokens": 0, "output_tokens": 0, "total_cost": 0,
+                "latency_sum": 0.0, "latency_count": 0
+            })
+            mode["files"] += 1
+            mode["input_tokens"] += input_tokens
+            mode["output_tokens"] += output_tokens
+            mode["total_cost"] += total_cost
+            if latency_s is not None:
+                mode["latency_sum"] += latency_s
+                mode["latency_count"] += 1
+
+            # The first call logged for a file names its model and input mode.
+            file_stats = self.by_file.setdefault(filename, {
+                "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "output_tokens_saved_est": 0,
+                "total_cost": 0, "model_used": full_model_name, "input_mode": entry["input_mode"]
+            })
+            for key in ("input_tokens", "cached_tokens", "output_tokens", "output_tokens_saved_est", "total_cost"):
+                file_stats[key] += entry[key]
+
+        # Only queued here; the ledger's writer thread does the SQLite work.
+        if self.ledger is not None:
+            self.ledger.record(entry, self.user_id, self.session_id)
+
+    def running_totals(self):
+        """
+        Small snapshot of the aggregates so far, for progress updates while a session runs.
+        """
+        with self._lock:
+            return {
+                "calls": self.entries,
+                "input_tokens": int(self.totals["input_tokens"]),
+                "output_tokens": int(self.totals["output_tokens"]),
+                "total_cost": round(float(self.totals["total_cost"]), 6),
+            }
 
     def generate_total(self):
         """
         Generates a summary AND an itemized breakdown per file.
+        Reads the running aggregates; nothing is recomputed from the individual calls.
         """
-        if not self.logger:
+        if not self.entries:
             print("No usage logged")
             return {
                 "summary": {
                     "total_input_tokens": 0,
+                    "total_cached_tokens": 0,
                     "total_output_tokens": 0,
+                    "total_output_tokens_saved_est": 0,
                     "total_cost": 0.0,
-                    "cost_by_model": {}
+                    "cost_by_model": {},
+                    "cost_by_input_mode": {}
                 },
                 "files": {}
             }
-            
-        df = pd.DataFrame(self.logger)
-        
-        total_input_tokens = df["input_tokens"].sum()
-        total_output_tokens = df["output_tokens"].sum()
-        total_input_cost = df["input_cost"].sum()
-        total_output_cost = df["output_cost"].sum()
-        total_cost = df["total_cost"].sum()
-        cost_by_model = df.groupby("model_name")["total_cost"].sum().to_dict()
-        
-        files_breakdown = {}
-        file_groups = df.groupby("filename")
-        
-        for name, group in file_groups:
-            files_breakdown[name] = {
-                "input_tokens": int(group["input_tokens"].sum()),
-                "output_tokens": int(group["output_tokens"].sum()),
-                "total_cost": round(float(group["total_cost"].sum()), 6),
-                "model_used": group["model_name"].iloc[0] if not group.empty else "Unknown"
-            }
+
+        with self._lock:
+            totals = dict(self.totals)
+            cost_by_model = {name: float(cost) for name, cost in sorted(self.by_model.items())}
+
+            cost_by_input_mode = {}
+            for mode, stats in sorted(self.by_input_mode.items()):
+                cost_by_input_mode[mode] = {
+                    "files": stats["files"],
+                    "input_tokens": int(stats["input_tokens"]),
+                    "output_tokens": int(stats["output_tokens"]),
+                    "total_cost": round(float(stats["total_cost"]), 6),
+                    "avg_cost_per_file": round(float(stats["total_cost"]) / stats["files"], 6),
+                    "avg_latency_s": round(stats["latency_sum"] / stats["latency_count"], 2) if stats["latency_count"] else None
+                }
+
+            files_breakdown = {}
+            for name, stats in sorted(self.by_file.items()):
+                files_breakdown[name] = {
+                    "input_tokens": int(stats["input_tokens"]),
+                    "cached_tokens": int(stats["cached_tokens"]),
+                    "output_tokens": int(stats["output_tokens"]),
+                    "output_tokens_saved_est": int(stats["output_tokens_saved_est"]),
+                    "total_cost": round(float(stats["total_cost"]), 6),
+                    "model_used": stats["model_used"],
+                    "input_mode": stats["input_mode"]
+                }
 
         return {
             "summary": {
-                "total_input_tokens": int(total_input_tokens),
-                "total_output_tokens": int(total_output_tokens),
-                "total_input_cost": total_input_cost,
-                "total_output_cost": total_output_cost,
-                "total_cost": total_cost,
-                "cost_by_model": cost_by_model
+                "total_input_tokens": int(totals["input_tokens"]),
+                "total_cached_tokens": int(totals["cached_tokens"]),
+                "total_output_tokens": int(totals["output_tokens"]),
+                "total_output_tokens_saved_est": int(totals["output_tokens_saved_est"]),
+                "total_input_cost": float(totals["input_cost"]),
+                "total_output_cost": float(totals["output_cost"]),
+                "total_cost": float(totals["total_cost"]),
+                "cost_by_model": cost_by_model,
+                "cost_by_input_mode": cost_by_input_mode
             },
             "files": files_breakdown
         }
-
-
-    
-
-    
-        
-        
\ No newline at end of file
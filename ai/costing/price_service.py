@@ -0,0 +1,227 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+from config.settings import (
+    GEMINI_ENGINE, PRICE_CACHE_FILE, PRICE_REFRESH_TTL_SECONDS, PRICES_OFFLINE,
+)
+
+PRICE_URL = "https://raw.githubusercontent.com/BerriAI/litellm/main/model_prices_and_context_window.json"
+# Shipped with the code; used until a refresh has succeeded, and whenever the network is unavailable.
+BUNDLED_PRICES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_prices.json")
+FETCH_TIMEOUT_SECONDS = 10
+# A failed refresh is retried after this long instead of waiting a full TTL.
+RETRY_SECONDS = 600
+# When one short name exists under several providers, Gemini API keys are billed as "gemini".
+PREFERRED_PROVIDERS = ("gemini",)
+
+
+def compact_price_list(data):
+    """
+    Keeps only the fields the cost manager and context limits use, for every model.
+    """
+    full_price_list = {}
+    for model_name, details in data.items():
+        if not isinstance(details, dict):
+            continue
+        full_price_list[model_name] = {
+            "litellm_provider": details.get("litellm_provider"),
+            "mode": details.get("mode"),
+            "input_cost_per_token": details.get("input_cost_per_token", 0),
+            "output_cost_per_token": details.get("output_cost_per_token", 0),
+            "cache_read_input_token_cost": details.get("cache_read_input_token_cost"),
+            "cache_creation_input_token_cost": details.get("cache_creation_input_token_cost"),
+            "max_tokens": details.get("max_tokens"),
+            "max_input_tokens": details.get("max_input_tokens"),
+            "max_output_tokens": details.get("max_output_tokens")
+        }
+    return full_price_list
+
+
+def resolve_model(price_list, model_name):
+    """
+    Finds the price entry for a model name as configured (e.g. "gemini-2.5-flash").
+    Prefers the PREFERRED_PROVIDERS entry, then an exact key, then the first entry
+    with that short name, so the answer no longer depends on which provider
+    happens to be listed last.
+    Returns (full_name, prices) or None.
+    """
+    if not model_name:
+        return None
+    for provider in PREFERRED_PROVIDERS:
+        full_name = f"{provider}/{model_name}"
+        if full_name in price_list:
+            return full_name, price_list[full_name]
+    if model_name in price_list:
+        return model_name, price_list[model_name]
+    for full_name, prices in price_list.items():
+        if full_name.split("/")[-1] == model_name:
+            return full_name, prices
+    return None
+
+
+def _write_json_atomic(path, payload):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".json", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class PriceService:
+    """
+    Model prices for the cost manager, kept as a small in-memory index of only
+    the models in use.
+
+    Prices come from the last refreshed copy in the cache directory, or from
+    the bundled snapshot. A background task re-checks the LiteLLM price file
+    once per TTL with If-None-Match / If-Modified-Since, so an unchanged file
+    costs a 304 and nothing is re-parsed. Nothing on the request path touches
+    the network, and with PRICES_OFFLINE the service never does.
+    """
+
+    def __init__(self, models=(GEMINI_ENGINE,), cache_file=PRICE_CACHE_FILE, snapshot_file=BUNDLED_PRICES_FILE,
+                 url=PRICE_URL, ttl_seconds=PRICE_REFRESH_TTL_SECONDS, offline=PRICES_OFFLINE):
+        self.cache_file = cache_file
+        self.meta_file = os.path.splitext(cache_file)[0] + ".meta.json"
+        self.snapshot_file = snapshot_file
+        self.url = url
+        self.ttl_seconds = ttl_seconds
+        self.offline = offline
+        self._models = {m for m in models if m}
+        self._index = {}
+        # Guards the model set and index swaps; held only briefly, never across a fetch.
+        self._index_lock = threading.Lock()
+        # Keeps two refreshes from fetching at once.
+        self._refresh_lock = threading.Lock()
+        self._task = None
+        self._load_index()
+
+    def _read_price_list(self):
+        for path in (self.cache_file, self.snapshot_file):
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, "r") as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Could not read model prices from {path}: {e}")
+        return {}
+
+    def _load_index(self, price_list=None):
+        if price_list is None:
+            price_list = self._read_price_list()
+        index = {}
+        for model_name in self._models:
+            entry = resolve_model(price_list, model_name)
+            if entry:
+                index[model_name] = entry
+        # Swapped in one assignment; readers never see a half-built index.
+        self._index = index
+
+    def lookup(self, model_name):
+        """
+        Returns (full_name, prices) for a model name, or None if it is not priced.
+        A model outside the index is looked up once from disk and then kept.
+        """
+        entry = self._index.get(model_name)
+        if entry is None and model_name and model_name not in self._models:
+            with self._index_lock:
+                self._models.add(model_name)
+                self._load_index()
+            entry = self._index.get(model_name)
+        return entry
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def refresh_if_stale(self):
+        """
+        Re-checks the remote price file when the TTL has passed (blocking; run it
+        in a thread). Returns True if new prices were loaded.
+        """
+        if self.offline:
+            return False
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            return self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self):
+        meta = self._read_meta()
+        now = time.time()
+        if now - meta.get("checked_at", 0) < self.ttl_seconds:
+            return False
+
+        headers = {}
+        if os.path.exists(self.cache_file):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        # The fetch runs without the index lock, so lookups never wait on the network.
+        try:
+            response = requests.get(self.url, headers=headers, timeout=FETCH_TIMEOUT_SECONDS)
+            if response.status_code == 304:
+                _write_json_atomic(self.meta_file, {**meta, "checked_at": now})
+                return False
+            response.raise_for_status()
+            price_list = compact_price_list(response.json())
+        except (requests.RequestException, ValueError) as e:
+            print(f"⚠️ Model price refresh failed: {e}. Keeping current prices.")
+            _write_json_atomic(self.meta_file, {**meta, "checked_at": now - self.ttl_seconds + RETRY_SECONDS})
+            return False
+
+        with self._index_lock:
+            _write_json_atomic(self.cache_file, price_list)
+            self._load_index(price_list)
+        _write_json_atomic(self.meta_file, {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked_at": now,
+        })
+        print(f"✅ Model prices refreshed: {len(price_list)} models.")
+        return True
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh_if_stale)
+            except Exception as e:
+                print(f"⚠️ Model price refresh error: {e}")
+            await asyncio.sleep(min(self.ttl_seconds, RETRY_SECONDS))
+
+    def start(self):
+        """
+        Starts the background refresh task on the running event loop.
+        """
+        if self._task is None and not self.offline:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+price_service = PriceService()
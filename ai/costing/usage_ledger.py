@@ -0,0 +1,194 @@
+import os
+import queue
+import atexit
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config.settings import USAGE_LEDGER_FILE
+
+SUM_COLUMNS = ("input_tokens", "cached_tokens", "output_tokens", "output_tokens_saved_est",
+               "input_cost", "output_cost", "total_cost")
+
+
+class UsageLedger:
+    """
+    Append-only SQLite ledger of every priced model call, shared by all sessions.
+
+    Each call is stored as a usage row and, in the same transaction, added to a
+    per (month, user, model) rollup, so monthly or per-user cost questions are
+    answered from the rollup without rescanning the ledger.
+
+    Writes are queued and made by one background thread, a batch per
+    transaction, so logging a call never waits on SQLite. Reads flush the
+    queue first.
+    """
+
+    def __init__(self, db_path=USAGE_LEDGER_FILE):
+        self.db_path = db_path
+        self._pending = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    month TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    session_id TEXT,
+                    filename TEXT,
+                    model_name TEXT NOT NULL,
+                    input_mode TEXT,
+                    input_tokens INTEGER NOT NULL,
+                    cached_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    output_tokens_saved_est INTEGER NOT NULL,
+                    input_cost REAL NOT NULL,
+                    output_cost REAL NOT NULL,
+                    total_cost REAL NOT NULL,
+                    latency_s REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_usage_session ON usage (user_id, session_id);
+
+                CREATE TABLE IF NOT EXISTS usage_monthly (
+                    month TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    calls INTEGER NOT NULL,
+                    input_tokens INTEGER NOT NULL,
+                    cached_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    output_tokens_saved_est INTEGER NOT NULL,
+                    input_cost REAL NOT NULL,
+                    output_cost REAL NOT NULL,
+                    total_cost REAL NOT NULL,
+                    PRIMARY KEY (month, user_id, model_name)
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, entry, user_id=None, session_id=None):
+        """
+        Queues one CostManager usage entry for the writer thread and returns at once.
+        """
+        now = time.time()
+        self._pending.put((now, user_id or "local", session_id, dict(entry)))
+        self._start_writer()
+
+    def _start_writer(self):
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                # Entries still queued at interpreter exit are written first.
+                atexit.register(self.flush)
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="usage-ledger", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            while True:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    def _write(self, batch):
+        """
+        Appends a batch of queued entries. Failures are reported, never raised,
+        so a locked or read-only ledger cannot fail an extraction.
+        """
+        usage_rows, monthly_rows = [], []
+        for now, user_id, session_id, entry in batch:
+            month = time.strftime("%Y-%m", time.localtime(now))
+            sums = tuple(entry[c] for c in SUM_COLUMNS)
+            usage_rows.append((now, month, user_id, session_id, entry["filename"], entry["model_name"],
+                               entry["input_mode"], entry["latency_s"], *sums))
+            monthly_rows.append((month, user_id, entry["model_name"], *sums))
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    f"""
+                    INSERT INTO usage (ts, month, user_id, session_id, filename, model_name, input_mode,
+                                       latency_s, {", ".join(SUM_COLUMNS)})
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, {", ".join("?" * len(SUM_COLUMNS))})
+                    """,
+                    usage_rows,
+                )
+                conn.executemany(
+                    f"""
+                    INSERT INTO usage_monthly (month, user_id, model_name, calls, {", ".join(SUM_COLUMNS)})
+                    VALUES (?, ?, ?, 1, {", ".join("?" * len(SUM_COLUMNS))})
+                    ON CONFLICT (month, user_id, model_name) DO UPDATE SET
+                        calls = calls + 1,
+                        {", ".join(f"{c} = {c} + excluded.{c}" for c in SUM_COLUMNS)}
+                    """,
+                    monthly_rows,
+                )
+        except sqlite3.Error as e:
+            print(f"   > ⚠️ Usage ledger write failed: {e}")
+
+    def flush(self):
+        """
+        Blocks until every queued entry has been written (or reported as failed).
+        """
+        if self._writer is not None and self._writer.is_alive():
+            self._pending.join()
+
+    def monthly(self, month=None, user_id=None):
+        """
+        Cost rollup rows, optionally for one month ("YYYY-MM") and/or one user.
+        """
+        clauses, params = [], []
+        if month:
+            clauses.append("month = ?")
+            params.append(month)
+        if user_id:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        self.flush()
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                f"SELECT * FROM usage_monthly {where} ORDER BY month, user_id, model_name", params
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def session(self, user_id, session_id):
+        """
+        The usage rows of one session, oldest first.
+        """
+        self.flush()
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM usage WHERE user_id = ? AND session_id = ? ORDER BY id",
+                (user_id, session_id),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+usage_ledger = UsageLedger()
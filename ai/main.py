@@ -1,40 +1,56 @@
 import os
 import json
 import asyncio
-from config.settings import DATA_DIR, OUTPUT_DIR, GEMINI_ENGINE
-from core.pdf_utils import convert_pdf_to_images
-from core.schema_manager import load_schemas, update_schema_memory
-from core.ai_extractor import extract_invoice_with_rotation
-from core.excel_writer import update_excel_sheet
+from config.settings import DATA_DIR, OUTPUT_DIR, GEMINI_ENGINE, EXCEL_FILE
+from core.pdf_utils import prepare_pdf_pages_async, shutdown_raster_pool
+from core.schema_manager import schema_registry, update_schema_memory
+from core.ai_extractor import extract_invoice_with_rotation, retry_policy
+from core.extraction_cache import extraction_cache
+from core.gemini_clients import gemini_clients
+from core.key_scheduler import key_scheduler
+from core.excel_writer import update_excel_sheet, report_session
 from core.logger import setup_logger
 from costing.cost_manager import CostManager
-from costing.price_updater import update_model_prices
+from costing.price_service import price_service
 
 logger = setup_logger()
 
-MAX_CONCURRENT_TASKS = 3 
+# Files allowed to rasterize ahead of the Gemini calls, so CPU and network overlap.
+# Concurrent Gemini calls themselves are capped process-wide by key_scheduler.concurrency (AIMD).
+RASTER_PREFETCH = 3
 
-async def process_single_invoice_async(file_path, schemas, semaphore):
+async def process_single_invoice_async(file_path, schema, semaphore, prefetch_semaphore):
     """
     Async Worker function.
-    Uses a semaphore to limit concurrency.
+    prefetch_semaphore bounds files in flight; semaphore bounds concurrent Gemini requests.
     """
-    async with semaphore:
-        filename = os.path.basename(file_path)
-        parent_folder = os.path.basename(os.path.dirname(file_path))
-        
+    filename = os.path.basename(file_path)
+    parent_folder = os.path.basename(os.path.dirname(file_path))
+    cache_key = extraction_cache.key_for(file_path, schema.schema_hash)
+    cached = extraction_cache.get(cache_key)
+
+    async with prefetch_semaphore:
         try:
-            images = convert_pdf_to_images(file_path)
-            
-            if not images:
-                return None, None, f"Skipped (Image Conversion Failed): {filename}"
+            if cached:
+                invoices_list, usage_stats = cached
+            else:
+                images = await prepare_pdf_pages_async(file_path)
+                
+                if not images:
+                    return None, None, f"Skipped (Image Conversion Failed): {filename}"
 
-            invoices_list, usage_stats = await extract_invoice_with_rotation(images, schemas)
+                # Rasterizing runs ahead of the model calls; only the Gemini requests are gated.
+                invoices_list, usage_stats = await extract_invoice_with_rotation(
+                    images, schema.columns, lambda page_count: semaphore
+                )
+                extraction_cache.put(cache_key, invoices_list, usage_stats)
             
             if invoices_list:
-                return invoices_list, usage_stats, f"Success: {parent_folder}/{filename} (Found {len(invoices_list)} invoices)"
+                cached_note = " [cached]" if cached else ""
+                return invoices_list, usage_stats, f"Success{cached_note}: {parent_folder}/{filename} (Found {len(invoices_list)} invoices)"
             else:
-                return None, None, f"Failed (AI returned no data): {filename}"
+                # The calls that were made are billed even when they produced nothing.
+                return None, usage_stats, f"Failed (AI returned no data): {filename}"
                 
         except Exception as e:
             return None, None, f"Error processing {filename}: {str(e)}"
@@ -42,12 +58,12 @@ async def process_single_invoice_async(file_path, schemas, semaphore):
 async def main_async():
     logger.info("🚀 Starting Mizhou Invoice Extraction System (Async Mode)...")
     
-    logger.info("💰 Updating Model Prices...")
-    update_model_prices()
+    # Prices refresh in the background; costs use the current snapshot meanwhile.
+    price_service.start()
     cost_manager = CostManager()
 
     logger.info(f"📂 Scanning Data Root: {DATA_DIR}")
-    schemas = load_schemas()
+    schema = schema_registry.snapshot()
     
     pdf_files = []
     for root, dirs, files in os.walk(DATA_DIR):
@@ -62,31 +78,50 @@ async def main_async():
 
     logger.info(f"   > Found {len(pdf_files)} PDF(s). Starting execution...")
     
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+    semaphore = key_scheduler.concurrency
+    prefetch_semaphore = asyncio.Semaphore(semaphore.max_limit + RASTER_PREFETCH)
 
     tasks = [
-        process_single_invoice_async(f, schemas, semaphore) 
+        process_single_invoice_async(f, schema, semaphore, prefetch_semaphore) 
         for f in pdf_files
     ]
 
-    results = await asyncio.gather(*tasks)
-    for i, (invoices_found, usage_stats, status_msg) in enumerate(results, 1):
-        logger.info(f"[{i}/{len(pdf_files)}] {status_msg}")
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        shutdown_raster_pool()
+        await gemini_clients.aclose()
+    with report_session(EXCEL_FILE):
+        for i, (invoices_found, usage_stats, status_msg) in enumerate(results, 1):
+            logger.info(f"[{i}/{len(pdf_files)}] {status_msg}")
         
-        if usage_stats:
-            cost_manager.log_usage(
-                model_name=GEMINI_ENGINE,
-                input_tokens=usage_stats["input_tokens"],
-                output_tokens=usage_stats["output_tokens"]
-            )
+            if usage_stats and not usage_stats.get("cache_hit"):
+                cost_manager.log_usage(
+                    model_name=GEMINI_ENGINE,
+                    input_tokens=usage_stats["input_tokens"],
+                    output_tokens=usage_stats["output_tokens"],
+                    filename=os.path.basename(pdf_files[i - 1]),
+                    input_mode=usage_stats.get("input_mode"),
+                    latency_s=usage_stats.get("latency_s"),
+                    cached_tokens=usage_stats.get("cached_tokens", 0),
+                    output_tokens_saved_est=usage_stats.get("output_tokens_saved_est", 0)
+                )
 
-        if invoices_found:
-            for invoice_data in invoices_found:
-                vendor_name = invoice_data.get("vendor_name", invoice_data.get("Vendor Name", "Unknown"))
+            if invoices_found:
+                for invoice_data in invoices_found:
+                    vendor_name = invoice_data.get("vendor_name", invoice_data.get("Vendor Name", "Unknown"))
                 
-                final_columns = update_excel_sheet(vendor_name, invoice_data)
-                if final_columns:
-                    update_schema_memory(vendor_name, final_columns)
+                    final_columns = update_excel_sheet(vendor_name, invoice_data)
+                    if final_columns:
+                        update_schema_memory(vendor_name, final_columns)
+
+    cache_stats = extraction_cache.stats()
+    logger.info(f"🗃️  Extraction cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    retry_stats = retry_policy.snapshot()
+    hedging = retry_stats["hedging"]
+    logger.info(f"🏁 Hedged calls: {hedging['fired']} fired, {hedging['won']} won, {hedging['lost']} lost, "
+                f"{hedging['loser_tokens']} tokens billed to losers (+~{hedging['cancelled_tokens_est']} cancelled); "
+                f"errors: {retry_stats['errors'] or 'none'}")
 
     logger.info("📊 Generating Financial Report...")
     financial_summary = cost_manager.generate_total()
@@ -105,6 +140,7 @@ async def main_async():
     except Exception as e:
         logger.error(f"❌ Failed to save costing.json: {e}")
 
+    await price_service.stop()
     logger.info(f"🎉 All files processed. Excel Output: {os.path.join(OUTPUT_DIR, 'Consolidated_Report.xlsx')}")
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import unittest
+
+from core.page_windows import merge_window_results, ROW_NUMBER_KEY
+from core.ai_extractor import continuation_note
+
+
+def item(row, description):
+    return {ROW_NUMBER_KEY: row, "Asset Description": description, "Qty": 1}
+
+
+class ContinuationMergeTest(unittest.TestCase):
+    def test_continuation_appends_the_rest_of_the_last_invoice(self):
+        first = [{"Invoice No": "A1", "Vendor Name": "Acme", "Line Items": [item(1, "Desk"), item(2, "Chair")]}]
+        rest = [
+            {"Invoice No": "A1", "Vendor Name": "Acme", "Line Items": [item(2, "Chair"), item(3, "Lamp")]},
+            {"Invoice No": "B7", "Vendor Name": "Acme", "Line Items": [item(1, "Shelf")]},
+        ]
+        merged = merge_window_results([first, rest])
+
+        self.assertEqual([invoice["Invoice No"] for invoice in merged], ["A1", "B7"])
+        self.assertEqual([i["Asset Description"] for i in merged[0]["Line Items"]], ["Desk", "Chair", "Lamp"])
+        self.assertNotIn(ROW_NUMBER_KEY, merged[0]["Line Items"][0])
+
+    def test_rows_without_row_numbers_are_all_kept(self):
+        first = [{"Invoice No": "A1", "Line Items": [{"Asset Description": "Bolt", "Qty": 1}]}]
+        rest = [{"Invoice No": "A1", "Line Items": [{"Asset Description": "Bolt", "Qty": 1}]}]
+        merged = merge_window_results([first, rest])
+        self.assertEqual(len(merged[0]["Line Items"]), 2)
+
+    def test_note_lists_where_the_answer_stopped(self):
+        invoices = [{"Invoice No": "A1", "Line Items": [item(1, "Desk"), item(2, "Chair")]}]
+        note = continuation_note(invoices, with_row_numbers=True)
+        self.assertIn('Invoice No "A1": 2 line items, the last one being "Chair"', note)
+        self.assertIn(ROW_NUMBER_KEY, note)
+        self.assertNotIn(ROW_NUMBER_KEY, continuation_note(invoices, with_row_numbers=False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import asyncio
+import unittest
+
+from core.fair_scheduler import FairScheduler
+from core.key_scheduler import AdaptiveConcurrencyLimiter
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def run_queued(scheduler, jobs):
+    """
+    Queues `jobs` ((user, size, name) tuples) behind a call holding the only
+    slot, releases it and returns the names in the order they were admitted.
+    """
+    order = []
+    release = asyncio.Event()
+
+    async def hold():
+        async with scheduler.slot("holder"):
+            await release.wait()
+
+    async def job(user, size, name):
+        async with scheduler.slot(user, job_size=size, session_key=user):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    holder = asyncio.create_task(hold())
+    await settle()
+    tasks = [asyncio.create_task(job(*entry)) for entry in jobs]
+    await settle()
+    release.set()
+    await asyncio.gather(holder, *tasks)
+    return order
+
+
+class FairSchedulerTest(unittest.TestCase):
+    def test_two_users_alternate_regardless_of_arrival(self):
+        scheduler = FairScheduler(max_concurrent=1)
+        jobs = [("a", 1, f"a{i}") for i in range(3)] + [("b", 1, f"b{i}") for i in range(3)]
+        order = asyncio.run(run_queued(scheduler, jobs))
+        self.assertEqual(order, ["a0", "b0", "a1", "b1", "a2", "b2"])
+        self.assertEqual(scheduler.in_flight, 0)
+
+    def test_weights_and_page_counts_set_the_share(self):
+        scheduler = FairScheduler(max_concurrent=1, weights={"a": 2})
+        jobs = [("a", 1, f"a{i}") for i in range(3)] + [("b", 1, f"b{i}") for i in range(3)]
+        self.assertEqual(asyncio.run(run_queued(scheduler, jobs)), ["a0", "b0", "a1", "a2", "b1", "b2"])
+
+        # A user's big job is charged its page count, so the other user catches up.
+        scheduler = FairScheduler(max_concurrent=1)
+        jobs = [("a", 4, "a-big"), ("a", 4, "a-big2"), ("b", 1, "b0"), ("b", 1, "b1"), ("b", 1, "b2")]
+        self.assertEqual(asyncio.run(run_queued(scheduler, jobs)), ["a-big", "b0", "b1", "b2", "a-big2"])
+
+    def test_shortest_job_first_within_a_user(self):
+        scheduler = FairScheduler(max_concurrent=1)
+        jobs = [("a", 9, "long"), ("a", 1, "short"), ("a", 3, "medium")]
+        self.assertEqual(asyncio.run(run_queued(scheduler, jobs)), ["short", "medium", "long"])
+
+    def test_capacity_follows_the_aimd_limit(self):
+        async def scenario():
+            limiter = AdaptiveConcurrencyLimiter(initial=2, minimum=1, maximum=8)
+            scheduler = FairScheduler(limiter=limiter, max_concurrent=4)
+            release = asyncio.Event()
+            peak = 0
+
+            async def call(user):
+                nonlocal peak
+                async with scheduler.slot(user):
+                    peak = max(peak, scheduler.in_flight)
+                    await release.wait()
+
+            tasks = [asyncio.create_task(call(user)) for user in ("a", "b", "a", "b", "a")]
+            await settle()
+            capped = (scheduler.capacity(), scheduler.in_flight, scheduler.snapshot()["queue_depth"])
+
+            limiter.limit = 100.0
+            release.set()
+            await asyncio.gather(*tasks)
+            return capped, peak, scheduler.capacity()
+
+        capped, peak, raised = asyncio.run(scenario())
+        self.assertEqual(capped, (2, 2, 3))
+        # The global cap still applies once the AIMD limit grows past it.
+        self.assertEqual(raised, 4)
+        self.assertLessEqual(peak, 4)
+
+    def test_cancelled_waiter_leaves_the_queue(self):
+        async def wait_for_slot(scheduler):
+            async with scheduler.slot("b", session_key="s1"):
+                pass
+
+        async def scenario():
+            scheduler = FairScheduler(max_concurrent=1)
+            release = asyncio.Event()
+
+            async def hold():
+                async with scheduler.slot("a"):
+                    await release.wait()
+
+            holder = asyncio.create_task(hold())
+            await settle()
+            waiting = asyncio.create_task(wait_for_slot(scheduler))
+            await settle()
+            depth = scheduler.snapshot()["queue_depth"]
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            release.set()
+            await holder
+            return depth, scheduler.snapshot()
+
+        depth, snapshot = asyncio.run(scenario())
+        self.assertEqual(depth, 1)
+        self.assertEqual((snapshot["queue_depth"], snapshot["in_flight"]), (0, 0))
+
+    def test_snapshot_reports_session_waits_until_forgotten(self):
+        scheduler = FairScheduler(max_concurrent=1)
+        asyncio.run(run_queued(scheduler, [("a", 1, "a0"), ("a", 1, "a1")]))
+        self.assertEqual(scheduler.snapshot("a")["session"]["started"], 2)
+
+        scheduler.forget_session("a")
+        self.assertEqual(scheduler.snapshot("a")["session"]["started"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import unittest
+from unittest import mock
+
+from core import pdf_utils
+from core.pdf_utils import resolve_input_mode, vendor_folder
+
+INPUT_MODES = {"HP Inc": "image", "Acme": "pdf", "Globex": "bogus"}
+
+
+class ResolveInputModeTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(pdf_utils, "load_input_modes", return_value=INPUT_MODES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        default = mock.patch.object(pdf_utils, "EXTRACTION_INPUT_MODE", "auto")
+        default.start()
+        self.addCleanup(default.stop)
+
+    def test_vendor_folder_selects_the_override(self):
+        self.assertEqual(resolve_input_mode(os.path.join("data", "HP Inc", "march.pdf")), "image")
+        self.assertEqual(resolve_input_mode(os.path.join("data", "acme", "0001.pdf")), "pdf")
+
+    def test_uploads_named_for_a_vendor_resolve_through_their_folder(self):
+        folder = vendor_folder("HP Inc.")
+        self.assertEqual(folder, "HP-Inc")
+        self.assertEqual(resolve_input_mode(os.path.join("uploads", "u1", "s1", folder, "scan_07.pdf")), "image")
+        self.assertIsNone(vendor_folder("  ./  "))
+
+    def test_file_name_matches_whole_words_only(self):
+        session_dir = os.path.join("uploads", "u1", "s1")
+        self.assertEqual(resolve_input_mode(os.path.join(session_dir, "hp_inc_invoice_03.pdf")), "image")
+        self.assertEqual(resolve_input_mode(os.path.join(session_dir, "Acme-2025-11.pdf")), "pdf")
+        self.assertEqual(resolve_input_mode(os.path.join(session_dir, "acmeco.pdf")), "auto")
+        # The folder must be the vendor name itself, not merely contain it.
+        self.assertEqual(resolve_input_mode(os.path.join("data", "acme-archive", "x.pdf")), "auto")
+
+    def test_unknown_modes_fall_back_to_the_default(self):
+        self.assertEqual(resolve_input_mode(os.path.join("data", "Globex", "x.pdf")), "auto")
+
+
+if __name__ == "__main__":
+    unittest.main()
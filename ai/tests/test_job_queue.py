@@ -0,0 +1,70 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import worker
+from core.job_queue import JobQueue
+
+
+class AbandonedFileTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.queue = JobQueue(db_path=os.path.join(self.folder.name, "jobs.sqlite3"), lease_seconds=60, max_attempts=2)
+        self.queue.enqueue("job-1", "user-1", "session-1", ["/tmp/a.pdf", "/tmp/b.pdf"], "/tmp/report.xlsx")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def run_failing(self, lease, worker_id):
+        failing = mock.AsyncMock(side_effect=RuntimeError("poppler crashed"))
+        with mock.patch.object(worker, "job_queue", self.queue), \
+                mock.patch.object(worker, "_process_leased_file", failing):
+            asyncio.run(worker.process_leased_file(lease, worker_id, asyncio.Semaphore(1)))
+
+    def file_row(self, position):
+        with self.queue._connect() as conn:
+            return conn.execute(
+                "SELECT status, attempts, lease_owner, message FROM job_files WHERE job_id = 'job-1' AND position = ?",
+                (position,),
+            ).fetchone()
+
+    def test_failed_file_is_retried_then_failed_and_the_job_finishes(self):
+        first, second = self.queue.lease_files("w1", 2)
+        self.assertTrue(self.queue.complete_file("job-1", second["position"], "w1", [{"Invoice No": "B"}], {}, "ok"))
+
+        self.run_failing(first, "w1")
+        self.assertEqual(self.file_row(0)[:3], ("pending", 1, None))
+        self.assertIsNone(self.queue.claim_finished_job("w1"))
+
+        retry = self.queue.lease_files("w2", 1)
+        self.assertEqual([(lease["position"], lease["attempts"]) for lease in retry], [(0, 2)])
+        # Abandoning a lease held by another worker does nothing.
+        self.assertFalse(self.queue.abandon_file("job-1", 0, "w1", "stale"))
+
+        self.run_failing(retry[0], "w2")
+        status, attempts, owner, message = self.file_row(0)
+        self.assertEqual((status, attempts, owner), ("failed", 2, None))
+        self.assertIn("poppler crashed", message)
+
+        job = self.queue.claim_finished_job("w1")
+        self.assertEqual(job["job_id"], "job-1")
+        self.assertEqual([r["status"] for r in self.queue.file_results("job-1")], ["failed", "done"])
+
+    def test_heartbeat_only_extends_files_still_being_processed(self):
+        self.queue.lease_files("w1", 2)
+        with self.queue._connect() as conn:
+            conn.execute("UPDATE job_files SET lease_expires = 0")
+
+        self.queue.heartbeat("w1", [("job-1", 1)])
+
+        with self.queue._connect() as conn:
+            expires = dict(conn.execute("SELECT position, lease_expires FROM job_files").fetchall())
+        self.assertEqual(expires[0], 0)
+        self.assertGreater(expires[1], 0)
+        self.assertEqual([lease["position"] for lease in self.queue.lease_files("w2", 2)], [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from core import key_scheduler
+from core.key_scheduler import (
+    AdaptiveConcurrencyLimiter, CircuitBreaker, KeyScheduler, NoAvailableKeyError, TokenBucket,
+    QUOTA_COOLDOWN, THROTTLE_COOLDOWN,
+)
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(key_scheduler.time, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class APIError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class TokenBucketTest(ClockTestCase):
+    def test_refills_at_the_per_minute_rate_up_to_capacity(self):
+        bucket = TokenBucket(60)
+        bucket.consume(60)
+        self.assertEqual(bucket.wait_time(1), 1.0)
+
+        self.clock.now += 30
+        self.assertEqual(bucket.wait_time(30), 0.0)
+        self.assertEqual(bucket.wait_time(31), 1.0)
+
+        self.clock.now += 3600
+        self.assertEqual(bucket.wait_time(60), 0.0)
+        self.assertEqual(bucket.tokens, 60)
+
+    def test_overdraft_and_drain_delay_the_next_request(self):
+        bucket = TokenBucket(60)
+        bucket.consume(90)
+        self.assertEqual(bucket.wait_time(1), 31.0)
+        # Requests larger than the bucket wait for a full bucket instead of forever.
+        self.clock.now += 90
+        self.assertEqual(bucket.wait_time(1000), 0.0)
+
+        bucket.drain()
+        self.assertEqual(bucket.wait_time(1), 1.0)
+
+
+class CircuitBreakerTest(ClockTestCase):
+    def test_half_open_trial_closes_on_success(self):
+        breaker = CircuitBreaker()
+        breaker.trip(10)
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allows_request())
+
+        self.clock.now += 10
+        self.assertTrue(breaker.allows_request())
+        self.assertEqual(breaker.state, "half_open")
+        breaker.on_request()
+        # Only one trial request at a time.
+        self.assertFalse(breaker.allows_request())
+
+        breaker.on_success()
+        self.assertEqual((breaker.state, breaker.cooldown), ("closed", 0.0))
+        self.assertTrue(breaker.allows_request())
+
+    def test_failed_trial_reopens_with_a_doubled_cooldown(self):
+        breaker = CircuitBreaker()
+        breaker.trip(10)
+        self.clock.now += 10
+        breaker.allows_request()
+        breaker.on_request()
+
+        breaker.trip(10)
+        self.assertEqual((breaker.state, breaker.cooldown), ("open", 20))
+        self.clock.now += 19
+        self.assertFalse(breaker.allows_request())
+        self.clock.now += 1
+        self.assertTrue(breaker.allows_request())
+
+    def test_late_success_does_not_close_an_open_breaker(self):
+        breaker = CircuitBreaker()
+        breaker.trip(10)
+        breaker.on_success()
+        self.assertEqual(breaker.state, "open")
+
+    def test_released_trial_lets_another_request_try(self):
+        breaker = CircuitBreaker()
+        breaker.trip(10)
+        self.clock.now += 10
+        breaker.allows_request()
+        breaker.on_request()
+        breaker.release_trial()
+        self.assertTrue(breaker.allows_request())
+        self.assertEqual(breaker.state, "half_open")
+
+
+class AdaptiveConcurrencyLimiterTest(ClockTestCase):
+    def test_additive_increase_up_to_the_maximum(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=2, minimum=1, maximum=4)
+        # About one window of `limit` successes raises the limit by one.
+        for _ in range(2):
+            limiter.on_success()
+        self.assertEqual(int(limiter.limit), 2)
+        limiter.on_success()
+        self.assertEqual(int(limiter.limit), 3)
+
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(limiter.limit, 4)
+
+    def test_multiplicative_decrease_once_per_burst_down_to_the_minimum(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=8, minimum=2, maximum=16)
+        limiter.on_throttle()
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 4)
+
+        self.clock.now += THROTTLE_COOLDOWN
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 2)
+        self.clock.now += THROTTLE_COOLDOWN
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 2)
+
+    def test_callers_beyond_the_limit_wait_for_a_release(self):
+        async def scenario():
+            limiter = AdaptiveConcurrencyLimiter(initial=1, minimum=1, maximum=1)
+            order = []
+
+            async def call(name):
+                async with limiter:
+                    order.append(f"{name} start")
+                    await asyncio.sleep(0)
+                    self.assertEqual(limiter.in_flight, 1)
+                    order.append(f"{name} end")
+
+            await asyncio.gather(call("a"), call("b"))
+            return order, limiter.in_flight
+
+        order, in_flight = asyncio.run(scenario())
+        self.assertEqual(order, ["a start", "a end", "b start", "b end"])
+        self.assertEqual(in_flight, 0)
+
+
+class KeySchedulerTest(ClockTestCase):
+    def scheduler(self, keys=("key-a", "key-b"), rpm=60, tpm=100000):
+        return KeyScheduler(api_keys=list(keys), rpm=rpm, tpm=tpm)
+
+    def test_spreads_requests_over_the_least_busy_key(self):
+        async def scenario():
+            scheduler = self.scheduler()
+            first = await scheduler.acquire(100)
+            second = await scheduler.acquire(100)
+            return first.api_key, second.api_key
+
+        self.assertEqual(sorted(asyncio.run(scenario())), ["key-a", "key-b"])
+
+    def test_quota_failure_takes_the_key_out_of_rotation(self):
+        async def scenario():
+            scheduler = self.scheduler()
+            lease = await scheduler.acquire(100, exclude=("key-b",))
+            kind = scheduler.report_failure(lease, APIError(429, "RESOURCE_EXHAUSTED: quota exceeded per day"))
+            later = [(await scheduler.acquire(100)).api_key for _ in range(3)]
+            return kind, scheduler.keys[0].breaker, later
+
+        with mock.patch("builtins.print"):
+            kind, breaker, later = asyncio.run(scenario())
+        self.assertEqual(kind, "quota")
+        self.assertEqual((breaker.state, breaker.cooldown), ("open", QUOTA_COOLDOWN))
+        self.assertEqual(later, ["key-b"] * 3)
+
+    def test_throttle_drains_the_key_and_halves_concurrency(self):
+        async def scenario():
+            scheduler = self.scheduler(keys=("key-a",))
+            scheduler.concurrency.limit = 8.0
+            lease = await scheduler.acquire(100)
+            kind = scheduler.report_failure(lease, APIError(429, "RESOURCE_EXHAUSTED"))
+            return kind, scheduler
+
+        kind, scheduler = asyncio.run(scenario())
+        state = scheduler.keys[0]
+        self.assertEqual(kind, "throttled")
+        self.assertEqual(state.breaker.state, "closed")
+        self.assertGreater(state.requests.wait_time(1), 0)
+        self.assertEqual(scheduler.concurrency.limit, 4)
+        self.assertEqual((state.in_flight, state.failures), (0, 1))
+
+    def test_gives_up_when_every_key_stays_disabled(self):
+        async def scenario():
+            scheduler = self.scheduler()
+            for state in scheduler.keys:
+                state.breaker.trip(QUOTA_COOLDOWN)
+            await scheduler.acquire(100)
+
+        with self.assertRaises(NoAvailableKeyError):
+            asyncio.run(scenario())
+
+    def test_release_and_success_settle_the_lease(self):
+        async def scenario():
+            scheduler = self.scheduler(keys=("key-a",), tpm=10000)
+            lease = await scheduler.acquire(1000)
+            scheduler.release(lease)
+            lease = await scheduler.acquire(1000)
+            scheduler.report_success(lease, actual_tokens=3000)
+            return scheduler.keys[0]
+
+        state = asyncio.run(scenario())
+        self.assertEqual((state.in_flight, state.successes), (0, 1))
+        # Both estimates plus the 2000 tokens the second call used beyond its estimate.
+        self.assertEqual(state.tokens.tokens, 10000 - 1000 - 1000 - 2000)
+
+
+if __name__ == "__main__":
+    unittest.main()
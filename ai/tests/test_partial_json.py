@@ -0,0 +1,40 @@
+import json
+import unittest
+
+from core.partial_json import loads_partial
+
+
+INVOICES = [
+    {"Invoice No": "A1", "Line Items": [{"Asset Description": "Desk", "Qty": 1}, {"Asset Description": "Chair", "Qty": 4}]},
+    {"Invoice No": "A2", "Line Items": [{"Asset Description": "Lamp [LED]", "Qty": 2}]},
+]
+
+
+class LoadsPartialTest(unittest.TestCase):
+    def test_complete_json_is_not_truncated(self):
+        self.assertEqual(loads_partial(json.dumps(INVOICES)), (INVOICES, False))
+
+    def test_cut_inside_a_line_item_keeps_the_completed_ones(self):
+        text = json.dumps(INVOICES)
+        data, truncated = loads_partial(text[:text.index('"Chair"') + 3])
+        self.assertTrue(truncated)
+        self.assertEqual(data, [{"Invoice No": "A1", "Line Items": [{"Asset Description": "Desk", "Qty": 1}]}])
+
+    def test_cut_before_anything_closes_in_a_later_invoice_keeps_earlier_invoices(self):
+        text = json.dumps(INVOICES)
+        data, truncated = loads_partial(text[:text.index('"Lamp') + 4])
+        self.assertTrue(truncated)
+        self.assertEqual(data, [INVOICES[0]])
+
+    def test_brackets_inside_strings_are_not_structure(self):
+        text = json.dumps(INVOICES)
+        data, truncated = loads_partial(text[:text.index('"Qty": 2}') + len('"Qty": 2}') + 1])
+        self.assertTrue(truncated)
+        self.assertEqual(data, INVOICES)
+
+    def test_nothing_complete_returns_none(self):
+        self.assertEqual(loads_partial('[{"Invoice No": "A'), (None, True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from core import excel_writer
+from core.result_store import ResultStore
+
+COLUMNS = ["Vendor Name", "Invoice No", "Invoice Date", "Amount"]
+
+
+def frame(*rows):
+    return pd.DataFrame([dict(zip(COLUMNS, row)) for row in rows], columns=COLUMNS)
+
+
+class ResultStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.store = ResultStore(db_path=os.path.join(self.folder.name, "results.sqlite3"))
+        self.report = self.store.report_key(os.path.join(self.folder.name, "report.xlsx"))
+
+
+class ResultStoreTest(ResultStoreTestCase):
+    def test_append_stores_one_batch_per_frame_and_bumps_the_generation(self):
+        self.assertEqual(self.store.version(self.report), (0, 0))
+
+        self.store.append(self.report, {
+            "Acme": [frame(("Acme", "A-1", "27/11/2025", 10.5), ("Acme", "A-2", "", ""))],
+            "Globex": [frame(("Globex", "G-1", "04-November-2025", 3))],
+        }, user_id="u1", session_id="s1")
+        generation, watermark = self.store.version(self.report)
+        self.assertEqual(generation, 1)
+
+        batches = self.store.batches(self.report, 0, watermark)
+        self.assertEqual([(b["sheet_name"], b["row_count"]) for b in batches], [("Acme", 2), ("Globex", 1)])
+        self.assertEqual(batches[0]["columns"], COLUMNS)
+        # Empty cells are not stored.
+        self.assertEqual(list(self.store.iter_batch_rows(batches[0]["batch_id"])), [
+            {"Vendor Name": "Acme", "Invoice No": "A-1", "Invoice Date": "27/11/2025", "Amount": 10.5},
+            {"Vendor Name": "Acme", "Invoice No": "A-2"},
+        ])
+
+        self.store.append(self.report, {"Acme": [frame(("Acme", "A-3", "01/12/2025", 1))]})
+        self.assertEqual(self.store.version(self.report), (2, watermark + 1))
+        later = self.store.batches(self.report, watermark, watermark + 1)
+        self.assertEqual([b["row_count"] for b in later], [1])
+        self.assertEqual(self.store.reports_for_session("u1", "s1"), [self.report])
+
+    def test_query_uses_normalized_invoice_dates(self):
+        self.store.append(self.report, {"Acme": [frame(
+            ("Acme", "A-1", "27/11/2025", 1), ("Acme", "A-2", "04-November-2025", 2), ("Acme", "A-3", "soon", 3),
+        )]})
+        found = self.store.query(date_from="2025-11-01", date_to="2025-11-30")
+        self.assertEqual(sorted(r["invoice_no"] for r in found), ["A-1", "A-2"])
+        self.assertEqual([r["row"]["Amount"] for r in self.store.query(vendor="Acme", invoice_no="A-3")], [3])
+
+    def test_drop_report_forgets_rows_and_exports(self):
+        self.store.append(self.report, {"Acme": [frame(("Acme", "A-1", "", 1))]})
+        self.store.record_export(self.report, "csv", "out.csv", *self.store.version(self.report))
+        other = self.store.report_key(os.path.join(self.folder.name, "other.xlsx"))
+        self.store.append(other, {"Acme": [frame(("Acme", "B-1", "", 1))]})
+
+        self.store.drop_report(self.report)
+        self.assertEqual(self.store.version(self.report), (0, 0))
+        self.assertIsNone(self.store.export_state(self.report, "csv", "out.csv"))
+        self.assertEqual([r["invoice_no"] for r in self.store.query()], ["B-1"])
+
+
+class ExportCachingTest(ResultStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(mock.patch.stopall)
+        mock.patch.object(excel_writer, "result_store", self.store).start()
+        mock.patch.object(excel_writer, "load_schemas", lambda: tuple(COLUMNS)).start()
+        self.writes = mock.patch.object(excel_writer, "_write_flat", wraps=excel_writer._write_flat).start()
+        self.report_path = os.path.join(self.folder.name, "report.xlsx")
+
+    def export(self):
+        with mock.patch("builtins.print"):
+            return excel_writer.export_report(self.report_path, fmt="csv")
+
+    def test_export_is_reused_until_new_rows_arrive(self):
+        self.assertIsNone(self.export())
+
+        self.store.append(self.report, {"Acme": [frame(("Acme", "A-1", "", 1))]})
+        out_path = self.export()
+        self.assertEqual(out_path, os.path.join(self.folder.name, "report.csv"))
+        self.assertEqual(self.store.export_state(self.report, "csv", out_path),
+                         dict(zip(("generation", "watermark"), self.store.version(self.report))))
+
+        self.assertEqual(self.export(), out_path)
+        self.assertEqual(self.writes.call_count, 1)
+
+        self.store.append(self.report, {"Acme": [frame(("Acme", "A-2", "", 2))]})
+        self.export()
+        self.assertEqual(self.writes.call_count, 2)
+        with open(out_path, encoding="utf-8") as f:
+            self.assertEqual(f.read().splitlines(), [
+                "Sheet,Vendor Name,Invoice No,Invoice Date,Amount",
+                "Acme,Acme,A-1,,1",
+                "Acme,Acme,A-2,,2",
+            ])
+
+    def test_missing_output_file_is_written_again(self):
+        self.store.append(self.report, {"Acme": [frame(("Acme", "A-1", "", 1))]})
+        os.remove(self.export())
+        self.assertTrue(os.path.exists(self.export()))
+        self.assertEqual(self.writes.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
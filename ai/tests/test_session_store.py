@@ -0,0 +1,145 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from core import session_store
+from core.session_store import MemorySessionStore, SessionStore, SQLiteSessionStore
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(session_store.time, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class MemorySessionStoreTest(ClockTestCase):
+    def test_sessions_expire_ttl_seconds_after_their_last_write(self):
+        store = MemorySessionStore(ttl_seconds=60, max_entries=10)
+        store.create("s1", {"status": "processing"})
+        self.clock.now += 50
+        store.update("s1", status="completed")
+        self.clock.now += 50
+        self.assertEqual(store.get("s1"), {"status": "completed", "version": 2})
+
+        self.clock.now += 11
+        self.assertIsNone(store.get("s1"))
+        # Writes to an expired session are dropped rather than reviving it.
+        store.update("s1", status="failed")
+        self.assertIsNone(store.get("s1"))
+
+    def test_least_recently_used_finished_sessions_are_evicted_first(self):
+        store = MemorySessionStore(ttl_seconds=60, max_entries=2)
+        store.create("old", {"status": "completed"})
+        store.create("recent", {"status": "completed"})
+        store.get("old")
+        store.create("new", {"status": "completed"})
+        self.assertEqual([k for k in ("old", "recent", "new") if store.get(k)], ["old", "new"])
+
+    def test_processing_sessions_are_never_evicted_for_space(self):
+        store = MemorySessionStore(ttl_seconds=60, max_entries=2)
+        store.create("busy-1", {"status": "processing"})
+        store.create("busy-2", {"status": "processing"})
+        store.create("done", {"status": "completed"})
+        store.create("busy-3", {"status": "processing"})
+
+        self.assertIsNone(store.get("done"))
+        self.assertEqual([store.get(k)["status"] for k in ("busy-1", "busy-2", "busy-3")], ["processing"] * 3)
+
+        # Once finished they are ordinary LRU candidates again.
+        store.update("busy-1", status="completed")
+        store.create("next", {"status": "processing"})
+        self.assertIsNone(store.get("busy-1"))
+
+        # TTL expiry still applies to processing sessions.
+        self.clock.now += 61
+        store.create("later", {"status": "processing"})
+        self.assertEqual([k for k in ("busy-2", "busy-3", "next", "later") if store.get(k)], ["later"])
+
+    def test_get_returns_a_copy(self):
+        store = MemorySessionStore(ttl_seconds=60, max_entries=10)
+        store.create("s1", {"files": {}})
+        store.get("s1")["files"]["a.pdf"] = "Done"
+        self.assertEqual(store.get("s1")["files"], {})
+
+
+class SQLiteSessionStoreTest(ClockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.db_path = os.path.join(self.folder.name, "sessions.sqlite3")
+
+    def test_writes_are_shared_between_store_instances_and_expire(self):
+        api, worker = SQLiteSessionStore(self.db_path, ttl_seconds=60), SQLiteSessionStore(self.db_path, ttl_seconds=60)
+        api.create("s1", {"files": {}, "completed_count": 0})
+
+        def mark_done(state):
+            state["files"]["a.pdf"] = "Done"
+            state["completed_count"] += 1
+
+        worker.mutate("s1", mark_done)
+        api.mutate("s1", lambda state: state.update(status="completed"))
+        self.assertEqual(api.get("s1"), {
+            "files": {"a.pdf": "Done"}, "completed_count": 1, "status": "completed", "version": 3,
+        })
+
+        self.clock.now += 61
+        self.assertIsNone(worker.get("s1"))
+
+    def test_failed_mutation_is_rolled_back(self):
+        store = SQLiteSessionStore(self.db_path, ttl_seconds=60)
+        store.create("s1", {"count": 0})
+
+        def broken(state):
+            state["count"] += 1
+            raise ValueError("bad update")
+
+        with self.assertRaises(ValueError):
+            store.mutate("s1", broken)
+        self.assertEqual(store.get("s1"), {"count": 0, "version": 1})
+
+
+class WaitForChangeTest(unittest.TestCase):
+    def test_base_class_cannot_be_instantiated(self):
+        with self.assertRaises(TypeError):
+            SessionStore()
+
+    def test_a_write_from_another_thread_wakes_the_waiter(self):
+        store = MemorySessionStore(ttl_seconds=60, max_entries=10)
+        store.create("s1", {"status": "processing"})
+
+        async def scenario():
+            loop = asyncio.get_running_loop()
+            writer = threading.Timer(0.05, store.update, args=("s1",), kwargs={"status": "completed"})
+            started = loop.time()
+            writer.start()
+            state = await store.wait_for_change("s1", 1, timeout=5)
+            return state, loop.time() - started
+
+        state, waited = asyncio.run(scenario())
+        self.assertEqual((state["status"], state["version"]), ("completed", 2))
+        self.assertLess(waited, 1)
+        self.assertEqual(store._waiters, {})
+
+    def test_unchanged_state_is_returned_after_the_timeout(self):
+        store = MemorySessionStore(ttl_seconds=60, max_entries=10)
+        store.create("s1", {"status": "processing"})
+        self.assertEqual(asyncio.run(store.wait_for_change("s1", 1, timeout=0.05))["version"], 1)
+        self.assertIsNone(asyncio.run(store.wait_for_change("missing", 1, timeout=0.05)))
+
+
+if __name__ == "__main__":
+    unittest.main()
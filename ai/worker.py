@@ -0,0 +1,212 @@
+"""
+Extraction workers for EXTRACTION_QUEUE=durable.
+
+    python worker.py [processes]
+
+Starts `processes` (default JOB_WORKERS) worker processes, each leasing up to
+JOB_FILES_PER_WORKER files at a time from the job queue that /extract fills.
+Run it from the same directory as the API, so upload and report paths match.
+Killed workers lose nothing but the files they were holding, which are leased
+again once their lease runs out; a file whose processing raises is handed back
+at once. Extracted files are never run twice.
+The Gemini rate limits and concurrency caps are split between the processes.
+"""
+import os
+import sys
+import signal
+import socket
+import asyncio
+import functools
+import multiprocessing
+
+from config.settings import (
+    JOB_WORKERS, JOB_FILES_PER_WORKER, JOB_LEASE_SECONDS, SESSION_STORE, GEMINI_PROCESS_SHARE,
+)
+from core.pdf_utils import shutdown_raster_pool
+from core.schema_manager import schema_registry
+from core.gemini_clients import gemini_clients
+from core.fair_scheduler import fair_scheduler
+from core.job_queue import job_queue
+from core.result_store import result_store
+from core.session_store import session_store
+from core.pipeline import (
+    process_single_file_async, log_file_usage, mark_file_done, store_file_result, write_session_report,
+    RASTER_PREFETCH,
+)
+from costing.cost_manager import CostManager
+from costing.price_service import price_service
+from costing.usage_ledger import usage_ledger
+
+# Seconds between queue polls while there is nothing to lease.
+POLL_SECONDS = 1.0
+
+
+def job_cost_manager(job, results):
+    """
+    Rebuilds the cost aggregates of a job from its stored per-file usage. The
+    ledger already holds these calls (recorded when each file finished), so
+    nothing is written to it again.
+    """
+    cost_manager = CostManager(user_id=job["user_id"], session_id=job["session_id"], ledger=None)
+    for result in results:
+        log_file_usage(cost_manager, os.path.basename(result["file_path"]), result["stats"])
+    return cost_manager
+
+
+async def process_leased_file(lease, worker_id, prefetch_semaphore):
+    try:
+        await _process_leased_file(lease, worker_id, prefetch_semaphore)
+    except Exception as e:
+        # Handed back at once: retried by any worker, or failed after JOB_MAX_ATTEMPTS.
+        print(f"❌ Worker error on {lease['file_path']}: {e}")
+        await asyncio.to_thread(job_queue.abandon_file, lease["job_id"], lease["position"], worker_id, str(e))
+
+
+async def _process_leased_file(lease, worker_id, prefetch_semaphore):
+    job_id = lease["job_id"]
+    filename = os.path.basename(lease["file_path"])
+
+    def mark_processing(state):
+        state["files"][filename] = "Processing..."
+    await asyncio.to_thread(session_store.mutate, job_id, mark_processing)
+
+    schema = schema_registry.snapshot()
+    gemini_slot = functools.partial(fair_scheduler.slot, lease["user_id"], session_key=job_id)
+    invoices, stats, msg = await process_single_file_async(lease["file_path"], schema, gemini_slot, prefetch_semaphore)
+    print(f"⏱️  Worker Finished: {filename} -> {msg}")
+
+    # Billed (and the queued ledger write flushed) before the result is stored: if the worker
+    # dies in between, the rerun is served by the extraction cache and is not billed again.
+    log_file_usage(CostManager(user_id=lease["user_id"], session_id=lease["session_id"]), filename, stats)
+    await asyncio.to_thread(usage_ledger.flush)
+
+    # Stored before the file is marked finished, so the report writer never races it. Only
+    # /partial reads these rows; the final report is rebuilt from the queue.
+    if invoices:
+        await asyncio.to_thread(store_file_result, lease["report_path"], invoices, lease["user_id"], lease["session_id"])
+
+    if not job_queue.complete_file(job_id, lease["position"], worker_id, invoices, stats, msg,
+                                   failed=invoices is None and stats is None):
+        print(f"   > ⚠️ Lease on {filename} was lost; result dropped.")
+        return
+
+    results = await asyncio.to_thread(job_queue.file_results, job_id)
+    cost = job_cost_manager(lease, results).running_totals()
+    await asyncio.to_thread(mark_file_done, job_id, filename, msg, stats, cost, fair_scheduler.snapshot(job_id))
+
+
+def finalize_job(job, worker_id):
+    """
+    Writes the report of a job whose files are all finished.
+    """
+    job_id = job["job_id"]
+    try:
+        # The rows stored per file may be incomplete (a worker can die between finishing
+        # a file and storing its rows), so the report is rebuilt from the queue.
+        result_store.drop_report(result_store.report_key(job["report_path"]))
+        if os.path.exists(job["report_path"]):
+            os.remove(job["report_path"])
+        os.makedirs(os.path.dirname(job["report_path"]), exist_ok=True)
+
+        results = job_queue.file_results(job_id)
+        download_link, financial_summary = write_session_report(
+            job["user_id"], job["session_id"], job["report_path"], job_cost_manager(job, results),
+            [result["invoices"] for result in results if result["invoices"]],
+        )
+        session_store.update(job_id, status="completed", download_url=download_link,
+                             cost_analysis=financial_summary)
+        job_queue.finish_job(job_id, worker_id)
+        print(f"✅ Session {job['session_id']} Completed.")
+    except Exception as e:
+        print(f"❌ Global Error in Job {job_id}: {e}")
+        session_store.update(job_id, status="failed", error=str(e))
+        job_queue.finish_job(job_id, worker_id, error=str(e))
+
+
+async def heartbeat(worker_id, active_files):
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        await asyncio.to_thread(job_queue.heartbeat, worker_id, list(active_files))
+
+
+async def run_worker(worker_id):
+    gemini_clients.start()
+    price_service.start()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    prefetch_semaphore = asyncio.Semaphore(JOB_FILES_PER_WORKER + RASTER_PREFETCH)
+    in_flight = set()
+    # (job_id, position) of the files being processed: only their leases are kept alive.
+    active_files = set()
+    beats = asyncio.create_task(heartbeat(worker_id, active_files))
+    print(f"🚀 Worker {worker_id} started.")
+
+    try:
+        while not stopping.is_set():
+            leases = job_queue.lease_files(worker_id, JOB_FILES_PER_WORKER - len(in_flight))
+            for lease in leases:
+                file_key = (lease["job_id"], lease["position"])
+                active_files.add(file_key)
+                task = asyncio.create_task(process_leased_file(lease, worker_id, prefetch_semaphore))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                task.add_done_callback(lambda _, file_key=file_key: active_files.discard(file_key))
+
+            job = job_queue.claim_finished_job(worker_id)
+            if job is not None:
+                await asyncio.to_thread(finalize_job, job, worker_id)
+                fair_scheduler.forget_session(job["job_id"])
+                continue
+
+            if not leases:
+                try:
+                    await asyncio.wait_for(stopping.wait(), POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+        # Graceful stop: finish what is in flight, hand back anything else.
+        if in_flight:
+            print(f"   > Worker {worker_id} finishing {len(in_flight)} file(s) before exit...")
+            await asyncio.gather(*in_flight, return_exceptions=True)
+    finally:
+        beats.cancel()
+        job_queue.release(worker_id)
+        await price_service.stop()
+        await gemini_clients.aclose()
+        shutdown_raster_pool()
+        print(f"👋 Worker {worker_id} stopped.")
+
+
+def worker_main(index):
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+    asyncio.run(run_worker(worker_id))
+
+
+def main(processes=JOB_WORKERS):
+    if SESSION_STORE != "sqlite":
+        print("⚠️ SESSION_STORE is not sqlite: the API will not see progress from these workers.")
+
+    # Spawned processes read the settings afresh: each one enforces its share of the
+    # per-key rate limits and concurrency caps, so together they stay within them.
+    os.environ["GEMINI_PROCESS_SHARE"] = str(GEMINI_PROCESS_SHARE * processes)
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=worker_main, args=(i,), name=f"extract-worker-{i}") for i in range(processes)]
+    for p in workers:
+        p.start()
+
+    def forward(signum, frame):
+        for p in workers:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    for p in workers:
+        p.join()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else JOB_WORKERS)